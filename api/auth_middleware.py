@@ -1,23 +1,81 @@
 import datetime
+import time
+from collections import OrderedDict
 from hashlib import blake2b
 from multiprocessing import AuthenticationError
 from os import environ
+from typing import Optional
 
 import datastore as ds
 import jwt
+import settings
 from bson import ObjectId
 from pydantic import Field
-from routes.models import AuthenticatedUser, User
+from routes.models import User
 from starlette.authentication import (AuthCredentials, AuthenticationBackend,
                                       UnauthenticatedUser)
 
 
+class Principal:
+    # The request's user as far as the token says. Endpoints that need the user document
+    # call load_user(); the others never touch Mongo or build a model.
+    __slots__ = ("id", "username", "roles")
+
+    def __init__(self, id: ObjectId, username: str, roles: tuple):
+        self.id = id
+        self.username = username
+        self.roles = roles
+
+    @property
+    def is_authenticated(self) -> bool:
+        return True
+
+    @property
+    def display_name(self) -> str:
+        return self.username
+
+    @property
+    def identity(self) -> str:
+        return str(self.id)
+
+    async def load_user(self) -> Optional[User]:
+        user = await ds.get_user(id=self.id)
+        return User.from_mongo(user) if user else None
+
+
+class TokenCache:
+    # Per-worker LRU of verified tokens, each kept until the token's exp or the cache TTL
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # token -> (expires, (credentials, principal))
+
+    def get(self, token: str):
+        entry = self.entries.get(token)
+        if entry is None:
+            return None
+        if entry[0] <= time.time():
+            del self.entries[token]
+            return None
+        self.entries.move_to_end(token)
+        return entry[1]
+
+    def set(self, token: str, exp: Optional[float], value: tuple):
+        if self.max_entries <= 0:
+            return
+        expires = time.time() + self.ttl
+        self.entries[token] = (min(expires, exp) if exp else expires, value)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
 class JWTAuthenticationBackend(AuthenticationBackend):
     algorithm = 'HS256'
     prefix = 'Bearer'
     username_field = 'username'
     def __init__(self, secret_key: str):
         self.secret_key = secret_key
+        self.tokens = TokenCache(settings.AUTH_CACHE_MAX_ENTRIES, settings.AUTH_CACHE_TTL_SECONDS)
 
     def get_token_from_header(self, authorization):
         try:
@@ -30,13 +88,16 @@ class JWTAuthenticationBackend(AuthenticationBackend):
         return token
 
     async def authenticate(self, conn):
-        if "Authorization" not in conn.headers:
+        if (authorization := conn.headers.get("Authorization")) is None:
             return AuthCredentials([]), UnauthenticatedUser()
-        token = self.get_token_from_header(conn.headers["Authorization"])
+        token = self.get_token_from_header(authorization)
+        if (verified := self.tokens.get(token)) is not None:
+            return verified
         try:
             payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
-            payload["_id"] = ObjectId(payload["_id"])
-
+            principal = Principal(ObjectId(payload["_id"]), payload[self.username_field], tuple(payload["roles"]))
         except jwt.InvalidTokenError as e:
             raise AuthenticationError(str(e))
-        return AuthCredentials(["authenticated", *payload["roles"]]), User(authenticated=True, **payload)
+        verified = AuthCredentials(["authenticated", *principal.roles]), principal
+        self.tokens.set(token, payload.get("exp"), verified)
+        return verified
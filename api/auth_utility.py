@@ -21,8 +21,8 @@ class EnhancedJSONEncoder(json.JSONEncoder):
         return super().default(o)
 
 
-def credentials_match(username, password):
-    user = ds.get_user(username=username)
+async def credentials_match(username, password):
+    user = await ds.get_user(username=username)
     if user and user["password_hash"] == hash_password(password):
         return user
     return None
@@ -0,0 +1,66 @@
+# Sets the attendee_count / presentation_count of every conference from its attendees and
+# presentations, for conferences created before the counters existed. Optional: the first write
+# that changes such a conference's counter sets it from the arrays first (datastore.init_counters),
+# and reads fall back to the array sizes until then. This sets them all at once.
+#
+#   python -m backfill_counters
+import asyncio
+import sys
+
+import datastore  # noqa: F401 resolves the routes.models import cycle
+import settings
+from common.database import close, db
+from pymongo import UpdateOne
+
+
+def counted(attendees: str, presentations: str):
+    return {
+        "attendee_count": {"$size": {"$ifNull": [attendees, []]}},
+        "presentation_count": {"$size": {"$ifNull": [presentations, []]}},
+    }
+
+
+async def backfill_embedded():
+    # A pipeline update rewrites each location in one atomic write, so registrations made while
+    # it runs are either counted or still to come
+    result = await db.locations.update_many(
+        {"conferences.0": {"$exists": True}},
+        [{"$set": {"conferences": {"$map": {
+            "input": "$conferences",
+            "in": {"$mergeObjects": ["$$this", counted("$$this.attendees", "$$this.presentations")]},
+        }}}}],
+    )
+    return result.modified_count
+
+
+async def backfill_normalized(batch_size: int = 500):
+    pipeline = [
+        {"$lookup": {"from": "registrations", "localField": "_id", "foreignField": "conference_id", "as": "attendees"}},
+        {"$lookup": {"from": "presentations", "localField": "_id", "foreignField": "conference_id", "as": "presentations"}},
+        {"$project": counted("$attendees", "$presentations")},
+    ]
+    modified, requests = 0, []
+    async for conference in db.conferences.aggregate(pipeline):
+        counters = {key: value for key, value in conference.items() if key != "_id"}
+        requests.append(UpdateOne({"_id": conference["_id"]}, {"$set": counters}))
+        if len(requests) == batch_size:
+            modified += (await db.conferences.bulk_write(requests, ordered=False)).modified_count
+            requests = []
+    if requests:
+        modified += (await db.conferences.bulk_write(requests, ordered=False)).modified_count
+    return modified
+
+
+async def main():
+    try:
+        if settings.STORAGE_LAYOUT == "normalized":
+            print(f"updated {await backfill_normalized()} conferences")
+        else:
+            print(f"updated {await backfill_embedded()} locations")
+        return 0
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
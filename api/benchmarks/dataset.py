@@ -0,0 +1,164 @@
+# Generates a synthetic dataset for benchmarks.load_test and loads it into Mongo
+# (MONGO_DB_CONNECTION_STRING / MONGO_DB_NAME, use a database of its own).
+# The same --seed and sizes always give the same documents and ids, so runs are comparable.
+# Run from the api directory: python -m benchmarks.dataset --locations 500 --users 5000 --drop
+import argparse
+import asyncio
+import random
+import sys
+from datetime import datetime, timedelta
+
+import datastore  # noqa: F401 - imports routes.models in the same order the app does
+import migrate_normalized
+import reindex_search
+import settings
+from auth_utility import hash_password
+from bson import ObjectId
+from common.constants import US_STATES, Role, Status
+from common.database import close, db
+from indexes import ensure_indexes
+from routes.models import Conference, Location, Presentation
+
+PASSWORD = "benchmark"
+ADMIN_EVERY = 50  # user 0, 50, 100... are admins and can submit presentations
+START = datetime(2026, 1, 1)
+WORDS = ("cloud", "data", "python", "mongo", "async", "scale", "design", "security", "testing", "devops",
+         "frontend", "api", "search", "streaming", "observability", "mobile", "ml", "edge", "rust", "web")
+
+
+def username(i: int) -> str:
+    return f"user{i}"
+
+
+def is_admin(i: int) -> bool:
+    return i % ADMIN_EVERY == 0
+
+
+class Generator:
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+
+    def object_id(self) -> ObjectId:
+        # Seeded ids, so a regenerated dataset has the same ids in the same order
+        return ObjectId(self.rng.randbytes(12))
+
+    def words(self, count: int) -> str:
+        return " ".join(self.rng.choice(WORDS) for _ in range(count))
+
+    def users(self, count: int) -> list:
+        password_hash = hash_password(PASSWORD)
+        users = []
+        for i in range(count):
+            users.append({
+                "_id": self.object_id(),
+                "username": username(i),
+                "name": f"User {i}",
+                "email": f"{username(i)}@example.com",
+                "company_name": f"Company {i % 97}",
+                "password_hash": password_hash,
+                "roles": [Role.USER, Role.ADMIN] if is_admin(i) else [Role.USER],
+                "conferences": [],
+                "presentations": [],
+            })
+        return users
+
+    def locations(self, count: int, conferences: int, presentations: int, max_attendees: int, users: list) -> list:
+        states = list(US_STATES.items())
+        presenters = [user for user in users if Role.ADMIN in user["roles"]] or users
+        locations = []
+        for i in range(count):
+            name, abbreviation = states[i % len(states)]
+            location_id = self.object_id()
+            location = Location(
+                _id=location_id, name=f"Venue {i}", city=f"{name} City {i % 5}", room_count=self.rng.randint(1, 40),
+                picture_url=f"https://images.example.com/{i}.jpg", state={"name": name, "abbreviation": abbreviation},
+            )
+            for j in range(self.rng.randint(max(conferences // 2, 1), conferences)):
+                starts = START + timedelta(days=self.rng.randint(0, 365))
+                conference = Conference(
+                    _id=self.object_id(), name=f"{self.words(2).title()} Conf {i}-{j}", starts=starts,
+                    ends=starts + timedelta(days=self.rng.randint(1, 4)), description=self.words(30),
+                    max_presentations=presentations * 2, max_attendees=max_attendees, location_id=location_id,
+                )
+                for _ in range(self.rng.randint(0, presentations)):
+                    presenter = self.rng.choice(presenters)
+                    presentation = Presentation(
+                        _id=self.object_id(), presenter=presenter["_id"], title=self.words(5).capitalize(),
+                        synopsis=self.words(60), status=self.rng.choice(list(Status)),
+                        location_id=location_id, conference_id=conference.id,
+                    )
+                    conference.presentations.append(presentation)
+                    presenter["presentations"].append(presentation.id)
+                location.conferences.append(conference)
+            locations.append(location)
+        return locations
+
+    def register(self, locations: list, users: list, per_user: int):
+        # Fills conferences up to about half their capacity, leaving room for the load test
+        conferences = [conference for location in locations for conference in location.conferences]
+        for user in users:
+            for conference in self.rng.sample(conferences, min(per_user, len(conferences))):
+                if len(conference.attendees) < conference.max_attendees // 2:
+                    conference.attendees.append(user["_id"])
+                    user["conferences"].append(conference.id)
+
+
+def counted(location: Location) -> dict:
+    # With the counters datastore keeps next to the arrays (see datastore.COUNTERS)
+    document = location.dict(by_alias=True)
+    for conference in document["conferences"]:
+        conference["attendee_count"] = len(conference["attendees"])
+        conference["presentation_count"] = len(conference["presentations"])
+    return document
+
+
+async def load(args) -> int:
+    if not args.drop and (await db.locations.estimated_document_count() or await db.users.estimated_document_count()):
+        print(f"{settings.MONGO_DB_NAME} already has data, pass --drop to replace it", file=sys.stderr)
+        return 1
+    generator = Generator(args.seed)
+    users = generator.users(args.users)
+    locations = generator.locations(args.locations, args.conferences, args.presentations, args.max_attendees, users)
+    generator.register(locations, users, args.registrations)
+
+    for collection in ("locations", "users", "conferences", "presentations", "registrations", "migrations",
+                       "jobs", "response_cache", "cache_generations", "search"):
+        await db[collection].drop()
+    await ensure_indexes()
+    for start in range(0, len(users), args.batch_size):
+        await db.users.insert_many(users[start:start + args.batch_size], ordered=False)
+    for start in range(0, len(locations), args.batch_size):
+        await db.locations.insert_many([counted(location) for location in locations[start:start + args.batch_size]],
+                                       ordered=False)
+    if settings.STORAGE_LAYOUT == "normalized":
+        await migrate_normalized.sync(args.batch_size, restart=True, force=True)
+    await reindex_search.reindex()
+
+    conferences = sum(len(location.conferences) for location in locations)
+    presentations = sum(len(c.presentations) for location in locations for c in location.conferences)
+    registrations = sum(len(c.attendees) for location in locations for c in location.conferences)
+    print(f"loaded {len(locations)} locations, {conferences} conferences, {presentations} presentations, "
+          f"{len(users)} users, {registrations} registrations into {settings.MONGO_DB_NAME} ({settings.STORAGE_LAYOUT})")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--locations", type=int, default=200)
+    parser.add_argument("--conferences", type=int, default=6, help="max conferences per location")
+    parser.add_argument("--presentations", type=int, default=8, help="max presentations per conference")
+    parser.add_argument("--max-attendees", type=int, default=200)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--registrations", type=int, default=3, help="conferences each user registers for")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--drop", action="store_true", help="replace the data already in the database")
+    args = parser.parse_args()
+    try:
+        sys.exit(asyncio.run(load(args)))
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    main()
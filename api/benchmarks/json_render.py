@@ -0,0 +1,90 @@
+# Compares the old double-encoding renderer with common.json.PydanticJSONResponse.
+# Run from the api directory: python -m benchmarks.json_render --locations 1000
+import argparse
+import json
+import timeit
+from datetime import datetime, timedelta
+
+import datastore  # noqa: F401 - imports routes.models in the same order the app does
+from bson import ObjectId
+from common.constants import US_STATES
+from common.json import PydanticJSONResponse, orjson
+from routes.models import Conference, Location, Presentation
+
+
+class LegacyEncoder(json.JSONEncoder):
+    def default(self, obj):
+        return json.loads(obj.json())
+
+
+def legacy_render(content):
+    return json.dumps(content, cls=LegacyEncoder).encode("utf-8")
+
+
+def build_locations(count: int, conferences: int, presentations: int, attendees: int):
+    states = list(US_STATES.items())
+    now = datetime.now()
+    locations = []
+    for i in range(count):
+        name, abbreviation = states[i % len(states)]
+        location_id = ObjectId()
+        locations.append(Location(
+            _id=location_id,
+            name=f"Venue {i}",
+            city=f"City {i}",
+            room_count=10,
+            picture_url=f"https://images.example.com/{i}.jpg",
+            state={"name": name, "abbreviation": abbreviation},
+            conferences=[
+                Conference(
+                    name=f"Conference {i}-{j}",
+                    starts=now + timedelta(days=j),
+                    ends=now + timedelta(days=j + 2),
+                    description="A conference about things " * 4,
+                    max_presentations=presentations,
+                    max_attendees=attendees,
+                    location_id=location_id,
+                    attendees=[ObjectId() for _ in range(attendees)],
+                    presentations=[
+                        Presentation(
+                            presenter=ObjectId(),
+                            title=f"Talk {k}",
+                            synopsis="What this talk is about " * 8,
+                        )
+                        for k in range(presentations)
+                    ],
+                )
+                for j in range(conferences)
+            ],
+        ))
+    return locations
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--locations", type=int, default=1000)
+    parser.add_argument("--conferences", type=int, default=3)
+    parser.add_argument("--presentations", type=int, default=5)
+    parser.add_argument("--attendees", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    content = {"locations": build_locations(args.locations, args.conferences, args.presentations, args.attendees)}
+    assert json.loads(legacy_render(content)) == json.loads(PydanticJSONResponse(200, content).body)
+
+    renderers = {
+        "legacy (obj.json -> loads -> dumps)": legacy_render,
+        f"PydanticJSONResponse ({'orjson' if orjson else 'json'})": lambda c: PydanticJSONResponse(200, c).body,
+    }
+    print(f"{args.locations} locations x {args.conferences} conferences x {args.presentations} presentations")
+    results = {}
+    for label, render in renderers.items():
+        best = min(timeit.repeat(lambda: render(content), number=1, repeat=args.repeat))
+        results[label] = best
+        print(f"{label:45} {best * 1000:10.1f} ms  {len(render(content)) / 1024:10.1f} KiB")
+    legacy, current = results.values()
+    print(f"speedup: {legacy / current:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
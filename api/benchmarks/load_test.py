@@ -0,0 +1,253 @@
+# Drives conference_go.app with concurrent clients and reports throughput and latency percentiles
+# per flow. Load the data first with benchmarks.dataset (same --users), and reload it before runs
+# that should be compared, since registrations and submissions fill the conferences up.
+#
+# Run from the api directory:
+#   python -m benchmarks.load_test --duration 30 --concurrency 32 --save baseline.json
+#   python -m benchmarks.load_test --duration 30 --concurrency 32 --compare baseline.json
+#
+# Without --url the app runs in this process through httpx's ASGI transport, lifespan included;
+# with --url the requests go to a running server instead.
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+from benchmarks.dataset import PASSWORD, WORDS, is_admin, username
+
+FLOWS = {
+    "list": 35,
+    "detail": 30,
+    "login": 5,
+    "registration": 20,
+    "submission": 10,
+    "search": 5,
+}
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, users: int, seed: int):
+        self.client = client
+        self.users = users
+        self.rng = random.Random(seed)
+        self.locations = []  # (location_id, [conference_id, ...])
+        self.tokens = {}  # user index -> token
+        self.latencies = defaultdict(list)  # flow -> seconds
+        self.statuses = defaultdict(lambda: defaultdict(int))  # flow -> status -> count
+
+    async def login(self, i: int) -> str:
+        response = await self.client.post("/login/", json={"username": username(i), "password": PASSWORD})
+        response.raise_for_status()
+        return response.cookies["token"]
+
+    async def prepare(self, logins: int):
+        after = None
+        while True:
+            response = await self.client.get("/api/locations/", params={"limit": 1000, **({"after": after} if after else {})})
+            response.raise_for_status()
+            page = response.json()
+            self.locations.extend(
+                (location["id"], [conference["id"] for conference in location["conferences"]])
+                for location in page["locations"]
+            )
+            if not (after := page["next"]):
+                break
+        self.locations = [location for location in self.locations if location[1]]
+        if not self.locations:
+            raise SystemExit("no conferences found, load a dataset with benchmarks.dataset first")
+
+        # Tokens for the registration and submission flows, the admins among them can submit
+        users = self.rng.sample(range(self.users), min(logins, self.users))
+        admins = [i for i in range(0, self.users) if is_admin(i)][:max(1, logins // 10)]
+        for i in {*users, *admins}:
+            self.tokens[i] = await self.login(i)
+        self.user_tokens = [self.tokens[i] for i in users]
+        self.admin_tokens = [self.tokens[i] for i in admins]
+
+    def conference(self):
+        location_id, conferences = self.rng.choice(self.locations)
+        return location_id, self.rng.choice(conferences)
+
+    def flow_request(self, flow: str):
+        location_id, conference_id = self.conference()
+        if flow == "list":
+            return self.rng.choice((
+                lambda: self.client.get("/api/locations/", params={"limit": 50}),
+                lambda: self.client.get("/api/conferences/", params={"limit": 50}),
+                lambda: self.client.get(f"/api/locations/{location_id}/conferences/"),
+                lambda: self.client.get("/api/presentations/", params={"limit": 50, "status": "approved"}),
+                lambda: self.client.get("/api/conferences/calendar",
+                                        params={"from": f"2026-{self.rng.randint(1, 12):02}-01", "days": 30, "limit": 50}),
+            ))()
+        if flow == "detail":
+            return self.rng.choice((
+                lambda: self.client.get(f"/api/locations/{location_id}/"),
+                lambda: self.client.get(f"/api/locations/{location_id}/conferences/{conference_id}"),
+                lambda: self.client.get(f"/api/conferences/{conference_id}/stats"),
+            ))()
+        if flow == "search":
+            params = {"q": " ".join(self.rng.sample(WORDS, self.rng.randint(1, 2))), "limit": 20}
+            if self.rng.random() < 0.5:
+                params["status"] = "approved"
+            return self.client.get("/api/search", params=params)
+        if flow == "login":
+            i = self.rng.randrange(self.users)
+            return self.client.post("/login/", json={"username": username(i), "password": PASSWORD})
+        if flow == "registration":
+            token = self.rng.choice(self.user_tokens)
+            return self.client.post(
+                f"/api/locations/{location_id}/conferences/{conference_id}/attendees/",
+                headers={"Authorization": f"Bearer {token}"},
+            )
+        token = self.rng.choice(self.admin_tokens)
+        return self.client.post(
+            f"/api/locations/{location_id}/conferences/{conference_id}/presentations/",
+            json={"title": "Load test talk", "synopsis": "Submitted by benchmarks.load_test"},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+
+    async def worker(self, deadline: float, flows: list, weights: list):
+        while time.perf_counter() < deadline:
+            flow = self.rng.choices(flows, weights)[0]
+            started = time.perf_counter()
+            try:
+                status = (await self.flow_request(flow)).status_code
+            except Exception:
+                # Transport errors, or an exception raised by the app itself when it runs in-process
+                status = "error"
+            self.latencies[flow].append(time.perf_counter() - started)
+            self.statuses[flow][status] += 1
+
+    async def run(self, duration: float, concurrency: int, mix: dict) -> dict:
+        flows, weights = list(mix), list(mix.values())
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(self.worker(deadline, flows, weights) for _ in range(concurrency)))
+        return self.report(time.perf_counter() - started)
+
+    def report(self, elapsed: float) -> dict:
+        self.latencies["all"] = [latency for latencies in self.latencies.values() for latency in latencies]
+        for statuses in list(self.statuses.values()):
+            for status, count in statuses.items():
+                self.statuses["all"][status] += count
+        results = {}
+        for flow in [*(flow for flow in FLOWS if flow in self.latencies), "all"]:
+            latencies = sorted(self.latencies[flow])
+            statuses = self.statuses[flow]
+            results[flow] = {
+                "requests": len(latencies),
+                "throughput": len(latencies) / elapsed,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+                # 409 (full) and 400 (already registered) are expected answers under load, 5xx are not
+                "errors": sum(count for status, count in statuses.items() if status == "error" or status >= 500),
+                "statuses": {str(status): count for status, count in sorted(statuses.items(), key=str)},
+            }
+        return results
+
+
+def print_report(results: dict, baseline: dict = None):
+    print(f"{'flow':14}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for flow, result in results.items():
+        print(f"{flow:14}{result['requests']:>10}{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}"
+              f"{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['errors']:>8}")
+        if baseline and flow in baseline:
+            before = baseline[flow]
+            deltas = [
+                f"{key} {change(before[key], result[key]):+.1%}"
+                for key in ("throughput", "p50_ms", "p95_ms", "p99_ms")
+            ]
+            print(f"{'':14}vs baseline: {', '.join(deltas)}")
+
+
+def change(before: float, after: float) -> float:
+    return (after - before) / before if before else 0.0
+
+
+def regressions(results: dict, baseline: dict, threshold: float) -> list:
+    found = []
+    for flow, result in results.items():
+        if flow not in baseline:
+            continue
+        if change(baseline[flow]["p95_ms"], result["p95_ms"]) > threshold:
+            found.append(f"{flow} p95")
+        if change(baseline[flow]["throughput"], result["throughput"]) < -threshold:
+            found.append(f"{flow} throughput")
+    return found
+
+
+def parse_mix(value: str) -> dict:
+    mix = dict(FLOWS)
+    for item in filter(None, value.split(",")):
+        flow, _, weight = item.partition("=")
+        if flow not in FLOWS:
+            raise argparse.ArgumentTypeError(f"unknown flow {flow}, expected one of {', '.join(FLOWS)}")
+        mix[flow] = int(weight)
+    return {flow: weight for flow, weight in mix.items() if weight > 0}
+
+
+async def main(args) -> int:
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=30)
+        lifespan = None
+    else:
+        from conference_go import app
+        client = httpx.AsyncClient(app=app, base_url="http://localhost", timeout=30)
+        lifespan = app.router.lifespan_context(app)
+
+    async with client:
+        if lifespan:
+            await lifespan.__aenter__()
+        try:
+            test = LoadTest(client, args.users, args.seed)
+            await test.prepare(args.logins)
+            if args.warmup:
+                await test.run(args.warmup, args.concurrency, args.mix)
+                test.latencies.clear()
+                test.statuses.clear()
+            results = await test.run(args.duration, args.concurrency, args.mix)
+        finally:
+            if lifespan:
+                await lifespan.__aexit__(None, None, None)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_report(results, baseline)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"config": {key: value for key, value in vars(args).items() if key not in ("save", "compare")},
+                       "results": results}, f, indent=2)
+    if baseline and (found := regressions(results, baseline, args.threshold)):
+        print(f"regressions beyond {args.threshold:.0%}: {', '.join(found)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", help="base URL of a running server, the app runs in-process otherwise")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds run first and not reported")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--mix", type=parse_mix, default=dict(FLOWS),
+                        help=f"flow weights, e.g. list=50,submission=0 (default {FLOWS})")
+    parser.add_argument("--users", type=int, default=2000, help="--users the dataset was loaded with")
+    parser.add_argument("--logins", type=int, default=200, help="users logged in for the registration flow")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this file, e.g. as a baseline")
+    parser.add_argument("--compare", help="baseline file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed p95 / throughput regression")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,81 @@
+# Fires concurrent registrations at one conference and checks it is never oversold.
+# Needs a running Mongo (MONGO_DB_CONNECTION_STRING / MONGO_DB_NAME), the data it creates is removed.
+# Make sure JOBS_WORKERS > 0, the user back-references are written by jobs.
+# Run from the api directory: python -m benchmarks.registration_rush --users 5000 --seats 100
+import argparse
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+import datastore as ds
+from bson import ObjectId
+from common import jobs
+from common.database import close, db
+from routes.models import Conference, Location
+from starlette.exceptions import HTTPException
+
+
+async def register(location_id, conference_id, user_id):
+    try:
+        await ds.attendee_create(location_id, conference_id, user_id)
+        return 201
+    except HTTPException as e:
+        return e.status_code
+
+
+async def rush(users: int, seats: int, duplicates: int):
+    location = Location(
+        name=f"Registration rush {ObjectId()}", city="New York", room_count=1,
+        picture_url="", state={"name": "New York", "abbreviation": "NY"},
+    )
+    conference = Conference(
+        name="Ticket rush", starts=datetime.now(), ends=datetime.now() + timedelta(days=1),
+        description="benchmark", max_presentations=0, max_attendees=seats, location_id=location.id,
+    )
+    location.conferences.append(conference)
+    await db.locations.insert_one(location.dict(by_alias=True))
+    user_ids = [ObjectId() for _ in range(users)]
+    await db.users.insert_many([{"_id": user_id, "username": str(user_id)} for user_id in user_ids])
+
+    jobs.start()
+    try:
+        # Every user signs up once, the first `duplicates` users try a second time as well
+        attempts = user_ids + user_ids[:duplicates]
+        started = time.perf_counter()
+        statuses = await asyncio.gather(*(register(str(location.id), str(conference.id), u) for u in attempts))
+        elapsed = time.perf_counter() - started
+
+        # The user back-references are written by jobs, wait for them to drain
+        while await db.jobs.count_documents({"name": "user_add_conference", "payload.conference_id": conference.id}):
+            await asyncio.sleep(0.1)
+
+        stored = await db.locations.find_one({"_id": location.id})
+        attendees = stored["conferences"][0]["attendees"]
+        registered_users = await db.users.count_documents({"_id": {"$in": user_ids}, "conferences": conference.id})
+
+        print(f"{len(attempts)} registrations in {elapsed:.2f}s ({len(attempts) / elapsed:.0f}/s): {dict(Counter(statuses))}")
+        assert len(attendees) == min(seats, users), f"{len(attendees)} attendees for {seats} seats"
+        assert len(set(attendees)) == len(attendees), "attendee registered twice"
+        assert registered_users == len(attendees), "user back-references out of sync"
+        print(f"ok: {len(attendees)}/{seats} seats taken, no duplicates, back-references consistent")
+    finally:
+        await jobs.stop()
+        await db.locations.delete_one({"_id": location.id})
+        await db.users.delete_many({"_id": {"$in": user_ids}})
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--seats", type=int, default=100)
+    parser.add_argument("--duplicates", type=int, default=50)
+    args = parser.parse_args()
+    try:
+        asyncio.run(rush(args.users, args.seats, args.duplicates))
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    main()
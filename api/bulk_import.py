@@ -0,0 +1,37 @@
+# Imports NDJSON or CSV rows, the same way as POST /api/import/{kind}, and prints the report.
+# The format follows the file extension unless --format is given.
+#
+#   python -m bulk_import locations venues.csv
+#   python -m bulk_import conferences conferences.ndjson --batch-size 1000
+import argparse
+import asyncio
+import json
+import sys
+
+import datastore  # noqa: F401 resolves the routes.models import cycle
+import routes.endpoints  # noqa: F401 registers the fill_location_photo job
+from common.database import close
+from importer import FORMATS, IMPORT_BATCH_SIZE, IMPORTS, run_import
+
+
+async def main(args) -> int:
+    format = args.format or ("csv" if args.file.lower().endswith(".csv") else "ndjson")
+    with open(args.file, "rb") as f:
+        data = f.read()
+    try:
+        report = await run_import(args.kind, data, format, args.batch_size)
+    finally:
+        close()
+    for error in report["errors"]:
+        print(f"line {error['row']}: {error['error']}", file=sys.stderr)
+    print(json.dumps({key: value for key, value in report.items() if key != "errors"} | {"errors": len(report["errors"])}))
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kind", choices=IMPORTS)
+    parser.add_argument("file")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,250 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+import settings
+from bson.errors import BSONError
+from common.compression import cached_encoding, compress, weak_etag
+from common.database import db
+from common.etag import body_etag
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+# The cache only ever makes a response faster: when Mongo fails it, the response is served uncached.
+# BSONError covers DocumentTooLarge, raised when an entry is too big for the mongo backend.
+CACHE_ERRORS = (PyMongoError, BSONError)
+
+
+class Generations:
+    # Per-tag generation counters in Mongo, shared by every worker. invalidate() bumps the counters
+    # of its tags, and an entry is only served while the counters of its tags are the ones read
+    # before its endpoint ran. Each worker keeps a copy of the counters, bumped at once by its own
+    # writes and refreshed from Mongo at most every CACHE_SYNC_SECONDS, so a hit needs no round
+    # trip and another worker's write is seen within that interval.
+    collection = "cache_generations"
+    # Bumps up to this long before the newest one seen are reread, in case one of them committed late
+    overlap = timedelta(seconds=5)
+
+    def __init__(self, sync_seconds: float):
+        self.sync_seconds = sync_seconds
+        self.counters = {}
+        self.newest = None  # the newest `updated` read from Mongo
+        self.synced = None  # time.monotonic() of the last refresh
+        self.syncing = False
+
+    async def current(self, tags: Iterable[str]) -> dict:
+        # While one request refreshes the counters, the others use the copy they have
+        if not self.syncing and (self.synced is None or time.monotonic() - self.synced >= self.sync_seconds):
+            self.syncing = True
+            try:
+                await self.sync()
+            finally:
+                self.syncing = False
+        return {tag: self.counters.get(tag, 0) for tag in tags}
+
+    async def sync(self):
+        query = {} if self.newest is None else {"updated": {"$gte": self.newest - self.overlap}}
+        async for counter in db[self.collection].find(query):
+            self.counters[counter["_id"]] = max(self.counters.get(counter["_id"], 0), counter["generation"])
+            if self.newest is None or counter["updated"] > self.newest:
+                self.newest = counter["updated"]
+        self.synced = time.monotonic()
+
+    async def bump(self, tags: Iterable[str]):
+        async def bump_one(tag: str):
+            counter = await db[self.collection].find_one_and_update(
+                {"_id": tag}, {"$inc": {"generation": 1}, "$currentDate": {"updated": True}},
+                upsert=True, return_document=ReturnDocument.AFTER,
+            )
+            self.counters[tag] = max(self.counters.get(tag, 0), counter["generation"])
+        await asyncio.gather(*(bump_one(tag) for tag in tags))
+
+
+class MemoryCache:
+    # Per-worker LRU with a TTL and a bound on the number of entries. Entries whose tags were
+    # invalidated, by this worker or another one, are dropped when they are next read.
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, tags, value)
+        self.tags = defaultdict(set)  # tag -> keys
+        self.hits = self.misses = self.evictions = 0
+
+    async def get(self, key: str, generations: dict) -> Optional[dict]:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic() or entry[2]["generations"] != generations:
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    async def set(self, key: str, value: dict, tags: Iterable[str]):
+        if key in self.entries:
+            self._remove(key)
+        tags = tuple(tags)
+        self.entries[key] = (time.monotonic() + self.ttl, tags, value)
+        for tag in tags:
+            self.tags[tag].add(key)
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    async def invalidate(self, *tags: str):
+        for tag in tags:
+            for key in list(self.tags.pop(tag, ())):
+                self._remove(key)
+
+    def _remove(self, key: str):
+        _, tags, _ = self.entries.pop(key)
+        for tag in tags:
+            if (keys := self.tags.get(tag)) is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "entries": len(self.entries), "max_entries": self.max_entries,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class MongoCache:
+    # Shared by every worker, at the cost of a round trip per hit. Expired entries are removed by
+    # the TTL index on `expires` (see indexes.py).
+    collection = "response_cache"
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.hits = self.misses = 0
+
+    async def get(self, key: str, generations: dict) -> Optional[dict]:
+        entry = await db[self.collection].find_one({"_id": key, "expires": {"$gt": datetime.utcnow()}})
+        if entry is None or entry["value"]["generations"] != generations:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["value"]
+
+    async def set(self, key: str, value: dict, tags: Iterable[str]):
+        expires = datetime.utcnow() + timedelta(seconds=self.ttl)
+        await db[self.collection].replace_one(
+            {"_id": key}, {"value": value, "tags": list(tags), "expires": expires}, upsert=True
+        )
+
+    async def invalidate(self, *tags: str):
+        await db[self.collection].delete_many({"tags": {"$in": list(tags)}})
+
+    def stats(self) -> dict:
+        return {"backend": "mongo", "hits": self.hits, "misses": self.misses}
+
+
+def create_backend(name: str):
+    if name == "memory":
+        return MemoryCache(settings.CACHE_MAX_ENTRIES, settings.CACHE_TTL_SECONDS)
+    if name == "mongo":
+        return MongoCache(settings.CACHE_TTL_SECONDS)
+    if name == "none":
+        return None
+    raise ValueError(f"Unknown CACHE_BACKEND: {name}")
+
+
+backend = create_backend(settings.CACHE_BACKEND)
+generations = Generations(settings.CACHE_SYNC_SECONDS)
+
+
+def cache_key(request: Request) -> str:
+    return f"{request.url.path}?{'&'.join(sorted(f'{k}={v}' for k, v in request.query_params.multi_items()))}"
+
+
+def cached_response(request: Request, entry: dict, status: str) -> Response:
+    # Serves the entry's compressed copy for the request's encoding, which CompressionMiddleware
+    # passes through. A copy made on a hit is kept by the memory backend, whose entries are the
+    # stored dicts themselves; the mongo backend only keeps the one made when the entry was set.
+    body, headers = entry["body"], {"X-Cache": status, "ETag": entry["etag"]}
+    if encoding := cached_encoding(request.headers, entry["media_type"], len(body)):
+        encoded = entry.setdefault("encoded", {})
+        if encoding not in encoded:
+            encoded[encoding] = compress(body, encoding)
+        body = encoded[encoding]
+        headers.update({"Content-Encoding": encoding, "Vary": "Accept-Encoding", "ETag": weak_etag(entry["etag"])})
+    return Response(body, status_code=entry["status_code"], media_type=entry["media_type"], headers=headers)
+
+
+def cached(*tags: str):
+    # Caches 200 responses of a read endpoint. Tags may reference path params, e.g.
+    # "location:{location_id}", and are what the datastore writes invalidate.
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request: Request):
+            if backend is None:
+                return await endpoint(request)
+
+            key = cache_key(request)
+            entry_tags = []
+            for tag in tags:
+                try:
+                    entry_tags.append(tag.format(**request.path_params))
+                except KeyError:
+                    continue
+            try:
+                # Read before the endpoint runs, so a write that lands while it runs is noticed
+                read_generations = await generations.current(entry_tags)
+                entry = await backend.get(key, read_generations)
+            except CACHE_ERRORS:
+                return await endpoint(request)
+            if entry is not None:
+                return cached_response(request, entry, "HIT")
+
+            response = await endpoint(request)
+            if response.status_code == 200:
+                # The ETag is computed once here and served from the cache afterwards
+                value = {"body": response.body, "status_code": 200, "media_type": response.media_type,
+                         "etag": body_etag(response.body), "generations": read_generations}
+                # Compresses the body for this request's encoding before it is stored
+                response = cached_response(request, value, "MISS")
+                try:
+                    # A body read before a write invalidated one of its tags may predate the write
+                    if await generations.current(entry_tags) == read_generations:
+                        await backend.set(key, value, entry_tags)
+                except CACHE_ERRORS:
+                    pass
+                return response
+            response.headers["X-Cache"] = "MISS"
+            return response
+        return wrapper
+    return decorator
+
+
+async def invalidate(*tags: str):
+    if backend is None:
+        return
+    # Called after the write succeeded, so a cache failure isn't the write's error. If the bump
+    # fails, other workers serve the entries they have until their CACHE_TTL_SECONDS run out.
+    try:
+        await generations.bump(tags)
+    except CACHE_ERRORS:
+        pass
+    try:
+        await backend.invalidate(*tags)
+    except CACHE_ERRORS:
+        pass
+
+
+async def invalidate_location(location_id=None):
+    # Conferences, presentations and attendees are embedded in their location, so any write
+    # below a location changes that location's detail and the lists that embed or filter it.
+    tags = ["locations", "conferences"]
+    if location_id is not None:
+        tags.append(f"location:{location_id}")
+    await invalidate(*tags)
+
+
+async def cache_stats(request: Request):
+    return JSONResponse(status_code=200, content=backend.stats() if backend else {"backend": "none"})
@@ -0,0 +1,159 @@
+import zlib
+from typing import Optional
+
+import settings
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, br is only offered when it is installed
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, zstd is only offered when it is installed
+    zstandard = None
+
+# Compresses responses with the client's preferred encoding among settings.COMPRESSION.
+# Bodies under COMPRESSION_MIN_SIZE are sent as they are, unless they are streamed: a streamed
+# body is compressed chunk by chunk, each chunk flushed so the client can decode it on arrival.
+# Responses that already have a Content-Encoding, like cached bodies compressed by
+# common/cache.py, and types that don't compress (application/gzip exports, images) pass through.
+INSTALLED = {"gzip": True, "br": brotli is not None, "zstd": zstandard is not None}
+if unknown := [encoding for encoding in settings.COMPRESSION if encoding not in INSTALLED]:
+    raise ValueError(f"Unknown COMPRESSION encodings: {', '.join(unknown)}")
+ENCODINGS = [encoding for encoding in settings.COMPRESSION if INSTALLED[encoding]]
+
+COMPRESSIBLE_TYPES = {"application/json", "application/x-ndjson", "application/javascript", "application/xml",
+                      "image/svg+xml"}
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    # The encoding with the highest q value in Accept-Encoding, our preference order breaking ties
+    if not accept_encoding or not ENCODINGS:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.partition(";")
+        q = 1.0
+        if (parameters := parameters.strip()).startswith("q="):
+            try:
+                q = float(parameters[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        if (q := accepted.get(encoding, accepted.get("*", 0.0))) > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def weak_etag(etag: str) -> str:
+    # A compressed body isn't byte-for-byte the body the strong ETag was computed from
+    return etag if etag.startswith("W/") else f"W/{etag}"
+
+
+def compressible(media_type: Optional[str]) -> bool:
+    media_type = (media_type or "").split(";")[0].strip().lower()
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES or media_type.endswith("+json")
+
+
+class Encoder:
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self.compressor = zlib.compressobj(settings.COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self.compressor = brotli.Compressor(quality=settings.COMPRESSION_BROTLI_QUALITY)
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=settings.COMPRESSION_ZSTD_LEVEL).compressobj()
+
+    def compress(self, chunk: bytes, final: bool) -> bytes:
+        # A non-final chunk is flushed, so what was sent so far decodes on its own
+        if self.encoding == "gzip":
+            return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return self.compressor.process(chunk) + (self.compressor.finish() if final else self.compressor.flush())
+        flush = zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        return self.compressor.compress(chunk) + self.compressor.flush(flush)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    return Encoder(encoding).compress(body, final=True)
+
+
+def cached_encoding(request_headers: Headers, media_type: str, size: int) -> Optional[str]:
+    # The encoding common/cache.py keeps a compressed copy of a cached body in, if any
+    if not settings.COMPRESSION_CACHED_BODIES or size < settings.COMPRESSION_MIN_SIZE or not compressible(media_type):
+        return None
+    return negotiate(request_headers.get("accept-encoding"))
+
+
+def add_vary(headers: MutableHeaders):
+    vary = [value.strip() for value in headers.get("vary", "").split(",") if value.strip()]
+    if "accept-encoding" not in (value.lower() for value in vary):
+        headers["Vary"] = ", ".join([*vary, "Accept-Encoding"])
+
+
+def not_modified_headers(request_headers: Headers, response: Response, etag: str) -> dict:
+    # The ETag and Vary of a 304 for `response`: those CompressionMiddleware would have given it
+    # as a 200, which it leaves 304s without
+    headers = {"ETag": etag}
+    if "content-encoding" in response.headers:
+        # Already compressed by common/cache.py, with its weak ETag
+        headers["Vary"] = response.headers.get("vary", "Accept-Encoding")
+    elif ENCODINGS and compressible(response.headers.get("content-type")):
+        headers["Vary"] = "Accept-Encoding"
+        if negotiate(request_headers.get("accept-encoding")) and len(response.body) >= settings.COMPRESSION_MIN_SIZE:
+            headers["ETag"] = weak_etag(etag)
+    return headers
+
+
+class CompressionMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] == "HEAD":
+            return await self.app(scope, receive, send)
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"))
+        start = None
+        encoder = None
+
+        async def send_wrapper(message):
+            nonlocal start, encoder
+            if message["type"] == "http.response.start":
+                # Held back until the first body chunk shows whether the body is streamed
+                start = message
+                return
+            if encoder is not None and message["type"] == "http.response.body":
+                # The last chunk finishes the stream, so it goes through the encoder even if empty
+                message = {**message, "body": encoder.compress(message.get("body", b""), not message.get("more_body", False))}
+                return await send(message)
+            if message["type"] != "http.response.body" or start is None:
+                return await send(message)
+
+            headers = MutableHeaders(raw=list(start.get("headers", [])))
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if (200 <= start["status"] < 300 and start["status"] != 204 and "content-encoding" not in headers
+                    and compressible(headers.get("content-type"))):
+                add_vary(headers)
+                if encoding and (more_body or len(body) >= settings.COMPRESSION_MIN_SIZE):
+                    encoder = Encoder(encoding)
+                    body = encoder.compress(body, not more_body)
+                    headers["Content-Encoding"] = encoding
+                    if "etag" in headers:
+                        headers["ETag"] = weak_etag(headers["etag"])
+                    if more_body:
+                        del headers["content-length"]
+                    else:
+                        headers["Content-Length"] = str(len(body))
+                    message = {**message, "body": body}
+            await send({**start, "headers": headers.raw})
+            start = None
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
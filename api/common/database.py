@@ -0,0 +1,67 @@
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import settings
+from common import metrics
+from motor.motor_asyncio import AsyncIOMotorClient
+
+client: Optional[AsyncIOMotorClient] = None
+
+
+def client_options() -> dict:
+    options = {
+        "maxPoolSize": settings.MONGO_MAX_POOL_SIZE,
+        "minPoolSize": settings.MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": settings.MONGO_MAX_IDLE_TIME_MS,
+        "connectTimeoutMS": settings.MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": settings.MONGO_SOCKET_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "waitQueueTimeoutMS": settings.MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "readPreference": settings.MONGO_READ_PREFERENCE,
+    }
+    if settings.MONGO_COMPRESSORS:
+        options["compressors"] = list(settings.MONGO_COMPRESSORS)
+    if settings.METRICS_ENABLED:
+        options["event_listeners"] = [metrics.command_listener]
+    return {key: value for key, value in options.items() if value is not None}
+
+
+def connect() -> AsyncIOMotorClient:
+    global client
+    if client is None:
+        client = AsyncIOMotorClient(settings.MONGO_DB_CONNECTION_STRING, **client_options())
+    return client
+
+
+def close():
+    global client
+    if client is not None:
+        client.close()
+        client = None
+
+
+def get_db():
+    # Falls back to connecting lazily so scripts that never run the app lifespan still work
+    return connect()[settings.MONGO_DB_NAME]
+
+
+class _Database:
+    # Resolves the database on every access, so modules can keep a module level `db`
+    # without creating their own client at import time.
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+    def __getitem__(self, name):
+        return get_db()[name]
+
+
+db = _Database()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    connect()
+    try:
+        yield
+    finally:
+        close()
@@ -0,0 +1,141 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import settings
+from common.database import db
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+
+# Deferred side effects. Jobs are stored in the `jobs` collection before they run, so they
+# survive restarts, and each worker claims them atomically, so several app processes can share
+# the collection. An asyncio queue wakes the local workers right after an enqueue instead of
+# waiting for the next poll.
+JOBS = "jobs"
+
+handlers: Dict[str, Callable[..., Awaitable]] = {}
+
+
+def job(name: str):
+    def decorator(handler):
+        handlers[name] = handler
+        return handler
+    return decorator
+
+
+async def enqueue(name: str, **payload):
+    if name not in handlers:
+        raise ValueError(f"Unknown job: {name}")
+    now = datetime.utcnow()
+    result = await db[JOBS].insert_one({
+        "name": name,
+        "payload": payload,
+        "status": "pending",
+        "attempts": 0,
+        "run_at": now,
+        "created": now,
+    })
+    if runner is not None:
+        runner.wake()
+    return result.inserted_id
+
+
+async def enqueue_many(name: str, payloads: List[dict]):
+    # One insert for a batch of jobs, e.g. from a bulk import
+    if name not in handlers:
+        raise ValueError(f"Unknown job: {name}")
+    if not payloads:
+        return []
+    now = datetime.utcnow()
+    result = await db[JOBS].insert_many([
+        {"name": name, "payload": payload, "status": "pending", "attempts": 0, "run_at": now, "created": now}
+        for payload in payloads
+    ])
+    if runner is not None:
+        runner.wake()
+    return result.inserted_ids
+
+
+class JobRunner:
+    def __init__(self, workers: int, max_attempts: int, backoff: float, poll_interval: float, lease: float):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.tasks: List[asyncio.Task] = []
+
+    def wake(self):
+        self.queue.put_nowait(None)
+
+    async def claim(self) -> Optional[dict]:
+        # Pending jobs that are due, or running ones whose worker died before the lease ran out
+        now = datetime.utcnow()
+        return await db[JOBS].find_one_and_update(
+            {"$or": [
+                {"status": "pending", "run_at": {"$lte": now}},
+                {"status": "running", "locked_until": {"$lt": now}},
+            ]},
+            {"$set": {"status": "running", "locked_until": now + timedelta(seconds=self.lease)},
+             "$inc": {"attempts": 1}},
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def run(self, document: dict):
+        try:
+            await handlers[document["name"]](**document["payload"])
+        except Exception as e:
+            if document["attempts"] >= self.max_attempts:
+                update = {"status": "failed", "error": repr(e)}
+            else:
+                delay = self.backoff * 2 ** (document["attempts"] - 1)
+                update = {"status": "pending", "error": repr(e),
+                          "run_at": datetime.utcnow() + timedelta(seconds=delay)}
+            await db[JOBS].update_one({"_id": document["_id"]}, {"$set": update, "$unset": {"locked_until": ""}})
+            if update["status"] == "pending":
+                asyncio.get_running_loop().call_later(delay, self.wake)
+        else:
+            await db[JOBS].delete_one({"_id": document["_id"]})
+
+    async def work(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.queue.get(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                while (document := await self.claim()) is not None:
+                    await self.run(document)
+            except PyMongoError:
+                # Mongo is unreachable, the next poll tries again
+                continue
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+        self.wake()
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+
+runner: Optional[JobRunner] = None
+
+
+def start():
+    global runner
+    if settings.JOBS_WORKERS > 0:
+        runner = JobRunner(settings.JOBS_WORKERS, settings.JOBS_MAX_ATTEMPTS, settings.JOBS_BACKOFF_SECONDS,
+                           settings.JOBS_POLL_SECONDS, settings.JOBS_LEASE_SECONDS)
+        runner.start()
+
+
+async def stop():
+    global runner
+    if runner is not None:
+        await runner.stop()
+        runner = None
@@ -1,19 +1,50 @@
 import json
 import typing
+from datetime import date, datetime
+from enum import Enum
 
+from bson import ObjectId
+from pydantic import BaseModel
 from starlette.responses import JSONResponse
 
+try:
+    import orjson
+except ImportError:  # orjson is optional, fall back to the stdlib encoder
+    orjson = None
+
+
+def encode_default(obj):
+    # Called only for values the JSON library can't encode itself. Models are handed back
+    # as a shallow dict so nested models are encoded in the same pass, instead of going
+    # through obj.json() -> json.loads() -> json.dumps().
+    if isinstance(obj, BaseModel):
+        return dict(obj)
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    if isinstance(obj, Enum):
+        return obj.value
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
 
 class CustomEncoder(json.JSONEncoder):
     def default(self, obj):
-        return json.loads(obj.json())
+        return encode_default(obj)
+
 
+def dumps(content: typing.Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=encode_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, cls=CustomEncoder, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 
 class PydanticJSONResponse(JSONResponse):
-    def __init__(self, status_code, content, encoder=CustomEncoder):
+    def __init__(self, status_code, content, encoder=CustomEncoder, background=None):
         self.encoder = encoder
-        super().__init__(status_code=status_code, content=content)
+        super().__init__(status_code=status_code, content=content, background=background)
 
     def render(self, content: typing.Any) -> bytes:
-        return json.dumps(content, cls=CustomEncoder).encode("utf-8")
+        if self.encoder is not CustomEncoder:
+            return json.dumps(content, cls=self.encoder).encode("utf-8")
+        return dumps(content)
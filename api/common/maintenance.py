@@ -0,0 +1,21 @@
+import settings
+from starlette.responses import JSONResponse
+
+# Methods that don't write, which WritesPausedMiddleware lets through
+READ_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+class WritesPausedMiddleware:
+    # With WRITES_PAUSED set, the API answers every write with a 503 while reads go on, e.g. for the
+    # final sync of a STORAGE_LAYOUT cutover (see migrate_normalized.py). /signup/ and /login/ stay
+    # open: users aren't stored differently by the two layouts.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] == "http" and settings.WRITES_PAUSED and scope["method"] not in READ_METHODS
+                and scope["path"].startswith("/api/")):
+            response = JSONResponse({"detail": "Writes are paused for maintenance, try again shortly"},
+                                    status_code=503, headers={"Retry-After": str(settings.WRITES_PAUSED_RETRY_SECONDS)})
+            return await response(scope, receive, send)
+        await self.app(scope, receive, send)
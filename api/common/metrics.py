@@ -0,0 +1,169 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Optional
+
+from pymongo import monitoring
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class MongoTiming:
+    # Mongo round trips of one request. Motor runs pymongo in a thread pool with a copy of the
+    # request's context, so the command listener finds this through `current_request`.
+    __slots__ = ("commands", "seconds")
+
+    def __init__(self):
+        self.commands = 0
+        self.seconds = 0.0
+
+
+current_request: ContextVar[Optional[MongoTiming]] = ContextVar("current_request", default=None)
+
+# Per-process metrics; every worker serves its own /metrics
+lock = threading.Lock()
+in_flight = 0
+requests = defaultdict(int)  # (method, route, status) -> count
+latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # (method, route) -> seconds
+response_size = defaultdict(lambda: Histogram(SIZE_BUCKETS))  # (method, route) -> bytes
+request_mongo_commands = defaultdict(lambda: Histogram(ROUND_TRIP_BUCKETS))  # (method, route) -> round trips
+request_mongo_seconds = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # (method, route) -> seconds in Mongo
+mongo_commands = defaultdict(int)  # (command, outcome) -> count
+mongo_seconds = defaultdict(float)  # command -> seconds
+
+
+class CommandListener(monitoring.CommandListener):
+    # Registered on the client in common/database.py
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event.command_name, event.duration_micros, "ok")
+
+    def failed(self, event):
+        self.record(event.command_name, event.duration_micros, "error")
+
+    def record(self, command: str, duration_micros: int, outcome: str):
+        seconds = duration_micros / 1_000_000
+        with lock:
+            mongo_commands[command, outcome] += 1
+            mongo_seconds[command] += seconds
+            if (timing := current_request.get()) is not None:
+                timing.commands += 1
+                timing.seconds += seconds
+
+
+command_listener = CommandListener()
+
+
+def route_name(scope) -> str:
+    # The route's path template rather than the path, so ids don't explode the label values
+    endpoint = scope.get("endpoint")
+    if endpoint is None or "app" not in scope:
+        return "unmatched"
+    for route in scope["app"].routes:
+        if getattr(route, "endpoint", None) is endpoint and route.path_regex.match(scope["path"]):
+            return route.path
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global in_flight
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        response = {"status": 500, "size": 0}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+            elif message["type"] == "http.response.body":
+                response["size"] += len(message.get("body", b""))
+            await send(message)
+
+        timing = MongoTiming()
+        token = current_request.set(timing)
+        in_flight += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            in_flight -= 1
+            current_request.reset(token)
+            key = (scope["method"], route_name(scope))
+            with lock:
+                requests[(*key, response["status"])] += 1
+                latency[key].observe(elapsed)
+                response_size[key].observe(response["size"])
+                request_mongo_commands[key].observe(timing.commands)
+                request_mongo_seconds[key].observe(timing.seconds)
+
+
+def label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render() -> str:
+    lines = [
+        "# TYPE http_requests_in_flight gauge",
+        f"http_requests_in_flight {in_flight}",
+        "# TYPE http_requests_total counter",
+    ]
+    with lock:
+        for (method, route, status), count in sorted(requests.items()):
+            lines.append(f'http_requests_total{{method="{method}",route="{label(route)}",status="{status}"}} {count}')
+        for name, histograms in (
+            ("http_request_duration_seconds", latency),
+            ("http_response_size_bytes", response_size),
+            ("http_request_mongo_commands", request_mongo_commands),
+            ("http_request_mongo_duration_seconds", request_mongo_seconds),
+        ):
+            lines.append(f"# TYPE {name} histogram")
+            for (method, route), histogram in sorted(histograms.items()):
+                lines.extend(histogram.lines(name, f'method="{method}",route="{label(route)}"'))
+        lines.append("# TYPE mongo_commands_total counter")
+        for (command, outcome), count in sorted(mongo_commands.items()):
+            lines.append(f'mongo_commands_total{{command="{command}",outcome="{outcome}"}} {count}')
+        lines.append("# TYPE mongo_command_duration_seconds_total counter")
+        for command, seconds in sorted(mongo_seconds.items()):
+            lines.append(f'mongo_command_duration_seconds_total{{command="{command}"}} {seconds}')
+    return "\n".join(lines) + "\n"
+
+
+async def metrics(request: Request):
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
@@ -1,7 +1,97 @@
 from datetime import datetime
+from typing import Any, Iterable, Optional, Type, TypeVar
 
 from bson import ObjectId
 from pydantic import BaseModel, Field, root_validator, validator
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField
+
+Model = TypeVar("Model", bound="BaseMongoModel")
+
+
+def construct_trusted(field: ModelField, value: Any):
+    # Builds the nested models of a field without validating them
+    model = field.type_
+    if value is None or not (isinstance(model, type) and issubclass(model, BaseModel)):
+        return value
+
+    def build(document):
+        if not isinstance(document, dict):
+            return document
+        return model.from_mongo(document) if issubclass(model, BaseMongoModel) else model.construct(**document)
+
+    if field.shape == SHAPE_LIST:
+        return [build(item) for item in value]
+    return build(value) if field.shape == SHAPE_SINGLETON else value
+
+
+class Fields:
+    # A sparse fieldset, e.g. `?fields=name,conferences.name`, checked against a model. It becomes
+    # the Mongo projection of the read, and the documents read with it are serialized with only
+    # those fields, without building models for them. The id is always included.
+    def __init__(self, model: Type[BaseModel], paths: Iterable[str] = ()):
+        self.model = model
+        self.tree = {}  # field name -> None for the whole field, or the tree of its nested model
+        for path in paths:
+            self.add(self.tree, model, path.split("."), path)
+
+    @staticmethod
+    def add(tree: dict, model, parts: list, path: str):
+        field = model.__fields__.get(parts[0]) if isinstance(model, type) and issubclass(model, BaseModel) else None
+        if field is None:
+            raise ValueError(f"Unknown field: {path}")
+        if len(parts) == 1 or (parts[0] in tree and tree[parts[0]] is None):
+            tree[parts[0]] = None
+        else:
+            Fields.add(tree.setdefault(parts[0], {}), field.type_, parts[1:], path)
+
+    def includes(self, name: str) -> bool:
+        return name in self.tree
+
+    def nested(self, name: str) -> Optional["Fields"]:
+        # The fieldset of a nested model field, None when the field is requested whole
+        if self.tree.get(name) is None:
+            return None
+        fields = Fields(self.model.__fields__[name].type_)
+        fields.tree = self.tree[name]
+        return fields
+
+    def projection(self, *extra: str) -> dict:
+        projection = {"_id": 1, **{path: 1 for path in extra}}
+
+        def walk(model, tree: dict, prefix: str):
+            for name, subtree in tree.items():
+                field = model.__fields__[name]
+                if subtree is None:
+                    projection[prefix + field.alias] = 1
+                else:
+                    walk(field.type_, subtree, f"{prefix}{field.alias}.")
+
+        walk(self.model, self.tree, "")
+        return projection
+
+    def serialize(self, document: dict) -> dict:
+        return {"id": document.get("_id"), **self.partial(self.model, self.tree, document)}
+
+    @classmethod
+    def partial(cls, model, tree: dict, document: dict) -> dict:
+        values = {}
+        for name, subtree in tree.items():
+            field = model.__fields__[name]
+            if field.alias in document:
+                value = document[field.alias]
+            elif name in document:
+                value = document[name]
+            else:
+                continue
+            if subtree is None:
+                values[name] = construct_trusted(field, value)
+            elif value is None:
+                values[name] = None
+            elif field.shape == SHAPE_LIST:
+                values[name] = [cls.partial(field.type_, subtree, item) for item in value]
+            else:
+                values[name] = cls.partial(field.type_, subtree, value)
+        return values
 
 
 class BaseMongoModel(BaseModel):
@@ -22,6 +112,20 @@ class BaseMongoModel(BaseModel):
             return [ObjectId(val) if isinstance(val, str) else val for val in value]
         return value
 
+    @classmethod
+    def from_mongo(cls: Type[Model], document: dict) -> Model:
+        # Trusted read path for documents that come straight from our own collections. They
+        # were validated when they were written, so this skips the validators (and the
+        # `updated` rewrite) and only builds the nested models. Inbound data from requests
+        # must still go through the regular constructor.
+        values = {}
+        for name, field in cls.__fields__.items():
+            if field.alias in document:
+                values[name] = construct_trusted(field, document[field.alias])
+            elif name in document:
+                values[name] = construct_trusted(field, document[name])
+        return cls.construct(**values)
+
     class Config:
         validate_assignment = True
         arbitrary_types_allowed = True
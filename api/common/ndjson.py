@@ -0,0 +1,37 @@
+import zlib
+
+from common.json import dumps
+from pymongo.errors import PyMongoError
+
+CHUNK_SIZE = 64 * 1024
+
+
+async def ndjson_chunks(rows, compress: bool = False, chunk_size: int = CHUNK_SIZE):
+    # Encodes rows as NDJSON and yields it in chunks of about chunk_size, gzipped if asked to,
+    # holding no more than one chunk at a time.
+    #
+    # The status line has gone out with the first chunk, so a Mongo error while reading the rows
+    # can't become an error response. The stream then ends with an {"error": ...} line, gzip
+    # finished so it still decodes, and the error is raised again: the server logs it and drops
+    # the connection without ending the chunked body, which clients report as an incomplete read.
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    buffer = bytearray()
+    count = 0
+    try:
+        async for row in rows:
+            buffer += dumps(row)
+            buffer += b"\n"
+            count += 1
+            if len(buffer) >= chunk_size:
+                chunk = compressor.compress(buffer) if compressor else bytes(buffer)
+                buffer.clear()
+                if chunk:
+                    yield chunk
+    except PyMongoError as e:
+        buffer += dumps({"error": f"Export failed after {count} rows: {e}", "rows": count})
+        buffer += b"\n"
+        yield compressor.compress(buffer) + compressor.flush() if compressor else bytes(buffer)
+        raise
+    tail = compressor.compress(buffer) + compressor.flush() if compressor else bytes(buffer)
+    if tail:
+        yield tail
@@ -0,0 +1,61 @@
+from datetime import datetime
+from typing import Any, Callable, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def limit_param(request: Request) -> int:
+    try:
+        limit = int(request.query_params.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid limit")
+    if not 0 < limit <= MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+def page_params(request: Request) -> Tuple[Optional[ObjectId], Optional[int]]:
+    # Keyset pagination: `after` is the last _id of the previous page, results are sorted by _id.
+    # Only requests that page get pages: without `limit` or `after` the whole list is returned, as
+    # it was before pagination, for the clients that don't follow `next`.
+    after = request.query_params.get("after")
+    if after is None and "limit" not in request.query_params:
+        return None, None
+    limit = limit_param(request)
+    try:
+        return (ObjectId(after) if after else None), limit
+    except InvalidId as e:
+        raise HTTPException(status_code=400, detail=f"Invalid ID: {str(e)}")
+
+
+def next_after(items: List[Any], limit: Optional[int]) -> Optional[str]:
+    if limit is None or len(items) < limit:
+        return None
+    last = items[-1]
+    if isinstance(last, dict):
+        return str(last.get("id", last.get("_id")))
+    return str(getattr(last, "id", last))
+
+
+def keyset_after(request: Request, parse: Callable[[str], Any]) -> Optional[Tuple[Any, ObjectId]]:
+    # For results sorted by (key, _id) rather than _id: `after` is "<key>_<id>" of the last result
+    if not (after := request.query_params.get("after")):
+        return None
+    key, _, id = after.rpartition("_")
+    try:
+        return parse(key), ObjectId(id)
+    except (ValueError, InvalidId):
+        raise HTTPException(status_code=400, detail=f"Invalid after: {after}")
+
+
+def keyset_next(items: List[dict], limit: int, key: str) -> Optional[str]:
+    if len(items) < limit:
+        return None
+    value = items[-1][key]
+    return f"{value.isoformat() if isinstance(value, datetime) else repr(value)}_{items[-1]['id']}"
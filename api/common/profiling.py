@@ -0,0 +1,123 @@
+import cProfile
+import marshal
+import os
+import re
+import time
+
+import settings
+from common.constants import Role
+from common.metrics import route_name
+from starlette.datastructures import Headers, QueryParams
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # pyinstrument is optional, fall back to cProfile
+    Profiler = None
+
+# Profiles one request, asked for with `?profile=<mode>` or an `X-Profile: <mode>` header:
+#   download  the response is replaced by the profile, as an attachment
+#   disk      the profile is written to PROFILE_DIR, named after the route (any other value too)
+# PROFILING=admin honours that for admins only, PROFILING=all profiles every request to disk.
+#
+# pyinstrument, when installed, samples the request's own task across awaits. cProfile is
+# deterministic but sees everything on the event loop thread while the request runs, so only
+# one request is profiled at a time. Neither follows pymongo into Motor's executor threads; the
+# Mongo time of the request is on /metrics (common/metrics.py).
+
+
+class RequestProfiler:
+    active = False
+
+    def __init__(self):
+        self.profiler = Profiler(async_mode="enabled") if Profiler else cProfile.Profile()
+        self.extension = "html" if Profiler else "prof"
+
+    def start(self):
+        if Profiler:
+            self.profiler.start()
+        else:
+            RequestProfiler.active = True
+            self.profiler.enable()
+
+    def stop(self) -> bytes:
+        if Profiler:
+            self.profiler.stop()
+            return self.profiler.output_html().encode("utf-8")
+        self.profiler.disable()
+        RequestProfiler.active = False
+        self.profiler.create_stats()
+        # The format of Profile.dump_stats, readable with pstats or snakeviz
+        return marshal.dumps(self.profiler.stats)
+
+
+def requested_mode(scope):
+    if settings.PROFILING == "all":
+        return "disk"
+    if settings.PROFILING != "admin":
+        return None
+    mode = QueryParams(scope["query_string"]).get("profile") or Headers(scope=scope).get("x-profile")
+    if mode and (auth := scope.get("auth")) is not None and Role.ADMIN.value in auth.scopes:
+        return mode
+    return None
+
+
+def file_name(scope, extension: str) -> str:
+    route = re.sub(r"[^A-Za-z0-9]+", "_", route_name(scope)).strip("_") or "root"
+    return f"{scope['method']}_{route}_{time.strftime('%Y%m%d-%H%M%S')}_{time.perf_counter_ns() % 1_000_000}.{extension}"
+
+
+class ProfilingMiddleware:
+    # Goes after AuthenticationMiddleware, it needs scope["auth"] to check the role
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (mode := requested_mode(scope)) is None:
+            return await self.app(scope, receive, send)
+        if not Profiler and RequestProfiler.active:
+            return await self.app(scope, receive, send)
+
+        profiler = RequestProfiler()
+        if mode == "download":
+            await self.download(profiler, scope, receive, send)
+        else:
+            await self.to_disk(profiler, scope, receive, send)
+
+    async def download(self, profiler, scope, receive, send):
+        status = {"status": 500}
+
+        async def discard(message):
+            if message["type"] == "http.response.start":
+                status["status"] = message["status"]
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profile = profiler.stop()
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/html; charset=utf-8" if profiler.extension == "html" else b"application/octet-stream"),
+            (b"content-disposition", f'attachment; filename="{file_name(scope, profiler.extension)}"'.encode()),
+            (b"content-length", str(len(profile)).encode()),
+            (b"x-profiled-status", str(status["status"]).encode()),
+        ]})
+        await send({"type": "http.response.body", "body": profile})
+
+    async def to_disk(self, profiler, scope, receive, send):
+        path = {}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # Routing has happened by now, so the file can be named after the route
+                path["path"] = os.path.join(settings.PROFILE_DIR, file_name(scope, profiler.extension))
+                message = {**message, "headers": [*message.get("headers", []), (b"x-profile-file", path["path"].encode())]}
+            await send(message)
+
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profile = profiler.stop()
+            os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+            with open(path.get("path") or os.path.join(settings.PROFILE_DIR, file_name(scope, profiler.extension)), "wb") as f:
+                f.write(profile)
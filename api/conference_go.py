@@ -1,15 +1,27 @@
+from contextlib import asynccontextmanager
 from os import environ
 
+import settings
 from auth_middleware import JWTAuthenticationBackend
-from routes.endpoints import (create_attendee, create_conference,
-                              create_location, create_presentation,
-                              delete_attendee, delete_conference,
-                              delete_location, delete_presentation,
+from common import database, jobs
+from common.cache import cache_stats
+from common.compression import ENCODINGS, CompressionMiddleware
+from common.maintenance import WritesPausedMiddleware
+from common.metrics import MetricsMiddleware, metrics
+from common.profiling import ProfilingMiddleware
+from indexes import ensure_indexes
+from routes.endpoints import (conference_calendar, create_attendee,
+                              create_conference, create_location,
+                              create_presentation, delete_attendee,
+                              delete_conference, delete_location,
+                              delete_presentation, export_data, import_data,
                               list_attendees, list_conferences, list_locations,
-                              list_presentations, list_states, show_attendee,
-                              show_conference, show_location,
+                              list_presentations, list_states, search,
+                              show_attendee, show_conference,
+                              show_conference_stats, show_location,
                               show_presentation, update_conference,
                               update_location, update_presentation)
+from routes import third_party
 from routes.user_endpoints import login, sign_up
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
@@ -18,10 +30,28 @@ from starlette.middleware.cors import CORSMiddleware
 from starlette.middleware.trustedhost import TrustedHostMiddleware
 from starlette.routing import Route
 
+@asynccontextmanager
+async def lifespan(app):
+    async with database.lifespan(app):
+        if settings.MONGO_ENSURE_INDEXES:
+            await ensure_indexes()
+        jobs.start()
+        try:
+            yield
+        finally:
+            await jobs.stop()
+            await third_party.close_client()
+
+
 middleware = [
-    Middleware(CORSMiddleware, allow_origins=["http://localhost:3001"], allow_methods=['*']),
+    *([Middleware(MetricsMiddleware)] if settings.METRICS_ENABLED else []),
+    # Inside the metrics, so the response sizes they record are the compressed ones
+    *([Middleware(CompressionMiddleware)] if ENCODINGS else []),
+    Middleware(CORSMiddleware, allow_origins=["http://localhost:3001"], allow_methods=['*'], expose_headers=["ETag"]),
     Middleware(TrustedHostMiddleware, allowed_hosts=["localhost"]),
-    Middleware(AuthenticationMiddleware, backend=JWTAuthenticationBackend(secret_key=environ.get("SESSION_SECRET_KEY")))
+    Middleware(WritesPausedMiddleware),
+    Middleware(AuthenticationMiddleware, backend=JWTAuthenticationBackend(secret_key=environ.get("SESSION_SECRET_KEY"))),
+    *([Middleware(ProfilingMiddleware)] if settings.PROFILING != "off" else []),
 ]
 
 routes = [
@@ -37,6 +67,8 @@ routes = [
 
     # Conferences
     Route("/api/conferences/", list_conferences, methods=["GET"]),
+    Route("/api/conferences/calendar", conference_calendar, methods=["GET"]),
+    Route("/api/conferences/{conference_id}/stats", show_conference_stats, methods=["GET"]),
     Route("/api/locations/{location_id}/conferences/", list_conferences, methods=["GET"]),
     Route("/api/locations/{location_id}/conferences/", create_conference, methods=["POST"]),
     Route("/api/locations/{location_id}/conferences/{conference_id}", show_conference, methods=["GET"]),
@@ -58,9 +90,24 @@ routes = [
     Route("/api/locations/{location_id}/conferences/{conference_id}/attendees/{attendee_id}", show_attendee, methods=["GET"]),
     Route("/api/locations/{location_id}/conferences/{conference_id}/attendees/{attendee_id}", delete_attendee, methods=["DELETE"]),
 
+    # Exports
+    Route("/api/export/{kind}", export_data, methods=["GET"]),
+
+    # Imports
+    Route("/api/import/{kind}", import_data, methods=["POST"]),
+
+    # Search
+    Route("/api/search", search, methods=["GET"]),
+
+    # Cache
+    Route("/api/cache/stats/", cache_stats, methods=["GET"]),
+
+    # Metrics
+    *([Route("/metrics", metrics, methods=["GET"])] if settings.METRICS_ENABLED else []),
+
     # User endpoints
     Route("/signup/", sign_up, methods=["POST"]),
     Route("/login/", login, methods=["POST"]),
 ]
 
-app = Starlette(debug=True, routes=routes, middleware=middleware)
+app = Starlette(debug=True, routes=routes, middleware=middleware, lifespan=lifespan)
@@ -1,29 +1,30 @@
-import os
+import functools
+from collections import defaultdict
+from datetime import datetime, timedelta
 from typing import List
 
+import settings
 from bson import ObjectId
 from bson.errors import InvalidId
-from common.constants import Role
+from common.cache import invalidate_location
+from common.constants import US_STATES, Role, Status
+from common.database import db
+from common.jobs import enqueue, enqueue_many, job
+from common.model import Fields
 from pydantic import ValidationError
-from pymongo import MongoClient, ReturnDocument
-from pymongo.errors import PyMongoError
-from routes.models import Conference, Location, Presentation, User
+from pymongo import DeleteMany, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+from routes.models import Conference, ConferenceStats, Location, Presentation, User
 from starlette.exceptions import HTTPException
 
-MONGO_DB_CONNECTION_STRING = os.environ["MONGO_DB_CONNECTION_STRING"]
-MONGO_DB_NAME = os.environ["MONGO_DB_NAME"]
-
-url = MONGO_DB_CONNECTION_STRING
-db_name = MONGO_DB_NAME
-
-client = MongoClient(url)
-db = client[db_name]
 
 def handle_exceptions(e, id=None, model_name=""):
     if isinstance(e, InvalidId):
         raise HTTPException(status_code=400, detail=f"Invalid ID: {str(e)}")
     elif isinstance(e, ValidationError):
         raise HTTPException(status_code=400, detail=f"Invalid {model_name}: {str(e)}")
+    elif isinstance(e, DuplicateKeyError):
+        raise HTTPException(status_code=400, detail=f"{model_name.capitalize() or 'Document'} already exists")
     elif isinstance(e, PyMongoError):
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
     else:
@@ -31,27 +32,225 @@ def handle_exceptions(e, id=None, model_name=""):
 
 
 async def location_create(location: Location):
-    if (count := db.locations.count_documents({"name": location.name})) > 0:
+    # The unique index on name (see indexes.py) rejects the duplicates this check races with. The
+    # check still matters where that index couldn't be built over existing duplicates.
+    if await db.locations.count_documents({"name": location.name}, limit=1):
         raise HTTPException(status_code=400, detail="Location already exists")
     try:
-        response = db.locations.insert_one(location.dict(by_alias=True))
-        location = db["locations"].find_one({"_id": response.inserted_id})
-        return Location(**location)
+        response = await db.locations.insert_one(location.dict(by_alias=True))
+        await invalidate_location()
+        location = await db["locations"].find_one({"_id": response.inserted_id})
+        return Location.from_mongo(location)
     except (ValidationError, PyMongoError) as e:
-        handle_exceptions(location.name, e)
+        handle_exceptions(e, model_name="location")
+
+# Bulk writes for bulk_import.py. They take a batch of validated models and return
+# {index in the batch: error} for the ones that weren't written; the rest of the batch is.
+def write_errors(e: BulkWriteError, model_name: str, indexes: list = None):
+    errors = {}
+    for error in e.details["writeErrors"]:
+        message = f"{model_name.capitalize()} already exists" if error["code"] == 11000 else error["errmsg"]
+        for index in indexes[error["index"]] if indexes else [error["index"]]:
+            errors[index] = message
+    return errors
+
+
+async def insert_unordered(collection: str, documents: list, model_name: str):
+    if not documents:
+        return {}
+    try:
+        await db[collection].insert_many(documents, ordered=False)
+        return {}
+    except BulkWriteError as e:
+        return write_errors(e, model_name)
+
+
+async def duplicate_rows(collection: str, field: str, values: list, model_name: str):
+    # {index: error} for the values already in the collection or earlier in the batch. Like the
+    # check in location_create, for when the unique index on `field` couldn't be built.
+    existing = set(await db[collection].distinct(field, {field: {"$in": list(set(values))}}))
+    errors, seen = {}, set()
+    for index, value in enumerate(values):
+        if value in existing or value in seen:
+            errors[index] = f"{model_name.capitalize()} already exists"
+        seen.add(value)
+    return errors
+
+
+async def insert_unique(collection: str, documents: list, field: str, model_name: str):
+    errors = await duplicate_rows(collection, field, [document[field] for document in documents], model_name)
+    indexes = [index for index in range(len(documents)) if index not in errors]
+    failed = await insert_unordered(collection, [documents[index] for index in indexes], model_name)
+    errors.update({indexes[index]: error for index, error in failed.items()})
+    return errors
+
+
+async def location_bulk_create(locations: List[Location]):
+    # Duplicate names are rejected row by row, the others are still inserted
+    errors = await insert_unique("locations", [location.dict(by_alias=True) for location in locations], "name", "location")
+    await invalidate_location()
+    return errors
+
+
+async def location_ids_by_name(names: list):
+    return {location["name"]: location["_id"] async for location in db.locations.find({"name": {"$in": list(names)}}, {"name": 1})}
+
+
+async def conference_locations(conferences: List[Conference]):
+    # Groups a batch by location, with an error for the conferences whose location doesn't exist
+    location_ids = list({conference.location_id for conference in conferences})
+    existing = set(await db.locations.distinct("_id", {"_id": {"$in": location_ids}}))
+    errors, by_location = {}, defaultdict(list)
+    for index, conference in enumerate(conferences):
+        if conference.location_id in existing:
+            by_location[conference.location_id].append(index)
+        else:
+            errors[index] = "Location does not exist"
+    return errors, by_location
+
+
+async def conference_bulk_create(conferences: List[Conference]):
+    errors, by_location = await conference_locations(conferences)
+    # One $push per location, however many of its conferences are in the batch
+    groups = list(by_location.values())
+    operations = [
+        UpdateOne({"_id": location_id}, {"$push": {"conferences": {"$each": [counted_conference(conferences[i]) for i in indexes]}}})
+        for location_id, indexes in by_location.items()
+    ]
+    if operations:
+        try:
+            await db.locations.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            errors.update(write_errors(e, "conference", groups))
+    for location_id in by_location:
+        await invalidate_location(location_id)
+    await search_changed(*by_location)
+    return errors
+
+
+def location_filter(state: str = None, city: str = None):
+    # Filters on the location document itself, shared by every list query so they run in Mongo
+    query = {}
+    if state:
+        query["state.abbreviation"] = US_STATES.get(state.title(), state.upper())
+    if city:
+        query["city"] = city
+    return query
+
+
+def conference_filter(starts_after: datetime = None, starts_before: datetime = None):
+    query = {}
+    if starts_after:
+        query.setdefault("starts", {})["$gte"] = starts_after
+    if starts_before:
+        query.setdefault("starts", {})["$lte"] = starts_before
+    return query
+
+
+def page_stages(after: ObjectId = None, limit: int = None):
+    stages = []
+    if after:
+        stages.append({"$match": {"_id": {"$gt": after}}})
+    stages.append({"$sort": {"_id": 1}})
+    if limit:
+        stages.append({"$limit": limit})
+    return stages
+
+
+def conference_stages(location_query: dict, conference_query: dict = None, fields: tuple = None):
+    # One document per conference. Projecting the location down to the fields the next stages
+    # need keeps Mongo from carrying every sibling subtree through the $unwind.
+    return [
+        {"$match": location_query},
+        {"$project": {f"conferences.{field}": 1 for field in fields} if fields else {"conferences": 1}},
+        {"$unwind": "$conferences"},
+        {"$match": conference_query or {}},
+    ]
+
+
+def location_query(location_id: str = None, conference_id: str = None, **filters):
+    query = location_filter(**filters)
+    if location_id:
+        query["_id"] = ObjectId(location_id)
+    if conference_id:
+        query["conferences._id"] = ObjectId(conference_id)
+    return query
+
+
+# Conferences keep attendee_count / presentation_count next to their arrays, maintained by the
+# same write that changes the array. The writes that $inc a counter only match conferences that
+# have it: a conference stored before the counters existed gets them from its arrays first, in
+# init_counters, so its counters start from the right number. Until its first such write, reads
+# fall back to the array sizes; `python -m backfill_counters` sets them all at once.
+COUNTERS = {"attendee_count": "attendees", "presentation_count": "presentations"}
+STATS_PROJECTION = {
+    **{field: 1 for field in ("_id", "location_id", "name", "starts", "ends", "max_attendees", "max_presentations")},
+    **{counter: {"$ifNull": [f"${counter}", {"$size": {"$ifNull": [f"${array}", []]}}]} for counter, array in COUNTERS.items()},
+}
+
+
+def counted_conference(conference: Conference):
+    # A conference as embedded in its location, with its counters
+    document = conference.dict(by_alias=True)
+    document.update({counter: len(document[array]) for counter, array in COUNTERS.items()})
+    return document
+
+
+async def init_counters(location_id: str, conference_id: str):
+    # Sets the counters a conference is missing from the sizes of its arrays, only while they are
+    # still the sizes that were read. Returns whether any were missing, i.e. a write that failed to
+    # match because of them can be retried.
+    location = await db.locations.find_one(
+        {"_id": ObjectId(location_id)}, {"conferences": {"$elemMatch": {"_id": ObjectId(conference_id)}}},
+    )
+    if not location or not location.get("conferences"):
+        return False
+    conference = location["conferences"][0]
+    missing = [counter for counter in COUNTERS if counter not in conference]
+    for counter in missing:
+        array = COUNTERS[counter]
+        size = len(conference.get(array) or [])
+        await db.locations.update_one(
+            {"_id": ObjectId(location_id), "conferences": {"$elemMatch": {
+                "_id": ObjectId(conference_id),
+                counter: {"$exists": False},
+                array: {"$size": size} if array in conference else {"$exists": False},
+            }}},
+            {"$set": {f"conferences.$.{counter}": size}},
+        )
+    return bool(missing)
 
-async def location_all():
+
+async def aggregate(pipeline: list, model=None, **options):
+    # Streams results batch by batch from the cursor instead of loading them all first
+    async for document in db.locations.aggregate(pipeline, **options):
+        yield model.from_mongo(document) if model else document
+
+
+def read(documents, fields: Fields = None, model=None):
+    # Models, or with a sparse fieldset only the requested fields (see common/model.py)
+    return [fields.serialize(document) if fields else model.from_mongo(document) for document in documents]
+
+
+async def location_all(after: ObjectId = None, limit: int = None, state: str = None, city: str = None,
+                       fields: Fields = None):
+    query = location_filter(state, city)
+    if after:
+        query["_id"] = {"$gt": after}
     try:
-        db_locations = db.locations.find()
-        return [Location(**location) for location in db_locations]
+        cursor = db.locations.find(query, fields.projection() if fields else None).sort("_id", 1)
+        if limit:
+            cursor = cursor.limit(limit)
+        return read([location async for location in cursor], fields, Location)
     except (ValidationError, PyMongoError) as e:
         handle_exceptions(e)
 
-async def location_details(location_id: str):
+async def location_details(location_id: str, fields: Fields = None):
     try:
-        if (location := db.locations.find_one({"_id": ObjectId(location_id)})) is None:
+        projection = fields.projection() if fields else None
+        if (location := await db.locations.find_one({"_id": ObjectId(location_id)}, projection)) is None:
             raise HTTPException(status_code=400, detail="Location does not exist")
-        return Location(**location)
+        return read([location], fields, Location)[0]
     except (ValidationError, PyMongoError, InvalidId) as e:
         handle_exceptions(e, location_id)
 
@@ -59,11 +258,13 @@ async def location_update(update_fields: dict, id: str):
     try:
         # The $set operator within the update document specifies the properties you want to update for
         # the matched location.
-        result = db.locations.update_one(
+        result = await db.locations.update_one(
             {"_id": ObjectId(id)},
             {"$set": update_fields}
         )
         if result.modified_count > 0:
+            await invalidate_location(id)
+            await search_changed(id)
             return await location_details(id)
         elif result.matched_count < 0:
             raise HTTPException(status_code=400, detail="Location does not exist")
@@ -72,34 +273,171 @@ async def location_update(update_fields: dict, id: str):
     except (PyMongoError, InvalidId) as e:
         handle_exceptions(e, id)
 
+async def location_set_photo(location_id, picture_url: str):
+    # Only fills an empty picture, so a slow background lookup never overwrites a newer one
+    try:
+        result = await db.locations.update_one(
+            {"_id": ObjectId(location_id), "picture_url": None}, {"$set": {"picture_url": picture_url}}
+        )
+        if result.modified_count > 0:
+            await invalidate_location(location_id)
+        return result.modified_count
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, location_id)
+
 async def location_delete(location_id: str):
     try:
-        return db.locations.delete_one({"_id": ObjectId(location_id)}).deleted_count
+        deleted_count = (await db.locations.delete_one({"_id": ObjectId(location_id)})).deleted_count
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        return deleted_count
     except (PyMongoError, InvalidId) as e:
         handle_exceptions(e, location_id)
 
-async def conference_all():
-    conferences: List[Conference] = []
-    locations = await location_all()
+async def conference_all(after: ObjectId = None, limit: int = None, state: str = None, city: str = None,
+                         starts_after: datetime = None, starts_before: datetime = None, location_id: str = None,
+                         stats: bool = False, fields: Fields = None):
+    try:
+        pipeline = [
+            *conference_stages(location_query(location_id, state=state, city=city),
+                               fields=tuple(fields.projection("starts")) if fields else None),
+            {"$replaceRoot": {"newRoot": "$conferences"}},
+            {"$match": conference_filter(starts_after, starts_before)},
+            *page_stages(after, limit),
+        ]
+        if stats:
+            pipeline.append({"$project": STATS_PROJECTION})
+        model = ConferenceStats if stats else Conference
+        return read([conference async for conference in aggregate(pipeline)], fields, model)
+    except (ValidationError, PyMongoError, InvalidId) as e:
+        handle_exceptions(e, model_name="conference")
 
-    for location in locations:
-        conferences.extend(location.conferences)
-    return conferences
+async def conference_stats(conference_id: str):
+    try:
+        pipeline = [
+            *conference_stages({"conferences._id": ObjectId(conference_id)}, {"conferences._id": ObjectId(conference_id)}),
+            {"$replaceRoot": {"newRoot": "$conferences"}},
+            {"$project": STATS_PROJECTION},
+        ]
+        async for stats in aggregate(pipeline, ConferenceStats):
+            return stats
+        raise HTTPException(status_code=400, detail="Conference does not exist")
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, conference_id, "conference")
 
-async def conference_details(location_id: str, conference_id: str):
+# Calendar. Conferences whose [starts, ends] overlaps the range, by start date, with their
+# location's name, city, state and picture; paged on (starts, _id).
+CALENDAR_FIELDS = ("_id", "location_id", "name", "description", "starts", "ends", "max_attendees", "max_presentations")
+CALENDAR_LOCATION_FIELDS = ("name", "city", "state", "picture_url")
+CALENDAR_PROJECTION = {**STATS_PROJECTION, "description": 1, "location": 1}
+
+
+def calendar_filter(ends_after: datetime = None, starts_before: datetime = None, after: tuple = None):
+    query = {}
+    if ends_after:
+        query["ends"] = {"$gte": ends_after}
+    if starts_before:
+        query["starts"] = {"$lt": starts_before}
+    if after:
+        starts, id = after
+        query["$or"] = [{"starts": {"$gt": starts}}, {"starts": starts, "_id": {"$gt": id}}]
+    return query
+
+
+def calendar_condition(ends_after: datetime = None, starts_before: datetime = None, after: tuple = None):
+    # calendar_filter as an expression on the conference $$this, for a $filter
+    conditions = []
+    if ends_after:
+        conditions.append({"$gte": ["$$this.ends", ends_after]})
+    if starts_before:
+        conditions.append({"$lt": ["$$this.starts", starts_before]})
+    if after:
+        starts, id = after
+        conditions.append({"$or": [
+            {"$gt": ["$$this.starts", starts]},
+            {"$and": [{"$eq": ["$$this.starts", starts]}, {"$gt": ["$$this._id", id]}]},
+        ]})
+    return {"$and": conditions}
+
+
+async def conference_calendar(ends_after: datetime = None, starts_before: datetime = None, after: tuple = None,
+                              limit: int = None, state: str = None, city: str = None):
+    # The $elemMatch on the conferences_ends_starts index finds the locations with a conference
+    # in the range and past the page's `after`. Only those conferences are unwound, their counters
+    # computed first so their attendee and presentation arrays aren't carried into the sort, which
+    # with a limit only keeps the page. Without `to` the range is open-ended and can match most
+    # locations, hence allowDiskUse for the rest.
+    in_range = calendar_filter(ends_after, starts_before, after)
+    pipeline = [
+        {"$match": {**location_filter(state, city), "conferences": {"$elemMatch": in_range}}},
+        {"$project": {
+            **{field: 1 for field in CALENDAR_LOCATION_FIELDS},
+            "conferences": {"$map": {
+                "input": {"$filter": {"input": "$conferences", "cond": calendar_condition(ends_after, starts_before, after)}},
+                "in": {
+                    **{field: f"$$this.{field}" for field in CALENDAR_FIELDS},
+                    **{counter: {"$ifNull": [f"$$this.{counter}", {"$size": {"$ifNull": [f"$$this.{array}", []]}}]}
+                       for counter, array in COUNTERS.items()},
+                },
+            }},
+        }},
+        {"$unwind": "$conferences"},
+        {"$addFields": {"conferences.location": {field: f"${field}" for field in CALENDAR_LOCATION_FIELDS}}},
+        {"$replaceRoot": {"newRoot": "$conferences"}},
+        {"$sort": {"starts": 1, "_id": 1}},
+        *([{"$limit": limit}] if limit else []),
+        {"$project": CALENDAR_PROJECTION},
+    ]
     try:
-        result = db.locations.find_one(
+        return [{"id": conference.pop("_id"), **conference} async for conference in aggregate(pipeline, allowDiskUse=True)]
+    except PyMongoError as e:
+        handle_exceptions(e, model_name="conference")
+
+async def conference_create(location_id: str, conference: Conference):
+    try:
+        conference.location_id = ObjectId(location_id)
+        result = await db.locations.find_one_and_update(
+            {"_id": ObjectId(location_id)},
+            {"$push": {"conferences": counted_conference(conference)}},
+            projection={"conferences": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+        if result is None:
+            raise HTTPException(status_code=400, detail="Location does not exist")
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        return [Conference.from_mongo(conference) for conference in result["conferences"]]
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, location_id, "conference")
+
+async def conference_details(location_id: str, conference_id: str, fields: Fields = None):
+    try:
+        if fields:
+            # A positional projection can't be narrowed further, so a sparse read unwinds instead
+            pipeline = [
+                *conference_stages(location_query(location_id, conference_id), {"conferences._id": ObjectId(conference_id)},
+                                   fields=tuple(fields.projection())),
+                {"$replaceRoot": {"newRoot": "$conferences"}},
+            ]
+            async for conference in aggregate(pipeline):
+                return fields.serialize(conference)
+            raise HTTPException(status_code=400, detail="Conference does not exist")
+        # The positional projection returns only the matched conference, not every sibling
+        result = await db.locations.find_one(
             {"_id": ObjectId(location_id), "conferences._id": ObjectId(conference_id)},
+            {"conferences.$": 1},
         )
 
         if result:
             conference = result["conferences"][0]
-            return Conference(**conference)
+            return Conference.from_mongo(conference)
         raise HTTPException(status_code=400, detail="Conference does not exist")
     except (PyMongoError, InvalidId, ValidationError) as e:
         handle_exceptions(e, conference_id, "conference")
 
 async def conference_update(location_id: str, conference_id: str, update_fields: dict):
+    if COUNTERS.keys() & update_fields.keys():
+        raise HTTPException(status_code=400, detail=f"{', '.join(COUNTERS)} can't be updated")
     if update_fields.get("location_id"):
         update_fields.update({"location_id": ObjectId(update_fields["location_id"])})
 
@@ -113,11 +451,13 @@ async def conference_update(location_id: str, conference_id: str, update_fields:
     set_dict = {f"conferences.$.{key}": value for key, value in update_fields.items()}
 
     try:
-        result = db.locations.update_one(
+        result = await db.locations.update_one(
             {"_id": ObjectId(location_id), "conferences._id": ObjectId(conference_id)},
             {"$set": set_dict},
         )
         if result.modified_count > 0:
+            await invalidate_location(location_id)
+            await search_changed(location_id)
             return await conference_details(location_id, conference_id)
         elif result.matched_count < 1:
             raise HTTPException(status_code=400, detail="Conference does not exist")
@@ -131,90 +471,462 @@ async def conference_delete(location_id: str, conference_id: str):
     update = {"$pull": {"conferences": {"_id": ObjectId(conference_id)}}}
 
     try:
-        if (result := db.locations.update_one(filter, update)).matched_count > 0:
+        if (result := await db.locations.update_one(filter, update)).matched_count > 0:
+            await invalidate_location(location_id)
+            await search_changed(location_id)
             return result.modified_count
         raise HTTPException(status_code=400, detail="Location does not exist")
     except (PyMongoError, InvalidId) as e:
         handle_exceptions(e)
 
-async def presentation_create(location_id: str, conference_id: str, presentation:Presentation):
-    result = db.locations.find_one_and_update(
-        {"_id": ObjectId(location_id), "conferences._id": ObjectId(conference_id)},
-        {"$addToSet": {
-            "presentation": {
-                "$each": [presentation.dict(by_alias=True)]
-            }
-        }},
-        return_document=ReturnDocument.AFTER
-    )
-    return result
+async def presentation_create(location_id: str, conference_id: str, presentation: Presentation):
+    try:
+        presentation.location_id = ObjectId(location_id)
+        presentation.conference_id = ObjectId(conference_id)
+        submit = functools.partial(
+            db.locations.find_one_and_update,
+            Conference.submission_filter(location_id, conference_id),
+            {
+                "$push": {"conferences.$[conference].presentations": presentation.dict(by_alias=True)},
+                "$inc": {"conferences.$[conference].presentation_count": 1},
+            },
+            array_filters=[{"conference._id": ObjectId(conference_id)}],
+            projection={"conferences": {"$elemMatch": {"_id": ObjectId(conference_id)}}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if (result := await submit()) is None and await init_counters(location_id, conference_id):
+            result = await submit()
+        if result is None:
+            # Raises if the conference doesn't exist, otherwise it is full
+            await conference_details(location_id, conference_id)
+            raise HTTPException(status_code=409, detail="Conference is not accepting more presentations")
+
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        await enqueue("user_add_presentation", user_id=presentation.presenter, presentation_id=presentation.id)
+        return presentation, Conference.from_mongo(result["conferences"][0])
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, conference_id, "presentation")
+
+async def presentation_details(location_id: str, conference_id: str, presentation_id: str, fields: Fields = None):
+    try:
+        presentations = await presentation_all(
+            limit=1, location_id=location_id, conference_id=conference_id, presentation_id=presentation_id, fields=fields,
+        )
+        if presentations:
+            return presentations[0]
+        raise HTTPException(status_code=400, detail="Presentation does not exist")
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, presentation_id)
+
+PRESENTATION_UPDATE_FIELDS = {"title", "synopsis", "status"}
 
-async def presentation_details(location_id: str, conference_id: str, presentation_id: str):
-    filter = {
+
+def presentation_filter(location_id: str, conference_id: str, presentation_id: str):
+    return {
         "_id": ObjectId(location_id),
-        "conferences._id": ObjectId(conference_id),
-        "presentations._id": ObjectId(presentation_id)
-        }
+        "conferences": {"$elemMatch": {"_id": ObjectId(conference_id), "presentations._id": ObjectId(presentation_id)}},
+    }
 
-    try:
-        result = db.locations.find_one(filter)
 
-        if result:
-            return result["presentations"][0]
-        raise HTTPException(status_code=400, detail="Presentation does not exist")
-    except PyMongoError as e:
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+def presentation_array_filters(conference_id: str, presentation_id: str):
+    return [{"conference._id": ObjectId(conference_id)}, {"presentation._id": ObjectId(presentation_id)}]
+
+
+def find_presentation(location: dict, presentation_id: str):
+    presentations = location["conferences"][0]["presentations"]
+    return next(p for p in presentations if p["_id"] == ObjectId(presentation_id))
+
+
+def validate_presentation_update(presentation: dict):
+    if (invalid := set(presentation) - PRESENTATION_UPDATE_FIELDS):
+        raise HTTPException(status_code=400, detail=f"Cannot update presentation fields: {', '.join(sorted(invalid))}")
+    if "status" in presentation and presentation["status"] not in {status.value for status in Status}:
+        raise HTTPException(status_code=400, detail=f"Invalid status: {presentation['status']}")
+    if not presentation:
+        raise HTTPException(status_code=400, detail="No changes to presentation")
+
 
 async def presentation_update(location_id: str, conference_id: str, presentation_id:str, presentation: dict):
-    pass
+    validate_presentation_update(presentation)
+
+    # Both levels are arrays, so the update names them with array filters rather than the positional $
+    set_dict = {f"conferences.$[conference].presentations.$[presentation].{key}": value for key, value in presentation.items()}
+    set_dict["conferences.$[conference].presentations.$[presentation].updated"] = datetime.now()
+    try:
+        result = await db.locations.find_one_and_update(
+            presentation_filter(location_id, conference_id, presentation_id),
+            {"$set": set_dict},
+            array_filters=presentation_array_filters(conference_id, presentation_id),
+            projection={"conferences": {"$elemMatch": {"_id": ObjectId(conference_id)}}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if result is None:
+            raise HTTPException(status_code=400, detail="Presentation does not exist")
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        return Presentation.from_mongo(find_presentation(result, presentation_id))
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, presentation_id, "presentation")
 
 
-async def presentation_all():
-    conferences = await conference_all()
-    presentations: List[Presentation] = []
-    for conference in conferences:
-        presentations.extend(conference.presentations)
-    return presentations
+async def presentation_delete(location_id: str, conference_id: str, presentation_id: str):
+    try:
+        # Returns the document as it was, to find the presenter whose back-reference goes too
+        query = presentation_filter(location_id, conference_id, presentation_id)
+        query["conferences"]["$elemMatch"]["presentation_count"] = {"$exists": True}
+        withdraw = functools.partial(
+            db.locations.find_one_and_update,
+            query,
+            {
+                "$pull": {"conferences.$[conference].presentations": {"_id": ObjectId(presentation_id)}},
+                "$inc": {"conferences.$[conference].presentation_count": -1},
+            },
+            array_filters=[{"conference._id": ObjectId(conference_id)}],
+            projection={"conferences": {"$elemMatch": {"_id": ObjectId(conference_id)}}},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if (result := await withdraw()) is None and await init_counters(location_id, conference_id):
+            result = await withdraw()
+        if result is None:
+            return 0
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        presenter = find_presentation(result, presentation_id)["presenter"]
+        await enqueue("user_remove_presentation", user_id=presenter, presentation_id=ObjectId(presentation_id))
+        return 1
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, presentation_id)
 
 
-async def attendees_all():
-    cursor = db.locations.aggregate(
-        [
-            { "$unwind": "$conferences.attendees" },
-            {"$replaceRoot": {"newRoot": "$attendees"}},
-            { "$project": {"_id": 0} }
+async def presentation_all(after: ObjectId = None, limit: int = None, state: str = None, city: str = None,
+                           status: str = None, location_id: str = None, conference_id: str = None,
+                           presentation_id: str = None, fields: Fields = None):
+    try:
+        presentation_query = {"status": status} if status else {}
+        if presentation_id:
+            presentation_query["_id"] = ObjectId(presentation_id)
+        # The status filter needs its field even when it isn't requested
+        presentation_fields = [f"presentations.{path}" for path in fields.projection("status")] if fields else ["presentations"]
+        pipeline = [
+            *conference_stages(
+                location_query(location_id, conference_id, state=state, city=city),
+                {"conferences._id": ObjectId(conference_id)} if conference_id else None,
+                fields=("_id", *presentation_fields),
+            ),
+            {"$unwind": "$conferences.presentations"},
+            {"$replaceRoot": {"newRoot": "$conferences.presentations"}},
+            {"$match": presentation_query},
+            *page_stages(after, limit),
         ]
-    )
-    return cursor.to_list(length=100)
+        return read([presentation async for presentation in aggregate(pipeline)], fields, Presentation)
+    except (ValidationError, PyMongoError, InvalidId) as e:
+        handle_exceptions(e, model_name="presentation")
+
+
+async def attendee_create(location_id: str, conference_id: str, attendee_id: ObjectId):
+    try:
+        register = functools.partial(
+            db.locations.find_one_and_update,
+            Conference.registration_filter(location_id, conference_id, attendee_id),
+            {
+                "$push": {"conferences.$[conference].attendees": ObjectId(attendee_id)},
+                "$inc": {"conferences.$[conference].attendee_count": 1},
+            },
+            array_filters=[{"conference._id": ObjectId(conference_id)}],
+            projection={"conferences": {"$elemMatch": {"_id": ObjectId(conference_id)}}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if (result := await register()) is None and await init_counters(location_id, conference_id):
+            result = await register()
+        if result is None:
+            # Only the rejected path pays for a second read, to say why
+            conference = await conference_details(location_id, conference_id)
+            if ObjectId(attendee_id) in conference.attendees:
+                raise HTTPException(status_code=400, detail="Already registered for this conference")
+            raise HTTPException(status_code=409, detail="Conference is full")
+        await invalidate_location(location_id)
+        await enqueue("user_add_conference", user_id=ObjectId(attendee_id), conference_id=ObjectId(conference_id))
+        return Conference.from_mongo(result["conferences"][0])
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, conference_id, "conference")
+
+
+async def attendee_delete(location_id: str, conference_id: str, attendee_id: str):
+    try:
+        unregister = functools.partial(
+            db.locations.update_one,
+            {"_id": ObjectId(location_id), "conferences": {"$elemMatch": {
+                "_id": ObjectId(conference_id), "attendees": ObjectId(attendee_id), "attendee_count": {"$exists": True},
+            }}},
+            {
+                "$pull": {"conferences.$[conference].attendees": ObjectId(attendee_id)},
+                "$inc": {"conferences.$[conference].attendee_count": -1},
+            },
+            array_filters=[{"conference._id": ObjectId(conference_id)}],
+        )
+        if (result := await unregister()).modified_count == 0 and await init_counters(location_id, conference_id):
+            result = await unregister()
+        if result.modified_count == 0:
+            return 0
+        await invalidate_location(location_id)
+        await enqueue("user_remove_conference", user_id=ObjectId(attendee_id), conference_id=ObjectId(conference_id))
+        return 1
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, attendee_id)
+
+
+async def attendees_all(after: ObjectId = None, limit: int = None, state: str = None, city: str = None,
+                        location_id: str = None, conference_id: str = None, attendee_id: str = None):
+    # One row per attendee with the conferences they registered for, joined with their user name.
+    # Attendees only exist inside the conferences' arrays, so a page has to group every registration
+    # after `after`; the $group may spill to disk rather than fail on Mongo's 100MB stage limit.
+    try:
+        attendee_query = {"$gt": after} if after else {}
+        if attendee_id:
+            attendee_query["$eq"] = ObjectId(attendee_id)
+        pipeline = [
+            *conference_stages(
+                location_query(location_id, conference_id, state=state, city=city),
+                {"conferences._id": ObjectId(conference_id)} if conference_id else None,
+                fields=("_id", "name", "attendees"),
+            ),
+            {"$unwind": "$conferences.attendees"},
+            {"$match": {"conferences.attendees": attendee_query} if attendee_query else {}},
+            {"$group": {
+                "_id": "$conferences.attendees",
+                "conferences": {"$push": {"id": {"$toString": "$conferences._id"}, "name": "$conferences.name"}},
+            }},
+            *page_stages(limit=limit),
+            {"$lookup": {"from": "users", "localField": "_id", "foreignField": "_id", "as": "user"}},
+            {"$project": {
+                "_id": 0,
+                "id": {"$toString": "$_id"},
+                "name": {"$arrayElemAt": ["$user.name", 0]},
+                "conferences": 1,
+            }},
+        ]
+        return [attendee async for attendee in aggregate(pipeline, allowDiskUse=True)]
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e)
 
 async def attendee_details(location_id: str, conference_id: str, attendee_id: str):
     try:
-        result= await db.locations.find_one(
-            {"_id": ObjectId(location_id), "conferences._id": ObjectId(conference_id), "attendees._id": ObjectId(attendee_id)},
-            {"attendees.$": 1}
+        attendees = await attendees_all(
+            limit=1, location_id=location_id, conference_id=conference_id, attendee_id=attendee_id
         )
-        if result:
-            return result["attendees"][0]
+        if attendees:
+            return attendees[0]
         raise HTTPException(status_code=400, detail="Attendee does not exist")
     except (PyMongoError, InvalidId) as e:
         handle_exceptions(e)
 
 
+# Full exports (see routes/endpoints.export_data and export.py). They stream from the cursor one
+# batch at a time, so memory stays flat however large the collections are.
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CONFERENCE_PROJECTION = {**STATS_PROJECTION, "description": 1}
+
+
+def registration_row(location_id: str, conference: str, attendee_id: str):
+    # One registration joined with its conference and user, from a `user` array $lookup
+    return {
+        "_id": 0,
+        "location_id": location_id,
+        "conference_id": f"{conference}._id",
+        "conference": f"{conference}.name",
+        "starts": f"{conference}.starts",
+        "ends": f"{conference}.ends",
+        "attendee_id": attendee_id,
+        **{field: {"$arrayElemAt": [f"$user.{field}", 0]} for field in ("username", "name", "email", "company_name")},
+    }
+
+
+async def exported(cursor):
+    async for document in cursor:
+        yield {"id": document.pop("_id"), **document} if "_id" in document else document
+
+
+def export_locations(state: str = None, city: str = None):
+    return exported(db.locations.find(location_filter(state, city), {"conferences": 0}, batch_size=EXPORT_BATCH_SIZE))
+
+
+def export_conferences(state: str = None, city: str = None):
+    pipeline = [
+        *conference_stages(location_filter(state, city)),
+        {"$replaceRoot": {"newRoot": "$conferences"}},
+        {"$project": EXPORT_CONFERENCE_PROJECTION},
+    ]
+    return exported(db.locations.aggregate(pipeline, allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE))
+
+
+def export_registrations(state: str = None, city: str = None):
+    pipeline = [
+        *conference_stages(location_filter(state, city), fields=("_id", "name", "starts", "ends", "attendees")),
+        {"$unwind": "$conferences.attendees"},
+        {"$lookup": {"from": "users", "localField": "conferences.attendees", "foreignField": "_id", "as": "user"}},
+        {"$project": registration_row("$_id", "$conferences", "$conferences.attendees")},
+    ]
+    return exported(db.locations.aggregate(pipeline, allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE))
+
+
+# Search. Conferences and presentations are copied into the `search` collection, one document
+# each with its location's state and city, under a weighted text index (see indexes.py). The
+# copies of a location are rebuilt by a job after every write that changes them, so results
+# can trail a write by a moment, and the same collection serves both storage layouts.
+SEARCH = "search"
+SEARCH_LOCKS = "search_locks"
+SEARCH_KINDS = ("conference", "presentation")
+SEARCH_PROJECTION = {
+    "state": 1, "city": 1,
+    **{f"conferences.{field}": 1 for field in ("_id", "name", "description", "starts", "ends")},
+    **{f"conferences.presentations.{field}": 1 for field in ("_id", "title", "synopsis", "status")},
+}
+
+
+def search_documents(location: dict):
+    place = {"location_id": location["_id"], "state": location["state"]["abbreviation"], "city": location["city"]}
+    documents = []
+    for conference in location.get("conferences", []):
+        dates = {"conference_id": conference["_id"], "starts": conference["starts"], "ends": conference["ends"]}
+        documents.append({"_id": conference["_id"], "kind": "conference", "title": conference["name"],
+                          "text": conference["description"], **place, **dates})
+        for presentation in conference.get("presentations", []):
+            documents.append({"_id": presentation["_id"], "kind": "presentation", "title": presentation["title"],
+                              "text": presentation["synopsis"], "status": presentation["status"], **place, **dates})
+    return documents
+
+
+async def search_entries(location_id: ObjectId):
+    location = await db.locations.find_one({"_id": location_id}, SEARCH_PROJECTION)
+    return search_documents(location) if location else []
+
+
+async def search_changed(*location_ids):
+    await enqueue_many("search_reindex", [{"location_id": ObjectId(location_id)} for location_id in location_ids])
+
+
+async def search_lock(location_id: ObjectId, token: ObjectId):
+    # Takes the location's reindex lock, or one whose holder died and let its lease run out. If
+    # another reindex holds it, marks it dirty instead, so the holder reads the location again
+    # before letting go; returns whether this reindex should run.
+    while True:
+        now = datetime.utcnow()
+        try:
+            await db[SEARCH_LOCKS].update_one(
+                {"_id": location_id, "expires": {"$lt": now}},
+                {"$set": {"token": token, "dirty": False, "expires": now + timedelta(seconds=settings.JOBS_LEASE_SECONDS)}},
+                upsert=True,
+            )
+            return True
+        except DuplicateKeyError:
+            if (await db[SEARCH_LOCKS].update_one({"_id": location_id}, {"$set": {"dirty": True}})).matched_count:
+                return False
+            # Released in between, try to take it again
+
+
+@job("search_reindex")
+async def search_reindex(location_id: ObjectId):
+    # Replaces the location's documents with its current conferences and presentations. Reindexes
+    # of a location are serialized: two running at once could otherwise finish out of order, the
+    # one that read first overwriting the newer copies and deleting what the other had just added.
+    # One that finds the location locked leaves it to the holder, which goes round again if any
+    # write happened since it read, so the last read always follows the last write.
+    token = ObjectId()
+    if not await search_lock(location_id, token):
+        return 0
+    try:
+        while True:
+            documents = await search_entries(location_id)
+            await db[SEARCH].bulk_write([
+                *(ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in documents),
+                DeleteMany({"location_id": location_id, "_id": {"$nin": [document["_id"] for document in documents]}}),
+            ], ordered=False)
+            if (await db[SEARCH_LOCKS].delete_one({"_id": location_id, "token": token, "dirty": False})).deleted_count:
+                return len(documents)
+            # Marked dirty: go round again, unless the lease ran out and another reindex took over
+            if not (await db[SEARCH_LOCKS].update_one({"_id": location_id, "token": token},
+                                                      {"$set": {"dirty": False}})).matched_count:
+                return len(documents)
+    except Exception:
+        await db[SEARCH_LOCKS].delete_one({"_id": location_id, "token": token})
+        raise
+
+
+async def search(text: str, after: tuple = None, limit: int = None, state: str = None, city: str = None,
+                 status: str = None, kind: str = None):
+    # Ranked by text score, then _id; `after` is the (score, _id) of the last result of the previous page
+    query = {"$text": {"$search": text}}
+    if state:
+        query["state"] = US_STATES.get(state.title(), state.upper())
+    if city:
+        query["city"] = city
+    if status:
+        query["status"] = status
+    if kind:
+        query["kind"] = kind
+    pipeline = [{"$match": query}, {"$addFields": {"score": {"$meta": "textScore"}}}]
+    if after:
+        score, id = after
+        pipeline.append({"$match": {"$or": [{"score": {"$lt": score}}, {"score": score, "_id": {"$gt": id}}]}})
+    pipeline.append({"$sort": {"score": -1, "_id": 1}})
+    if limit:
+        pipeline.append({"$limit": limit})
+    try:
+        return [{"id": hit.pop("_id"), **hit} async for hit in db[SEARCH].aggregate(pipeline)]
+    except PyMongoError as e:
+        handle_exceptions(e, model_name="search")
+
+
+# Back-references on the user document. They run as jobs (see common/jobs.py) after the
+# conference write commits and are retried until they succeed.
+@job("user_add_conference")
+async def user_add_conference(user_id: ObjectId, conference_id: ObjectId):
+    await db.users.update_one({"_id": user_id}, {"$addToSet": {"conferences": conference_id}})
+
+
+@job("user_remove_conference")
+async def user_remove_conference(user_id: ObjectId, conference_id: ObjectId):
+    await db.users.update_one({"_id": user_id}, {"$pull": {"conferences": conference_id}})
+
+
+@job("user_add_presentation")
+async def user_add_presentation(user_id: ObjectId, presentation_id: ObjectId):
+    await db.users.update_one({"_id": user_id}, {"$addToSet": {"presentations": presentation_id}})
+
+
+@job("user_remove_presentation")
+async def user_remove_presentation(user_id: ObjectId, presentation_id: ObjectId):
+    await db.users.update_one({"_id": user_id}, {"$pull": {"presentations": presentation_id}})
+
+
 ############# Auth related functions ################################
 # user related functions
 async def create_user(user: dict):
     try:
         User(**user)
+        if await db.users.count_documents({"username": user.get("username")}, limit=1):
+            raise HTTPException(status_code=400, detail="User already exists")
         user["roles"] = [Role.USER]
         if user.get("is_superuser"):
             user["roles"].append(Role.ADMIN)
-        if (result := db.users.insert_one(user)).inserted_id is not None:
+        if (result := await db.users.insert_one(user)).inserted_id is not None:
             return True
         return False
     except (PyMongoError, ValidationError) as e:
-        handle_exceptions(e)
+        handle_exceptions(e, model_name="user")
 
-def get_user(id=None, username=None):
+async def user_bulk_create(users: List[dict]):
+    return await insert_unique("users", users, "username", "user")
+
+async def get_user(id=None, username=None):
     if id:
-        return db.users.find_one({"_id": id})
-    return db.users.find_one({"username": username})
+        return await db.users.find_one({"_id": id})
+    return await db.users.find_one({"username": username})
+
+
+# STORAGE_LAYOUT=normalized keeps conferences, presentations and registrations in their own
+# collections instead of embedding them in the location. normalized_datastore.py implements
+# the functions that differ for that layout with the same signatures, and replaces them here.
+if settings.STORAGE_LAYOUT == "normalized":
+    from normalized_datastore import *  # noqa: E402,F401,F403
@@ -0,0 +1,35 @@
+# Streams a full export as NDJSON, the same rows as GET /api/export/{kind}.
+#
+#   python -m export registrations --gzip --output registrations.ndjson.gz
+#   python -m export conferences --state NY > conferences.ndjson
+import argparse
+import asyncio
+import sys
+
+import datastore as ds
+from common.database import close
+from common.ndjson import ndjson_chunks
+from routes.endpoints import EXPORTS
+
+
+async def main(args) -> int:
+    rows = getattr(ds, f"export_{args.kind}")(state=args.state, city=args.city)
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        async for chunk in ndjson_chunks(rows, args.gzip):
+            output.write(chunk)
+        return 0
+    finally:
+        if args.output:
+            output.close()
+        close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("kind", choices=EXPORTS)
+    parser.add_argument("--gzip", action="store_true")
+    parser.add_argument("--output", help="file to write, stdout otherwise")
+    parser.add_argument("--state")
+    parser.add_argument("--city")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,149 @@
+import csv
+import io
+import json
+from itertools import islice
+
+import datastore as ds
+from auth_utility import hash_password
+from bson import ObjectId
+from bson.errors import InvalidId
+from common.constants import US_STATES, Role
+from common.jobs import enqueue_many
+from pydantic import ValidationError
+from routes.models import Conference, Location, User
+
+# Bulk imports of NDJSON or CSV rows, shared by POST /api/import/{kind} and bulk_import.py.
+# Rows are validated with the same models as the single-item endpoints and written a batch at a
+# time with unordered bulk writes, so a bad row is reported by its line number instead of failing
+# the whole import; the rows before and after it are still written.
+IMPORTS = ("locations", "conferences", "users")
+IMPORT_BATCH_SIZE = 500
+FORMATS = ("ndjson", "csv")
+
+STATE_NAMES = {abbreviation: name for name, abbreviation in US_STATES.items()}
+STATES_BY_NAME = {name.lower(): name for name in US_STATES}
+# Written by the server, or through their own endpoints
+SKIPPED_FIELDS = ("_id", "id", "conferences", "attendees", "presentations", "attendee_count",
+                  "presentation_count", "roles", "password_hash", "created", "updated")
+
+
+class RowError(ValueError):
+    pass
+
+
+def parse_rows(data: bytes, format: str):
+    # Yields (line, row or RowError); CSV lines count the header as line 1
+    if format == "csv":
+        reader = csv.DictReader(io.StringIO(data.decode("utf-8-sig")))
+        for line, row in enumerate(reader, 2):
+            # Empty cells are missing values, so the models apply their defaults
+            yield line, {key: value for key, value in row.items() if key and value not in ("", None)}
+        return
+    for line, text in enumerate(data.decode("utf-8-sig").splitlines(), 1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as e:
+            yield line, RowError(f"Invalid JSON: {e}")
+            continue
+        yield line, row if isinstance(row, dict) else RowError("Expected a JSON object")
+
+
+def row_fields(row: dict) -> dict:
+    return {key: value for key, value in row.items() if key not in SKIPPED_FIELDS}
+
+
+def state(value) -> dict:
+    # "New York", "new york", "NY" or {"name": ..., "abbreviation": ...}
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, str):
+        if (name := STATE_NAMES.get(value.strip().upper())) or (name := STATES_BY_NAME.get(value.strip().lower())):
+            return {"name": name, "abbreviation": US_STATES[name]}
+    raise RowError(f"Invalid state: {value}")
+
+
+def flag(value) -> bool:
+    return value is True or str(value).lower() in ("1", "true", "yes")
+
+
+def location_row(row: dict) -> Location:
+    return Location(**{**row_fields(row), "state": state(row.get("state"))})
+
+
+def conference_row(row: dict) -> Conference:
+    if not row.get("location_id"):
+        raise RowError("location_id or a known location name is required")
+    fields = {key: value for key, value in row_fields(row).items() if key != "location"}
+    return Conference(**{**fields, "location_id": ObjectId(row["location_id"])})
+
+
+def user_row(row: dict) -> dict:
+    if not row.get("password"):
+        raise RowError("password is required")
+    fields = {key: value for key, value in row_fields(row).items() if key not in ("password", "is_superuser")}
+    user = User(**fields, password_hash=hash_password(str(row["password"])))
+    # The document create_user writes, with the roles it would give
+    document = user.dict(by_alias=True, exclude={"auth_profile"})
+    document["roles"] = [Role.USER, Role.ADMIN] if flag(row.get("is_superuser")) else [Role.USER]
+    return document
+
+
+ROW_MODELS = {"locations": location_row, "conferences": conference_row, "users": user_row}
+
+
+def error_message(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+    if isinstance(e, InvalidId):
+        return f"Invalid id: {e}"
+    return str(e)
+
+
+async def resolve_locations(rows: list):
+    # Conferences may name their location instead of giving its id, looked up once per batch
+    names = {row["location"] for _, row in rows
+             if isinstance(row, dict) and row.get("location") and not row.get("location_id")}
+    if not names:
+        return
+    ids = await ds.location_ids_by_name(names)
+    for _, row in rows:
+        if isinstance(row, dict) and row.get("location") in ids and not row.get("location_id"):
+            row["location_id"] = ids[row["location"]]
+
+
+async def import_batch(kind: str, rows: list, report: dict):
+    if kind == "conferences":
+        await resolve_locations(rows)
+    models, lines = [], []
+    for line, row in rows:
+        try:
+            if isinstance(row, RowError):
+                raise row
+            models.append(ROW_MODELS[kind](row))
+            lines.append(line)
+        except (ValueError, TypeError, InvalidId) as e:
+            report["errors"].append({"row": line, "error": error_message(e)})
+    if not models:
+        return
+
+    failed = await getattr(ds, f"{kind[:-1]}_bulk_create")(models)
+    report["errors"].extend({"row": lines[index], "error": error} for index, error in sorted(failed.items()))
+    report["created"] += len(models) - len(failed)
+    if kind == "locations":
+        # Always in the background; a photo lookup per row would make the import as slow as the API
+        await enqueue_many("fill_location_photo", [
+            {"location_id": location.id, "city": location.city, "state": location.state.abbreviation}
+            for index, location in enumerate(models) if index not in failed and not location.picture_url
+        ])
+
+
+async def run_import(kind: str, data: bytes, format: str, batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    report = {"kind": kind, "rows": 0, "created": 0, "errors": []}
+    rows = parse_rows(data, format)
+    while batch := list(islice(rows, batch_size)):
+        report["rows"] += len(batch)
+        await import_batch(kind, batch, report)
+    report["errors"].sort(key=lambda error: error["row"])
+    return report
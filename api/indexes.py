@@ -0,0 +1,207 @@
+# Declarative index registry for the datastore queries.
+#
+#   python -m indexes            create the indexes, failing if a unique one can't be built over duplicates
+#   python -m indexes --check    create them, then explain() every query shape and fail on a COLLSCAN
+import argparse
+import asyncio
+import sys
+from datetime import datetime
+
+import datastore as ds
+from bson import ObjectId
+from common.database import close, db
+from pymongo import ASCENDING, TEXT, IndexModel
+
+INDEXES = {
+    "locations": [
+        # location_create relies on names being unique
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+        # conference_details / conference_update / Conference.add_* filter on the embedded ids
+        IndexModel([("conferences._id", ASCENDING)], name="conferences_id"),
+        IndexModel([("conferences.presentations._id", ASCENDING)], name="conferences_presentations_id"),
+        # conference_calendar, which matches conferences still running after a date
+        IndexModel([("conferences.ends", ASCENDING), ("conferences.starts", ASCENDING)], name="conferences_ends_starts"),
+        # location_filter(state, city), paged by _id
+        IndexModel([("state.abbreviation", ASCENDING), ("city", ASCENDING), ("_id", ASCENDING)], name="state_city"),
+        IndexModel([("city", ASCENDING), ("_id", ASCENDING)], name="city"),
+    ],
+    "jobs": [
+        # JobRunner.claim in common/jobs.py
+        IndexModel([("status", ASCENDING), ("run_at", ASCENDING)], name="status_run_at"),
+        IndexModel([("status", ASCENDING), ("locked_until", ASCENDING)], name="status_locked_until"),
+    ],
+    "photo_cache": [
+        # Pexels lookups by (city, state), see routes/third_party.py
+        IndexModel([("expires", ASCENDING)], name="expires_ttl", expireAfterSeconds=0),
+    ],
+    "cache_generations": [
+        # Workers reread the counters bumped since their last refresh, see common/cache.py
+        IndexModel([("updated", ASCENDING)], name="updated"),
+    ],
+    "response_cache": [
+        # Only used with CACHE_BACKEND=mongo, see common/cache.py
+        IndexModel([("expires", ASCENDING)], name="expires_ttl", expireAfterSeconds=0),
+        IndexModel([("tags", ASCENDING)], name="tags"),
+    ],
+    "search": [
+        # datastore.search ranks titles above descriptions and synopses
+        IndexModel([("title", TEXT), ("text", TEXT)], name="text", weights={"title": 5, "text": 1},
+                   default_language="english", language_override="search_language"),
+        # search_reindex replaces a location's documents
+        IndexModel([("location_id", ASCENDING)], name="location_id"),
+    ],
+    "search_locks": [
+        # Left behind by a search_reindex whose worker died, see datastore.search_lock
+        IndexModel([("expires", ASCENDING)], name="expires_ttl", expireAfterSeconds=0),
+    ],
+    "users": [
+        # get_user / credentials_match look users up by username
+        IndexModel([("username", ASCENDING)], name="username_unique", unique=True),
+    ],
+    # The collections below are only used with STORAGE_LAYOUT=normalized, see normalized_datastore.py
+    "conferences": [
+        IndexModel([("location_id", ASCENDING), ("_id", ASCENDING)], name="location_id"),
+        IndexModel([("starts", ASCENDING)], name="starts"),
+        IndexModel([("ends", ASCENDING), ("starts", ASCENDING)], name="ends_starts"),
+    ],
+    "presentations": [
+        IndexModel([("conference_id", ASCENDING), ("_id", ASCENDING)], name="conference_id"),
+        IndexModel([("location_id", ASCENDING), ("_id", ASCENDING)], name="location_id"),
+        IndexModel([("status", ASCENDING), ("_id", ASCENDING)], name="status"),
+    ],
+    "registrations": [
+        # attendee_create relies on one registration per attendee and conference
+        IndexModel([("conference_id", ASCENDING), ("attendee_id", ASCENDING)], name="conference_attendee_unique", unique=True),
+        IndexModel([("attendee_id", ASCENDING)], name="attendee_id"),
+        IndexModel([("location_id", ASCENDING)], name="location_id"),
+        # attendees_all pages by attendee_id, also within a location (or a state / city's locations)
+        IndexModel([("location_id", ASCENDING), ("attendee_id", ASCENDING)], name="location_attendee"),
+    ],
+}
+
+
+def query_shapes():
+    # (description, collection, explain command) for every filtered query the datastore runs
+    location_id, conference_id, presentation_id = ObjectId(), ObjectId(), ObjectId()
+    return [
+        ("location_create", "locations", {"find": "locations", "filter": {"name": "Venue"}}),
+        ("location_details", "locations", {"find": "locations", "filter": {"_id": location_id}}),
+        ("location_all(state, city)", "locations", {"find": "locations", "filter": ds.location_filter("NY", "New York")}),
+        ("location_all(city)", "locations", {"find": "locations", "filter": ds.location_filter(city="New York")}),
+        ("conference_details", "locations", {
+            "find": "locations", "filter": {"_id": location_id, "conferences._id": conference_id},
+        }),
+        ("conference lookup by id", "locations", {"find": "locations", "filter": {"conferences._id": conference_id}}),
+        ("presentation lookup by id", "locations", {
+            "find": "locations", "filter": {"conferences.presentations._id": presentation_id},
+        }),
+        ("presentation_all(location, conference)", "locations", {
+            "aggregate": "locations", "cursor": {},
+            "pipeline": ds.conference_stages(ds.location_query(location_id, conference_id)),
+        }),
+        ("normalized conference_all(location)", "conferences", {
+            "find": "conferences", "filter": {"location_id": location_id}, "sort": {"_id": 1},
+        }),
+        ("conference_calendar", "locations", {"find": "locations", "filter": {
+            "conferences": {"$elemMatch": ds.calendar_filter(datetime(2026, 1, 1), datetime(2026, 2, 1))},
+        }}),
+        ("normalized conference_calendar", "conferences", {
+            "find": "conferences", "filter": ds.calendar_filter(datetime(2026, 1, 1), datetime(2026, 2, 1)),
+            "sort": {"starts": 1, "_id": 1},
+        }),
+        ("normalized presentation_all(conference)", "presentations", {
+            "find": "presentations", "filter": {"conference_id": conference_id}, "sort": {"_id": 1},
+        }),
+        ("normalized attendees_all", "registrations", {
+            "find": "registrations", "filter": {"attendee_id": {"$gt": ObjectId()}}, "sort": {"attendee_id": 1},
+        }),
+        ("normalized attendees_all(location)", "registrations", {
+            "find": "registrations", "filter": {"location_id": location_id}, "sort": {"attendee_id": 1},
+        }),
+        ("normalized attendees_all(conference)", "registrations", {
+            "find": "registrations", "filter": {"conference_id": conference_id}, "sort": {"attendee_id": 1},
+        }),
+        ("search", "search", {"aggregate": "search", "cursor": {}, "pipeline": [
+            {"$match": {"$text": {"$search": "python"}, "state": "NY", "status": "approved"}},
+            {"$sort": {"score": {"$meta": "textScore"}, "_id": 1}},
+        ]}),
+        ("search_reindex", "search", {"find": "search", "filter": {"location_id": location_id}}),
+        ("get_user(username)", "users", {"find": "users", "filter": {"username": "username"}}),
+        ("get_user(id)", "users", {"find": "users", "filter": {"_id": ObjectId()}}),
+    ]
+
+
+async def duplicate_keys(collection: str, index: IndexModel, limit: int = 5):
+    # Up to `limit` key values held by more than one document, which a unique index can't be built over
+    keys = [field for field, _ in index.document["key"].items()]
+    pipeline = [
+        {"$group": {"_id": {field: f"${field}" for field in keys}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": limit},
+    ]
+    return [duplicate["_id"] async for duplicate in db[collection].aggregate(pipeline, allowDiskUse=True)]
+
+
+async def ensure_indexes():
+    # A unique index that doesn't exist yet is only built once its collection has no duplicates.
+    # Otherwise it is skipped, and the returned messages say which values to clean up first,
+    # rather than the build failing and taking the app's startup down with it. location_create,
+    # create_user and the bulk imports check for duplicates themselves in the meantime.
+    skipped = []
+    for collection, indexes in INDEXES.items():
+        existing = await db[collection].index_information()
+        buildable = []
+        for index in indexes:
+            name = index.document["name"]
+            if index.document.get("unique") and name not in existing:
+                if duplicates := await duplicate_keys(collection, index):
+                    values = ", ".join(str(duplicate) for duplicate in duplicates)
+                    skipped.append(f"{collection}.{name} not built, duplicate values: {values}")
+                    continue
+            buildable.append(index)
+        if buildable:
+            await db[collection].create_indexes(buildable)
+    for message in skipped:
+        print(message, file=sys.stderr)
+    return skipped
+
+
+def plan_stages(plan):
+    # Walks an explain() plan and yields every stage name in it
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from plan_stages(value)
+
+
+async def check_indexes():
+    failures = []
+    for description, collection, command in query_shapes():
+        explained = await db.command("explain", command, verbosity="queryPlanner")
+        stages = set(plan_stages(explained))
+        if "COLLSCAN" in stages:
+            failures.append(description)
+        print(f"{'COLLSCAN' if 'COLLSCAN' in stages else 'ok':8} {collection}: {description}")
+    return failures
+
+
+async def main(check: bool):
+    try:
+        if await ensure_indexes():
+            return 1
+        if check and (failures := await check_indexes()):
+            print(f"collection scans in: {', '.join(failures)}", file=sys.stderr)
+            return 1
+        return 0
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check", action="store_true", help="explain() every query shape and fail on a collection scan")
+    sys.exit(asyncio.run(main(parser.parse_args().check)))
@@ -0,0 +1,144 @@
+# Copies the conferences, presentations and attendees embedded in `locations` into the collections
+# used by STORAGE_LAYOUT=normalized, while the app keeps serving from the embedded layout.
+#
+#   python -m migrate_normalized              sync, resuming after the last location copied
+#   python -m migrate_normalized --restart    sync every location again, picking up the writes made meanwhile
+#   python -m migrate_normalized --prune      once running normalized, drop the embedded arrays
+#
+# The sync only runs while STORAGE_LAYOUT is embedded: after the switch the normalized collections
+# are the live data, and the embedded copies are stale.
+#
+# Every write is an idempotent upsert keyed on the embedded ids, so the sync can be interrupted and
+# re-run at any point. Its progress is kept in the `migrations` collection.
+#
+# A sync only copies the writes made before it read each location, so the last one has to run with
+# writes stopped. The cutover, with no write lost:
+#
+#   1. While running embedded, run `python -m migrate_normalized` until it completes. This is the
+#      bulk of the copy and can take as long as it needs; re-running it resumes.
+#   2. Deploy with WRITES_PAUSED=true, still STORAGE_LAYOUT=embedded, and wait until no worker of the
+#      previous deploy is left: from then on the API answers writes with a 503 (common/maintenance.py).
+#      Don't run bulk_import.py or backfill_counters.py until step 4 is done either.
+#   3. Run `python -m migrate_normalized --restart`. Nothing writes to the embedded arrays meanwhile,
+#      so this copy is final.
+#   4. Deploy with STORAGE_LAYOUT=normalized and WRITES_PAUSED unset. Until the rollout finishes the
+#      workers left over from step 2 keep refusing writes, so every write lands in the normalized
+#      collections.
+#   5. Once everything runs normalized, `python -m migrate_normalized --prune`.
+#
+# Writes are paused from step 2 to step 4; reads are served throughout.
+import argparse
+import asyncio
+import sys
+
+import datastore  # noqa: F401 resolves the routes.models import cycle
+import settings
+from common.database import close, db
+from indexes import ensure_indexes
+from normalized_datastore import conference_document
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+from routes.models import Conference
+
+MIGRATION_ID = "normalize"
+
+
+def location_requests(location: dict):
+    requests = {"conferences": [], "presentations": [], "registrations": []}
+    conference_ids, presentation_ids, registered = [], [], []
+    for document in location.get("conferences", []):
+        conference = Conference.from_mongo(document)
+        conference.location_id = location["_id"]
+        normalized = conference_document(conference)
+        normalized.update({
+            "attendee_count": len(conference.attendees),
+            "presentation_count": len(conference.presentations),
+        })
+        requests["conferences"].append(ReplaceOne({"_id": conference.id}, normalized, upsert=True))
+        conference_ids.append(conference.id)
+        for presentation in conference.presentations:
+            presentation.location_id, presentation.conference_id = location["_id"], conference.id
+            requests["presentations"].append(
+                ReplaceOne({"_id": presentation.id}, presentation.dict(by_alias=True), upsert=True)
+            )
+            presentation_ids.append(presentation.id)
+        for attendee_id in conference.attendees:
+            registration = {"conference_id": conference.id, "attendee_id": attendee_id}
+            requests["registrations"].append(UpdateOne(
+                registration,
+                {"$set": {"location_id": location["_id"]}, "$setOnInsert": {"created": conference.updated}},
+                upsert=True,
+            ))
+            registered.append(registration)
+
+    # Anything normalized earlier that is no longer embedded was deleted in the meantime. A location
+    # without the field was pruned (or never had conferences embedded), so it says nothing about that.
+    if "conferences" not in location:
+        return requests
+    requests["conferences"].append(DeleteMany({"location_id": location["_id"], "_id": {"$nin": conference_ids}}))
+    requests["presentations"].append(DeleteMany({"location_id": location["_id"], "_id": {"$nin": presentation_ids}}))
+    requests["registrations"].append(DeleteMany({"location_id": location["_id"], "$nor": registered or [{"_id": None}]}))
+    return requests
+
+
+async def sync(batch_size: int, restart: bool, force: bool = False):
+    # Once the app runs normalized, the embedded copies are stale or pruned and the normalized
+    # collections are the live data, which a sync would overwrite or delete. `force` is for a
+    # database that was just loaded embedded, like benchmarks/dataset.py's.
+    if settings.STORAGE_LAYOUT == "normalized" and not force:
+        print("refusing to sync while STORAGE_LAYOUT is normalized", file=sys.stderr)
+        return None
+    if restart:
+        await db.migrations.delete_one({"_id": MIGRATION_ID})
+    checkpoint = await db.migrations.find_one({"_id": MIGRATION_ID}) or {}
+    query = {"_id": {"$gt": checkpoint["last_location_id"]}} if checkpoint.get("last_location_id") else {}
+    copied = 0
+    while True:
+        locations = await db.locations.find(query, {"_id": 1, "conferences": 1}).sort("_id", 1).to_list(batch_size)
+        if not locations:
+            break
+        batch = {"conferences": [], "presentations": [], "registrations": []}
+        for location in locations:
+            for collection, requests in location_requests(location).items():
+                batch[collection].extend(requests)
+        for collection, requests in batch.items():
+            if requests:
+                await db[collection].bulk_write(requests, ordered=False)
+
+        last_location_id = locations[-1]["_id"]
+        await db.migrations.update_one(
+            {"_id": MIGRATION_ID}, {"$set": {"last_location_id": last_location_id}}, upsert=True,
+        )
+        query = {"_id": {"$gt": last_location_id}}
+        copied += len(locations)
+        print(f"copied {copied} locations, last {last_location_id}")
+    await db.migrations.update_one({"_id": MIGRATION_ID}, {"$set": {"complete": True}}, upsert=True)
+    return copied
+
+
+async def prune():
+    if settings.STORAGE_LAYOUT != "normalized":
+        print("refusing to prune while STORAGE_LAYOUT is not normalized", file=sys.stderr)
+        return 1
+    result = await db.locations.update_many({"conferences": {"$exists": True}}, {"$unset": {"conferences": ""}})
+    print(f"pruned {result.modified_count} locations")
+    return 0
+
+
+async def main(args):
+    try:
+        await ensure_indexes()
+        if args.prune:
+            return await prune()
+        if await sync(args.batch_size, args.restart) is None:
+            return 1
+        return 0
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=500, help="locations copied per bulk write")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and sync every location again")
+    parser.add_argument("--prune", action="store_true", help="unset the embedded conferences after switching layout")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,498 @@
+# Datastore functions for STORAGE_LAYOUT=normalized.
+#
+# Locations stay in `locations`, but their conferences, presentations and attendee registrations
+# live in the `conferences`, `presentations` and `registrations` collections, linked by
+# location_id / conference_id. Reads reassemble the same nested models the embedded layout
+# returns, so the endpoints don't know which layout is in use. Conferences carry
+# attendee_count / presentation_count, which the capacity checks increment atomically.
+from datetime import datetime
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from common.cache import invalidate_location
+from common.database import db
+from common.jobs import enqueue
+from common.model import Fields
+from datastore import (CALENDAR_LOCATION_FIELDS, CALENDAR_PROJECTION, COUNTERS,
+                       EXPORT_BATCH_SIZE, EXPORT_CONFERENCE_PROJECTION,
+                       STATS_PROJECTION, calendar_filter, conference_filter,
+                       conference_locations,
+                       exported, handle_exceptions, insert_unordered,
+                       location_filter, read, registration_row, search_changed,
+                       search_documents, validate_presentation_update)
+from pydantic import ValidationError
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+from routes.models import Conference, ConferenceStats, Location, Presentation
+from starlette.exceptions import HTTPException
+
+__all__ = [
+    "location_all", "location_details", "location_delete",
+    "conference_create", "conference_bulk_create", "conference_all", "conference_details", "conference_stats", "conference_update",
+    "conference_delete", "conference_calendar",
+    "presentation_create", "presentation_all", "presentation_update", "presentation_delete",
+    "attendee_create", "attendee_delete", "attendees_all",
+    "export_conferences", "export_registrations",
+    "search_entries",
+]
+
+# Skips the embedded copies left in locations until migrate_normalized --prune removes them
+EMBEDDED = {"conferences": 0}
+
+# Attaches the presentations and attendee ids to conference documents
+CONFERENCE_CHILDREN = {
+    "presentations": [
+        {"$lookup": {"from": "presentations", "localField": "_id", "foreignField": "conference_id", "as": "presentations"}},
+    ],
+    "attendees": [
+        {"$lookup": {"from": "registrations", "localField": "_id", "foreignField": "conference_id", "as": "attendees"}},
+        {"$addFields": {"attendees": "$attendees.attendee_id"}},
+    ],
+}
+
+
+def conference_children(fields: Fields = None):
+    # Only the children a sparse fieldset asks for are looked up
+    return [stage for name, stages in CONFERENCE_CHILDREN.items() if fields is None or fields.includes(name)
+            for stage in stages]
+
+
+def location_projection(fields: Fields = None):
+    # The location's own fields; its conferences come from the conferences collection
+    if fields is None:
+        return EMBEDDED
+    return {path: 1 for path in fields.projection() if path.split(".")[0] != "conferences"}
+
+
+def conference_document(conference: Conference):
+    document = conference.dict(by_alias=True, exclude={"attendees", "presentations"})
+    document.update({"attendee_count": 0, "presentation_count": 0})
+    return document
+
+
+def below_capacity(count_field: str, max_field: str):
+    return {"$expr": {"$lt": [{"$ifNull": [f"${count_field}", 0]}, f"${max_field}"]}}
+
+
+async def location_ids(state: str = None, city: str = None):
+    return await db.locations.distinct("_id", location_filter(state, city))
+
+
+async def parent_query(location_id: str = None, conference_id: str = None, state: str = None, city: str = None):
+    # Filters for documents below a location, by their location_id / conference_id links
+    query = {}
+    if location_id:
+        query["location_id"] = ObjectId(location_id)
+    if conference_id:
+        query["conference_id"] = ObjectId(conference_id)
+    if state or city:
+        query.setdefault("$and", []).append({"location_id": {"$in": await location_ids(state, city)}})
+    return query
+
+
+async def find_page(collection: str, query: dict, after: ObjectId = None, limit: int = None, projection: dict = None):
+    if after:
+        query = {**query, "_id": {"$gt": after}}
+    cursor = db[collection].find(query, projection).sort("_id", 1)
+    if limit:
+        cursor = cursor.limit(limit)
+    async for document in cursor:
+        yield document
+
+
+def page_pipeline(query: dict, after: ObjectId = None, limit: int = None):
+    pipeline = [{"$match": {**query, "_id": {"$gt": after}} if after else query}, {"$sort": {"_id": 1}}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    return pipeline
+
+
+async def conference_documents(query: dict, after: ObjectId = None, limit: int = None, fields: Fields = None):
+    pipeline = page_pipeline(query, after, limit)
+    # The children are looked up after the page is cut, only for the conferences returned
+    pipeline.extend(conference_children(fields))
+    if fields:
+        pipeline.append({"$project": fields.projection("location_id")})
+    return [document async for document in db.conferences.aggregate(pipeline)]
+
+
+async def conferences_for(query: dict, after: ObjectId = None, limit: int = None, stats: bool = False,
+                          fields: Fields = None):
+    if stats:
+        pipeline = [*page_pipeline(query, after, limit), {"$project": STATS_PROJECTION}]
+        return [ConferenceStats.from_mongo(document) async for document in db.conferences.aggregate(pipeline)]
+    return read(await conference_documents(query, after, limit, fields), fields, Conference)
+
+
+async def with_conferences(locations: list, fields: Fields = None):
+    if fields and not fields.includes("conferences"):
+        return read(locations, fields)
+    conferences = await conference_documents({"location_id": {"$in": [location["_id"] for location in locations]}},
+                                             fields=fields and fields.nested("conferences"))
+    by_location = {}
+    for conference in conferences:
+        by_location.setdefault(conference["location_id"], []).append(conference)
+    return read([{**location, "conferences": by_location.get(location["_id"], [])} for location in locations],
+                fields, Location)
+
+
+async def location_all(after: ObjectId = None, limit: int = None, state: str = None, city: str = None,
+                       fields: Fields = None):
+    try:
+        locations = [location async for location in find_page("locations", location_filter(state, city), after, limit,
+                                                              location_projection(fields))]
+        return await with_conferences(locations, fields)
+    except (ValidationError, PyMongoError) as e:
+        handle_exceptions(e)
+
+
+async def location_details(location_id: str, fields: Fields = None):
+    try:
+        location = await db.locations.find_one({"_id": ObjectId(location_id)}, location_projection(fields))
+        if location is None:
+            raise HTTPException(status_code=400, detail="Location does not exist")
+        return (await with_conferences([location], fields))[0]
+    except (ValidationError, PyMongoError, InvalidId) as e:
+        handle_exceptions(e, location_id)
+
+
+async def location_delete(location_id: str):
+    try:
+        deleted_count = (await db.locations.delete_one({"_id": ObjectId(location_id)})).deleted_count
+        if deleted_count:
+            for collection in ("conferences", "presentations", "registrations"):
+                await db[collection].delete_many({"location_id": ObjectId(location_id)})
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        return deleted_count
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, location_id)
+
+
+async def conference_create(location_id: str, conference: Conference):
+    try:
+        conference.location_id = ObjectId(location_id)
+        if await db.locations.count_documents({"_id": ObjectId(location_id)}, limit=1) == 0:
+            raise HTTPException(status_code=400, detail="Location does not exist")
+        await db.conferences.insert_one(conference_document(conference))
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        return await conferences_for({"location_id": ObjectId(location_id)})
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, location_id, "conference")
+
+
+async def conference_bulk_create(conferences: list):
+    errors, by_location = await conference_locations(conferences)
+    indexes = sorted(index for group in by_location.values() for index in group)
+    failed = await insert_unordered("conferences", [conference_document(conferences[i]) for i in indexes], "conference")
+    errors.update({indexes[i]: error for i, error in failed.items()})
+    for location_id in by_location:
+        await invalidate_location(location_id)
+    await search_changed(*by_location)
+    return errors
+
+
+async def conference_all(after: ObjectId = None, limit: int = None, state: str = None, city: str = None,
+                         starts_after: datetime = None, starts_before: datetime = None, location_id: str = None,
+                         stats: bool = False, fields: Fields = None):
+    try:
+        query = {**await parent_query(location_id, state=state, city=city), **conference_filter(starts_after, starts_before)}
+        return await conferences_for(query, after, limit, stats, fields)
+    except (ValidationError, PyMongoError, InvalidId) as e:
+        handle_exceptions(e, model_name="conference")
+
+
+async def conference_calendar(ends_after: datetime = None, starts_before: datetime = None, after: tuple = None,
+                              limit: int = None, state: str = None, city: str = None):
+    # Served by the ends_starts index; the locations are only looked up for the page
+    query = {**await parent_query(state=state, city=city), **calendar_filter(ends_after, starts_before, after)}
+    pipeline = [
+        {"$match": query},
+        {"$sort": {"starts": 1, "_id": 1}},
+        *([{"$limit": limit}] if limit else []),
+        {"$lookup": {"from": "locations", "localField": "location_id", "foreignField": "_id", "as": "location"}},
+        {"$addFields": {"location": {
+            field: {"$arrayElemAt": [f"$location.{field}", 0]} for field in CALENDAR_LOCATION_FIELDS
+        }}},
+        {"$project": CALENDAR_PROJECTION},
+    ]
+    try:
+        return [{"id": conference.pop("_id"), **conference} async for conference in db.conferences.aggregate(pipeline)]
+    except PyMongoError as e:
+        handle_exceptions(e, model_name="conference")
+
+
+async def conference_details(location_id: str, conference_id: str, fields: Fields = None):
+    try:
+        conferences = await conferences_for({"_id": ObjectId(conference_id), "location_id": ObjectId(location_id)},
+                                            fields=fields)
+        if conferences:
+            return conferences[0]
+        raise HTTPException(status_code=400, detail="Conference does not exist")
+    except (PyMongoError, InvalidId, ValidationError) as e:
+        handle_exceptions(e, conference_id, "conference")
+
+
+async def conference_stats(conference_id: str):
+    try:
+        if conferences := await conferences_for({"_id": ObjectId(conference_id)}, stats=True):
+            return conferences[0]
+        raise HTTPException(status_code=400, detail="Conference does not exist")
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, conference_id, "conference")
+
+
+async def conference_update(location_id: str, conference_id: str, update_fields: dict):
+    if COUNTERS.keys() & update_fields.keys():
+        raise HTTPException(status_code=400, detail=f"{', '.join(COUNTERS)} can't be updated")
+    if update_fields.get("location_id"):
+        update_fields.update({"location_id": ObjectId(update_fields["location_id"])})
+    try:
+        result = await db.conferences.update_one(
+            {"_id": ObjectId(conference_id), "location_id": ObjectId(location_id)},
+            {"$set": update_fields},
+        )
+        if result.modified_count > 0:
+            await invalidate_location(location_id)
+            if "location_id" in update_fields:
+                # The children follow the conference to its new location
+                for collection in ("presentations", "registrations"):
+                    await db[collection].update_many(
+                        {"conference_id": ObjectId(conference_id)},
+                        {"$set": {"location_id": update_fields["location_id"]}},
+                    )
+                await invalidate_location(update_fields["location_id"])
+                await search_changed(location_id)
+                location_id = update_fields["location_id"]
+            await search_changed(location_id)
+            return await conference_details(location_id, conference_id)
+        elif result.matched_count < 1:
+            raise HTTPException(status_code=400, detail="Conference does not exist")
+        else:
+            raise HTTPException(status_code=400, detail="No changes to conference")
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e)
+
+
+async def conference_delete(location_id: str, conference_id: str):
+    try:
+        result = await db.conferences.delete_one({"_id": ObjectId(conference_id), "location_id": ObjectId(location_id)})
+        if result.deleted_count == 0:
+            if await db.locations.count_documents({"_id": ObjectId(location_id)}, limit=1) == 0:
+                raise HTTPException(status_code=400, detail="Location does not exist")
+            return 0
+        for collection in ("presentations", "registrations"):
+            await db[collection].delete_many({"conference_id": ObjectId(conference_id)})
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        return result.deleted_count
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e)
+
+
+async def presentation_create(location_id: str, conference_id: str, presentation: Presentation):
+    try:
+        presentation.location_id = ObjectId(location_id)
+        presentation.conference_id = ObjectId(conference_id)
+        # Takes a slot first; the presentation is only inserted if the limit allowed it
+        slot = await db.conferences.find_one_and_update(
+            {"_id": ObjectId(conference_id), "location_id": ObjectId(location_id),
+             **below_capacity("presentation_count", "max_presentations")},
+            {"$inc": {"presentation_count": 1}},
+            projection={"_id": 1},
+        )
+        if slot is None:
+            await conference_details(location_id, conference_id)
+            raise HTTPException(status_code=409, detail="Conference is not accepting more presentations")
+        try:
+            await db.presentations.insert_one(presentation.dict(by_alias=True))
+        except PyMongoError:
+            await db.conferences.update_one({"_id": ObjectId(conference_id)}, {"$inc": {"presentation_count": -1}})
+            raise
+
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        await enqueue("user_add_presentation", user_id=presentation.presenter, presentation_id=presentation.id)
+        return presentation, await conference_details(location_id, conference_id)
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, conference_id, "presentation")
+
+
+async def presentation_all(after: ObjectId = None, limit: int = None, state: str = None, city: str = None,
+                           status: str = None, location_id: str = None, conference_id: str = None,
+                           presentation_id: str = None, fields: Fields = None):
+    try:
+        query = await parent_query(location_id, conference_id, state, city)
+        if status:
+            query["status"] = status
+        if presentation_id:
+            query["_id"] = ObjectId(presentation_id)
+        documents = find_page("presentations", query, after, limit, fields.projection() if fields else None)
+        return read([document async for document in documents], fields, Presentation)
+    except (ValidationError, PyMongoError, InvalidId) as e:
+        handle_exceptions(e, model_name="presentation")
+
+
+async def presentation_update(location_id: str, conference_id: str, presentation_id:str, presentation: dict):
+    validate_presentation_update(presentation)
+    try:
+        result = await db.presentations.find_one_and_update(
+            {"_id": ObjectId(presentation_id), "conference_id": ObjectId(conference_id), "location_id": ObjectId(location_id)},
+            {"$set": {**presentation, "updated": datetime.now()}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if result is None:
+            raise HTTPException(status_code=400, detail="Presentation does not exist")
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        return Presentation.from_mongo(result)
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, presentation_id, "presentation")
+
+
+async def presentation_delete(location_id: str, conference_id: str, presentation_id: str):
+    try:
+        deleted = await db.presentations.find_one_and_delete(
+            {"_id": ObjectId(presentation_id), "conference_id": ObjectId(conference_id), "location_id": ObjectId(location_id)},
+            projection={"presenter": 1},
+        )
+        if deleted is None:
+            return 0
+        await db.conferences.update_one({"_id": ObjectId(conference_id)}, {"$inc": {"presentation_count": -1}})
+        await invalidate_location(location_id)
+        await search_changed(location_id)
+        await enqueue("user_remove_presentation", user_id=deleted["presenter"], presentation_id=ObjectId(presentation_id))
+        return 1
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, presentation_id)
+
+
+async def attendee_create(location_id: str, conference_id: str, attendee_id: ObjectId):
+    try:
+        # Contention is on the counter of one small conference document, not on the whole location
+        seat = await db.conferences.find_one_and_update(
+            {"_id": ObjectId(conference_id), "location_id": ObjectId(location_id),
+             **below_capacity("attendee_count", "max_attendees")},
+            {"$inc": {"attendee_count": 1}},
+            projection={"_id": 1},
+        )
+        if seat is None:
+            await conference_details(location_id, conference_id)
+            raise HTTPException(status_code=409, detail="Conference is full")
+        try:
+            # The unique (conference_id, attendee_id) index rejects a second registration
+            await db.registrations.insert_one({
+                "conference_id": ObjectId(conference_id),
+                "location_id": ObjectId(location_id),
+                "attendee_id": ObjectId(attendee_id),
+                "created": datetime.now(),
+            })
+        except PyMongoError as e:
+            await db.conferences.update_one({"_id": ObjectId(conference_id)}, {"$inc": {"attendee_count": -1}})
+            if isinstance(e, DuplicateKeyError):
+                raise HTTPException(status_code=400, detail="Already registered for this conference")
+            raise
+
+        await invalidate_location(location_id)
+        await enqueue("user_add_conference", user_id=ObjectId(attendee_id), conference_id=ObjectId(conference_id))
+        return await conference_details(location_id, conference_id)
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, conference_id, "conference")
+
+
+async def attendee_delete(location_id: str, conference_id: str, attendee_id: str):
+    try:
+        result = await db.registrations.delete_one({
+            "conference_id": ObjectId(conference_id), "location_id": ObjectId(location_id), "attendee_id": ObjectId(attendee_id),
+        })
+        if result.deleted_count == 0:
+            return 0
+        await db.conferences.update_one({"_id": ObjectId(conference_id)}, {"$inc": {"attendee_count": -1}})
+        await invalidate_location(location_id)
+        await enqueue("user_remove_conference", user_id=ObjectId(attendee_id), conference_id=ObjectId(conference_id))
+        return 1
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e, attendee_id)
+
+
+async def attendee_page(query: dict, limit: int = None):
+    # The first `limit` distinct attendee ids, read in attendee_id order (see the registrations
+    # indexes in indexes.py) and only until the page is full
+    ids = []
+    cursor = db.registrations.find(query, {"_id": 0, "attendee_id": 1}).sort("attendee_id", 1)
+    async for registration in cursor:
+        if not ids or ids[-1] != registration["attendee_id"]:
+            if limit and len(ids) == limit:
+                break
+            ids.append(registration["attendee_id"])
+    await cursor.close()
+    return ids
+
+
+async def attendees_all(after: ObjectId = None, limit: int = None, state: str = None, city: str = None,
+                        location_id: str = None, conference_id: str = None, attendee_id: str = None):
+    try:
+        query = await parent_query(location_id, conference_id, state, city)
+        if attendee_id:
+            query["attendee_id"] = ObjectId(attendee_id)
+        elif after:
+            query["attendee_id"] = {"$gt": after}
+        # Only the page's attendees are grouped, instead of every registration
+        query["attendee_id"] = {"$in": await attendee_page(query, limit)}
+        pipeline = [
+            {"$match": query},
+            {"$group": {"_id": "$attendee_id", "conference_ids": {"$push": "$conference_id"}}},
+            {"$sort": {"_id": 1}},
+            {"$lookup": {"from": "conferences", "localField": "conference_ids", "foreignField": "_id", "as": "conferences"}},
+            {"$lookup": {"from": "users", "localField": "_id", "foreignField": "_id", "as": "user"}},
+            {"$project": {
+                "_id": 0,
+                "id": {"$toString": "$_id"},
+                "name": {"$arrayElemAt": ["$user.name", 0]},
+                "conferences": {"$map": {
+                    "input": "$conferences",
+                    "in": {"id": {"$toString": "$$this._id"}, "name": "$$this.name"},
+                }},
+            }},
+        ]
+        return [attendee async for attendee in db.registrations.aggregate(pipeline)]
+    except (PyMongoError, InvalidId) as e:
+        handle_exceptions(e)
+
+
+async def export_conferences(state: str = None, city: str = None):
+    cursor = db.conferences.aggregate(
+        [{"$match": await parent_query(state=state, city=city)}, {"$project": EXPORT_CONFERENCE_PROJECTION}],
+        allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE,
+    )
+    async for conference in exported(cursor):
+        yield conference
+
+
+async def export_registrations(state: str = None, city: str = None):
+    pipeline = [
+        {"$match": await parent_query(state=state, city=city)},
+        {"$lookup": {"from": "conferences", "localField": "conference_id", "foreignField": "_id", "as": "conference"}},
+        {"$unwind": "$conference"},
+        {"$lookup": {"from": "users", "localField": "attendee_id", "foreignField": "_id", "as": "user"}},
+        {"$project": registration_row("$location_id", "$conference", "$attendee_id")},
+    ]
+    async for registration in exported(db.registrations.aggregate(pipeline, allowDiskUse=True, batchSize=EXPORT_BATCH_SIZE)):
+        yield registration
+
+
+async def search_entries(location_id: ObjectId):
+    location = await db.locations.find_one({"_id": location_id}, {"state": 1, "city": 1})
+    if location is None:
+        return []
+    presentations = {}
+    async for presentation in db.presentations.find({"location_id": location_id},
+                                                    {"conference_id": 1, "title": 1, "synopsis": 1, "status": 1}):
+        presentations.setdefault(presentation["conference_id"], []).append(presentation)
+    location["conferences"] = [
+        {**conference, "presentations": presentations.get(conference["_id"], [])}
+        async for conference in db.conferences.find({"location_id": location_id},
+                                                    {"name": 1, "description": 1, "starts": 1, "ends": 1})
+    ]
+    return search_documents(location)
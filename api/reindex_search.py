@@ -0,0 +1,33 @@
+# Rebuilds the `search` collection from the conferences and presentations of every location.
+# Needed once for data written before search existed, or loaded straight into Mongo; every
+# write since reindexes its location in the background (datastore.search_reindex).
+#
+#   python -m reindex_search
+import asyncio
+import sys
+
+import datastore as ds
+from common.database import close, db
+
+
+async def reindex():
+    documents, location_ids = 0, []
+    async for location in db.locations.find({}, {"_id": 1}):
+        documents += await ds.search_reindex(location["_id"])
+        location_ids.append(location["_id"])
+    # Leftovers of locations deleted while no job runner was around to reindex them
+    await db[ds.SEARCH].delete_many({"location_id": {"$nin": location_ids}})
+    return documents, len(location_ids)
+
+
+async def main():
+    try:
+        documents, locations = await reindex()
+        print(f"indexed {documents} conferences and presentations of {locations} locations")
+        return 0
+    finally:
+        close()
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -1,34 +1,92 @@
 import json
-from datetime import datetime
+from datetime import date, datetime, time, timedelta
 
 import datastore as ds
+import settings
+from common.cache import cached
 from common.constants import US_STATES
+from common.etag import conditional
+from common.jobs import enqueue, job
+from common.model import Fields
 from common.json import PydanticJSONResponse
+from common.ndjson import ndjson_chunks
+from common.pagination import (keyset_after, keyset_next, limit_param,
+                               next_after, page_params)
+from importer import FORMATS, IMPORTS, run_import
 from pydantic import ValidationError
 from routes.models import Conference, Location, Presentation, User
 from starlette.authentication import requires
 from starlette.exceptions import HTTPException
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, StreamingResponse
 
 from .third_party import get_photo
 
 
+def date_param(request: Request, name: str):
+    if (value := request.query_params.get(name)) is None:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: expected YYYY-MM-DD")
+
+
+def flag_param(request: Request, name: str):
+    return request.query_params.get(name, "").lower() in ("1", "true", "yes")
+
+
+def fields_param(request: Request, model):
+    # `?fields=id,name,conferences.name`: only these are read from Mongo and returned
+    if not (value := request.query_params.get("fields")):
+        return None
+    try:
+        return Fields(model, [path.strip() for path in value.split(",") if path.strip()])
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def location_params(request: Request):
+    return {"state": request.query_params.get("state"), "city": request.query_params.get("city")}
+
+
+EXPORTS = ("locations", "conferences", "registrations")
+
+
 # States
+@conditional
+@cached("states")
 async def list_states(request: Request):
     return JSONResponse(status_code=200, content={"states": US_STATES})
 
 
 # Locations
+@conditional
+@cached("locations")
 async def list_locations(request: Request):
-    locations = await ds.location_all()
-    return PydanticJSONResponse(status_code=200, content={"locations": locations})
+    after, limit = page_params(request)
+    locations = await ds.location_all(after, limit, **location_params(request), fields=fields_param(request, Location))
+    return PydanticJSONResponse(status_code=200, content={"locations": locations, "next": next_after(locations, limit)})
+
+
+@job("fill_location_photo")
+async def fill_location_photo(location_id, city, state):
+    photo = await get_photo(city, state)
+    if photo["picture_url"]:
+        await ds.location_set_photo(location_id, photo["picture_url"])
 
 
 async def create_location(request: Request):
     content = await request.json()
     if content.get("state", "_").title() in US_STATES:
         content["state"] = {"name": content["state"], "abbreviation": US_STATES[content["state"]]}
+        if settings.PHOTO_LOOKUP == "background":
+            location = Location(**content)
+            new_location = await ds.location_create(location)
+            await enqueue("fill_location_photo", location_id=new_location.id,
+                          city=location.city, state=location.state.abbreviation)
+            return PydanticJSONResponse(status_code=201, content=new_location)
+
         photo = await get_photo(content["city"], content["state"]["abbreviation"])
         content.update(photo)
         location = Location(**content)
@@ -38,9 +96,11 @@ async def create_location(request: Request):
         raise HTTPException(status_code=400, detail=f"Invalid state: {content.get('state')}")
 
 
+@conditional
+@cached("location:{location_id}")
 async def show_location(request: Request):
     location_id = request.path_params["location_id"]
-    location = await ds.location_details(location_id)
+    location = await ds.location_details(location_id, fields_param(request, Location))
     return PydanticJSONResponse(status_code=200, content=location)
 
 
@@ -58,14 +118,49 @@ async def delete_location(request: Request):
 
 
 # Conferences
+@conditional
+@cached("conferences", "location:{location_id}")
 async def list_conferences(request: Request):
     location_id = request.path_params.get("location_id")
-    if location_id:
-        location = await ds.location_details(location_id)
-        return PydanticJSONResponse(status_code=200, content={"conferences": location.conferences})
-    else:
-        conferences = await ds.conference_all()
-        return PydanticJSONResponse(status_code=200, content={"conferences": conferences})
+    after, limit = page_params(request)
+    stats, fields = flag_param(request, "stats"), fields_param(request, Conference)
+    if stats and fields:
+        raise HTTPException(status_code=400, detail="fields can't be combined with stats")
+    conferences = await ds.conference_all(
+        after, limit, **location_params(request),
+        starts_after=date_param(request, "starts_after"),
+        starts_before=date_param(request, "starts_before"),
+        location_id=location_id,
+        stats=stats,
+        fields=fields,
+    )
+    return PydanticJSONResponse(status_code=200, content={"conferences": conferences, "next": next_after(conferences, limit)})
+
+
+@conditional
+@cached("conferences")
+async def conference_calendar(request: Request):
+    # Conferences running at any point from `from` (today by default) through `to`, or the
+    # next `days` days, by start date
+    date_from = date_param(request, "from") or datetime.combine(date.today(), time())
+    date_to = date_param(request, "to")
+    if date_to is None and (days := request.query_params.get("days")):
+        if not days.isdigit():
+            raise HTTPException(status_code=400, detail="Invalid days")
+        date_to = date_from + timedelta(days=int(days))
+    limit = limit_param(request)
+    conferences = await ds.conference_calendar(
+        ends_after=date_from, starts_before=date_to + timedelta(days=1) if date_to else None,
+        after=keyset_after(request, datetime.fromisoformat), limit=limit, **location_params(request),
+    )
+    return PydanticJSONResponse(status_code=200, content={"conferences": conferences, "next": keyset_next(conferences, limit, "starts")})
+
+
+@conditional
+@cached("conferences")
+async def show_conference_stats(request: Request):
+    stats = await ds.conference_stats(request.path_params["conference_id"])
+    return PydanticJSONResponse(status_code=200, content=stats)
 
 
 async def create_conference(request: Request):
@@ -76,16 +171,16 @@ async def create_conference(request: Request):
     })
     conference = Conference(**content)
     location_id = request.path_params["location_id"]
-    location = await ds.location_details(location_id)
-    if (added := await location.add_conference(conference)):
-        updated_location = await ds.location_details(location_id)
-        return PydanticJSONResponse(status_code=201, content=updated_location.conferences)
+    conferences = await ds.conference_create(location_id, conference)
+    return PydanticJSONResponse(status_code=201, content=conferences)
 
 
+@conditional
+@cached("location:{location_id}")
 async def show_conference(request: Request):
     location_id = request.path_params["location_id"]
     conference_id = request.path_params["conference_id"]
-    conference = await ds.conference_details(location_id, conference_id)
+    conference = await ds.conference_details(location_id, conference_id, fields_param(request, Conference))
     return PydanticJSONResponse(status_code=200, content=conference)
 
 
@@ -104,15 +199,16 @@ async def delete_conference(request: Request):
     return JSONResponse(status_code=200, content={"deleted": deleted_count > 0})
 
 # Presentations
+@conditional
 async def list_presentations(request: Request):
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
-    if location_id and conference_id:
-        conference = await ds.conference_details(location_id, conference_id)
-        return PydanticJSONResponse(status_code=200, content=conference.presentations)
-    else:
-        presentations = await ds.presentation_all()
-        return PydanticJSONResponse(status_code=200, content=[Presentation(**presentation) for presentation in presentations])
+    after, limit = page_params(request)
+    presentations = await ds.presentation_all(
+        after, limit, **location_params(request), status=request.query_params.get("status"),
+        location_id=location_id, conference_id=conference_id, fields=fields_param(request, Presentation),
+    )
+    return PydanticJSONResponse(status_code=200, content={"presentations": presentations, "next": next_after(presentations, limit)})
 
 @requires(["authenticated", "admin"])
 async def create_presentation(request: Request):
@@ -125,26 +221,22 @@ async def create_presentation(request: Request):
 
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
-    conference = await ds.conference_details(location_id, conference_id)
-
-    if (await conference.add_presentation(presentation)):
-        conference = await ds.conference_details(location_id, conference_id)
-        presentation_id = conference.presentations[-1].id
-
-        if (await request.user.add_presentation(presentation_id)):
-            conference = await ds.conference_details(location_id, conference_id)
-            return PydanticJSONResponse(status_code=201, content=conference)
+    presentation, conference = await ds.presentation_create(location_id, conference_id, presentation)
+    return PydanticJSONResponse(status_code=201, content=conference)
 
 
+@conditional
 async def show_presentation(request: Request):
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
     presentation_id = request.path_params.get("presentation_id")
 
-    presentation = await ds.presentation_details(location_id, conference_id, presentation_id)
+    presentation = await ds.presentation_details(location_id, conference_id, presentation_id,
+                                                 fields_param(request, Presentation))
     return PydanticJSONResponse(status_code=200, content=presentation)
 
 
+@requires(["authenticated", "admin"])
 async def update_presentation(request: Request):
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
@@ -155,44 +247,102 @@ async def update_presentation(request: Request):
     return PydanticJSONResponse(status_code=200, content=presentation)
 
 
+@requires(["authenticated", "admin"])
 async def delete_presentation(request: Request):
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
     presentation_id = request.path_params.get("presentation_id")
-    pass
+    deleted_count = await ds.presentation_delete(location_id, conference_id, presentation_id)
+    return JSONResponse(status_code=200, content={"deleted": deleted_count > 0})
 
 
 # Attendees
+@conditional
 async def list_attendees(request: Request):
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
-    conference = await ds.conference_details(location_id, conference_id)
-    return PydanticJSONResponse(status_code=200, content=conference.attendees)
+    after, limit = page_params(request)
+    attendees = await ds.attendees_all(
+        after, limit, **location_params(request), location_id=location_id, conference_id=conference_id
+    )
+    return JSONResponse(status_code=200, content={"attendees": attendees, "next": next_after(attendees, limit)})
 
 
 @requires(["authenticated"])
 async def create_attendee(request: Request):
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
-    conference = await ds.conference_details(location_id, conference_id)
-
-    if (await conference.add_attendee(request.user.id)):
-        if (await request.user.add_conference(conference_id)):
-            conference = await ds.conference_details(location_id, conference_id)
-            return PydanticJSONResponse(status_code=201, content=conference)
+    conference = await ds.attendee_create(location_id, conference_id, request.user.id)
+    return PydanticJSONResponse(status_code=201, content=conference)
 
 
+@conditional
 async def show_attendee(request: Request, id: str = None):
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
     attendee_id = request.path_params.get("attendee_id")
 
     attendee = await ds.attendee_details(location_id, conference_id, attendee_id)
-    return PydanticJSONResponse(status_code=200, content=attendee)
+    return JSONResponse(status_code=200, content=attendee)
 
 
+@requires(["authenticated"])
 async def delete_attendee(request: Request, id: str = None):
     location_id = request.path_params.get("location_id")
     conference_id = request.path_params.get("conference_id")
     attendee_id = request.path_params.get("attendee_id")
-    pass
+    # Attendees can cancel their own registration, admins anyone's
+    if attendee_id != str(request.user.id) and "admin" not in request.auth.scopes:
+        raise HTTPException(status_code=403, detail="Not allowed to remove this attendee")
+    deleted_count = await ds.attendee_delete(location_id, conference_id, attendee_id)
+    return JSONResponse(status_code=200, content={"deleted": deleted_count > 0})
+
+
+# Exports
+@requires(["authenticated", "admin"])
+async def export_data(request: Request):
+    kind = request.path_params["kind"]
+    if kind not in EXPORTS:
+        raise HTTPException(status_code=404, detail=f"Unknown export {kind}, expected one of {', '.join(EXPORTS)}")
+    compress = flag_param(request, "gzip")
+    rows = getattr(ds, f"export_{kind}")(**location_params(request))
+    filename = f"{kind}.ndjson.gz" if compress else f"{kind}.ndjson"
+    # A Mongo error once rows have gone out ends the body with an {"error": ...} line, see common/ndjson.py
+    return StreamingResponse(
+        ndjson_chunks(rows, compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+# Imports
+def import_format(request: Request):
+    format = request.query_params.get("format")
+    if format is None:
+        format = "csv" if request.headers.get("content-type", "").startswith("text/csv") else "ndjson"
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format {format}, expected one of {', '.join(FORMATS)}")
+    return format
+
+
+@requires(["authenticated", "admin"])
+async def import_data(request: Request):
+    kind = request.path_params["kind"]
+    if kind not in IMPORTS:
+        raise HTTPException(status_code=404, detail=f"Unknown import {kind}, expected one of {', '.join(IMPORTS)}")
+    report = await run_import(kind, await request.body(), import_format(request))
+    # 207 when some rows were rejected, their line numbers and errors are in the report
+    return JSONResponse(status_code=207 if report["errors"] else 200, content=report)
+
+
+# Search
+@conditional
+async def search(request: Request):
+    if not (text := request.query_params.get("q", "").strip()):
+        raise HTTPException(status_code=400, detail="q is required")
+    if (kind := request.query_params.get("type")) and kind not in ds.SEARCH_KINDS:
+        raise HTTPException(status_code=400, detail=f"Invalid type {kind}, expected one of {', '.join(ds.SEARCH_KINDS)}")
+    limit = limit_param(request)
+    results = await ds.search(text, keyset_after(request, float), limit, **location_params(request),
+                              status=request.query_params.get("status"), kind=kind)
+    return PydanticJSONResponse(status_code=200, content={"results": results, "next": keyset_next(results, limit, "score")})
@@ -1,5 +1,4 @@
 import json
-import os
 from datetime import datetime
 from enum import Enum
 from typing import List, Optional
@@ -9,19 +8,8 @@ from bson import ObjectId
 from common.constants import US_STATES, Status
 from common.model import BaseMongoModel
 from pydantic import BaseModel, Field
-from pymongo import MongoClient
 from starlette.authentication import SimpleUser
 
-MONGO_DB_CONNECTION_STRING = os.environ["MONGO_DB_CONNECTION_STRING"]
-MONGO_DB_NAME = os.environ["MONGO_DB_NAME"]
-
-url = MONGO_DB_CONNECTION_STRING
-db_name = MONGO_DB_NAME
-
-client = MongoClient(url)
-db = client[db_name]
-
-
 
 class AuthenticatedUser(SimpleUser):
     def __init__(self, payload: dict):
@@ -45,21 +33,6 @@ class User(BaseMongoModel):
         if authenticated:
             self.auth_profile = AuthenticatedUser(user)
 
-    async def add_presentation(self, presentation_id: ObjectId):
-        filter_criteria = {"_id": ObjectId(self.id)}
-        update_query = {"$push": {"presentations": ObjectId(presentation_id)}}
-
-        result = db.users.update_one(filter_criteria, update_query)
-        return result.modified_count > 0
-
-    async def add_conference(self, conference_id: ObjectId):
-        filter_criteria = {"_id": ObjectId(self.id)}
-        update_query = {"$push": {"conferences": ObjectId(conference_id)}}
-
-        result = db.users.update_one(filter_criteria, update_query)
-
-        return result.modified_count > 0
-
 
 # Model class representing a state
 class State(BaseModel):
@@ -89,36 +62,63 @@ class Conference(BaseMongoModel):
     presentations: List[Presentation] = Field(default_factory=list)
     location_id: Optional[ObjectId] = Field(default_factory=None)
 
-    async def add_attendee(self, attendee_id: str):
-        filter_criteria = {"_id": ObjectId(self.location_id), "conferences._id": ObjectId(self.id)}
-        update_query = {"$push": {"conferences.$.attendees": ObjectId(attendee_id)}}
-
-        result = db.locations.update_one(filter_criteria, update_query)
-
-        return result.modified_count == 1
+    @staticmethod
+    def capacity_filter(location_id, conference_id, field: str, max_field: str, **conference_match):
+        # Matches the location only while the conference's `field` array is shorter than its
+        # `max_field`, so a single $push on it is an atomic, capacity-checked insert.
+        conference = {"$arrayElemAt": [
+            {"$filter": {"input": "$conferences", "cond": {"$eq": ["$$this._id", ObjectId(conference_id)]}}}, 0
+        ]}
+        return {
+            "_id": ObjectId(location_id),
+            "conferences": {"$elemMatch": {"_id": ObjectId(conference_id), **conference_match}},
+            "$expr": {"$let": {
+                "vars": {"conference": conference},
+                "in": {"$lt": [{"$size": {"$ifNull": [f"$$conference.{field}", []]}}, f"$$conference.{max_field}"]},
+            }},
+        }
+
+    @classmethod
+    def registration_filter(cls, location_id, conference_id, attendee_id):
+        # A free seat, and the attendee isn't registered yet. Only conferences that have their counter
+        # match, see datastore.init_counters.
+        return cls.capacity_filter(
+            location_id, conference_id, "attendees", "max_attendees",
+            attendees={"$ne": ObjectId(attendee_id)}, attendee_count={"$exists": True},
+        )
+
+    @classmethod
+    def submission_filter(cls, location_id, conference_id):
+        return cls.capacity_filter(
+            location_id, conference_id, "presentations", "max_presentations", presentation_count={"$exists": True}
+        )
+
+
+# Counters of a conference, read without loading its attendees and presentations
+class ConferenceStats(BaseModel):
+    id: ObjectId = Field(..., alias="_id")
+    location_id: Optional[ObjectId]
+    name: str
+    starts: datetime
+    ends: datetime
+    max_attendees: int
+    attendee_count: int
+    max_presentations: int
+    presentation_count: int
+
+    @classmethod
+    def from_mongo(cls, document: dict):
+        return cls.construct(**{name: document.get(field.alias) for name, field in cls.__fields__.items()})
+
+    class Config:
+        arbitrary_types_allowed = True
 
-    async def add_presentation(self, presentation: Presentation):
-        presentation.conference_id = ObjectId(self.id)
-        presentation.location_id = ObjectId(self.location_id)
-
-        filter_criteria = {"_id": ObjectId(self.location_id), "conferences._id": ObjectId(self.id)}
-        update_query = {"$push": {"conferences.$.presentations": presentation.dict(by_alias=True)}}
-        result = db.locations.update_one(filter_criteria, update_query)
-        return result.modified_count == 1
 
     # Model class representing a location
 class Location(BaseMongoModel):
     name: str = Field(..., example="Location name")
     city: str = Field(..., example="City name")
     room_count: int = Field(..., example=5)
-    picture_url: str = Field(..., example="https://example.com/location-picture.jpg")
+    picture_url: Optional[str] = Field(None, example="https://example.com/location-picture.jpg")
     state: State = Field(..., example={"name": "State name", "abbreviation": "State abbreviation"})
     conferences: List[Conference] = Field(default_factory=list)
-
-    async def add_conference(self, conference: Conference):
-        conference.location_id = ObjectId(self.id)
-        filter_criteria = {"_id": ObjectId(self.id)}
-        update_query = {"$push": {"conferences": conference.dict(by_alias=True)}}
-
-        result = db.locations.update_one(filter_criteria, update_query)
-        return result.modified_count == 1
@@ -1,20 +1,84 @@
-import json
-import os
+from datetime import datetime, timedelta
+from typing import Optional
 
-import requests
+import httpx
+import settings
+from common.database import db
 
-PEXELS_API_KEY = os.environ["PEXELS_API_KEY"]
+PHOTO_CACHE = "photo_cache"
 
-async def get_photo(city, state):
-    headers = {"Authorization": PEXELS_API_KEY}
+client: Optional[httpx.AsyncClient] = None
+
+
+def create_client(transport: Optional[httpx.AsyncBaseTransport] = None) -> httpx.AsyncClient:
+    # A client configured from settings. `transport` replaces the network, e.g. with an
+    # httpx.MockTransport; the worker's client is then set with use_client().
+    return httpx.AsyncClient(
+        base_url=settings.PEXELS_API_URL,
+        headers={"Authorization": settings.PEXELS_API_KEY or ""},
+        timeout=httpx.Timeout(settings.PEXELS_TIMEOUT_SECONDS),
+        limits=httpx.Limits(max_connections=settings.PEXELS_MAX_CONNECTIONS,
+                            max_keepalive_connections=settings.PEXELS_MAX_CONNECTIONS),
+        transport=transport,
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    # One pooled client per worker instead of a new connection per lookup
+    global client
+    if client is None:
+        client = create_client()
+    return client
+
+
+async def use_client(new_client: Optional[httpx.AsyncClient]):
+    # Replaces the worker's client, closing the one it had
+    global client
+    await close_client()
+    client = new_client
+
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+async def fetch_photo(city, state) -> Optional[str]:
     params = {
         "per_page": 1,
         "query": f"downtown {city} {state}",
     }
-    url = "https://api.pexels.com/v1/search"
-    response = requests.get(url, params=params, headers=headers)
-    content = json.loads(response.content)
+    response = await get_client().get("/search", params=params)
+    response.raise_for_status()
+    content = response.json()
     try:
-        return {"picture_url": content["photos"][0]["src"]["original"]}
+        return content["photos"][0]["src"]["original"]
     except (KeyError, IndexError):
+        return None
+
+
+async def get_photo(city, state):
+    if not settings.PEXELS_API_KEY:
         return {"picture_url": None}
+
+    key = f"{city.strip().lower()}|{state.strip().lower()}"
+    now = datetime.utcnow()
+    if (cached := await db[PHOTO_CACHE].find_one({"_id": key, "expires": {"$gt": now}})) is not None:
+        return {"picture_url": cached["picture_url"]}
+
+    try:
+        picture_url = await fetch_photo(city, state)
+    except (httpx.HTTPError, ValueError):
+        # Timeouts and API errors aren't cached, the next location for this city tries again
+        return {"picture_url": None}
+
+    # "No photo" is cached too, for a shorter time, so unknown cities don't hit the API every time
+    ttl = settings.PHOTO_CACHE_TTL_SECONDS if picture_url else settings.PHOTO_NEGATIVE_CACHE_TTL_SECONDS
+    await db[PHOTO_CACHE].replace_one(
+        {"_id": key},
+        {"picture_url": picture_url, "expires": now + timedelta(seconds=ttl)},
+        upsert=True,
+    )
+    return {"picture_url": picture_url}
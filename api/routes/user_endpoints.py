@@ -26,7 +26,7 @@ async def login(request):
     content =  await request.json()
     username = content.get("username")
     password = content.get("password")
-    db_user = credentials_match(username, password)
+    db_user = await credentials_match(username, password)
 
     if db_user:
         user = User(authenticated=True, **db_user)
@@ -1,6 +1,82 @@
 from starlette.config import Config
+from starlette.datastructures import CommaSeparatedStrings
 
 config = Config(".env")
-MONGODB_URL = config("MONGODB_URL", default="no-url")
-MONGO_DB = config("MONGO_DB")
-SESSION_SECRET_KEY = config("SESSION_SECRET_KEY")
+MONGO_DB_CONNECTION_STRING = config("MONGO_DB_CONNECTION_STRING", default="mongodb://localhost:27017")
+MONGO_DB_NAME = config("MONGO_DB_NAME", default="conference_go")
+SESSION_SECRET_KEY = config("SESSION_SECRET_KEY", default=None)
+
+# Mongo connection pool, shared by every datastore module (see common/database.py)
+MONGO_MAX_POOL_SIZE = config("MONGO_MAX_POOL_SIZE", cast=int, default=100)
+MONGO_MIN_POOL_SIZE = config("MONGO_MIN_POOL_SIZE", cast=int, default=0)
+MONGO_MAX_IDLE_TIME_MS = config("MONGO_MAX_IDLE_TIME_MS", cast=int, default=None)
+MONGO_CONNECT_TIMEOUT_MS = config("MONGO_CONNECT_TIMEOUT_MS", cast=int, default=5000)
+MONGO_SOCKET_TIMEOUT_MS = config("MONGO_SOCKET_TIMEOUT_MS", cast=int, default=None)
+MONGO_SERVER_SELECTION_TIMEOUT_MS = config("MONGO_SERVER_SELECTION_TIMEOUT_MS", cast=int, default=10000)
+MONGO_WAIT_QUEUE_TIMEOUT_MS = config("MONGO_WAIT_QUEUE_TIMEOUT_MS", cast=int, default=None)
+# e.g. "zstd,snappy,zlib"; zstd and snappy need their python packages installed
+MONGO_COMPRESSORS = config("MONGO_COMPRESSORS", cast=CommaSeparatedStrings, default="")
+# primary, primaryPreferred, secondary, secondaryPreferred or nearest
+MONGO_READ_PREFERENCE = config("MONGO_READ_PREFERENCE", default="primary")
+# Create the indexes in indexes.py on startup (also available as `python -m indexes`). A unique index
+# whose collection still has duplicates is skipped with a warning, not built, until they are cleaned up.
+MONGO_ENSURE_INDEXES = config("MONGO_ENSURE_INDEXES", cast=bool, default=True)
+
+# Response cache for the read endpoints: memory (an LRU per worker process), mongo (shared by every
+# worker, a round trip per hit) or none. Writes bump per-tag generation counters in Mongo, which each
+# worker rereads at most every CACHE_SYNC_SECONDS: that is how long another worker may serve a response
+# a write changed. The worker that made the write stops serving it at once.
+CACHE_BACKEND = config("CACHE_BACKEND", default="memory")
+CACHE_SYNC_SECONDS = config("CACHE_SYNC_SECONDS", cast=float, default=1.0)
+CACHE_MAX_ENTRIES = config("CACHE_MAX_ENTRIES", cast=int, default=1024)
+CACHE_TTL_SECONDS = config("CACHE_TTL_SECONDS", cast=int, default=60)
+
+# Response compression (common/compression.py): the encodings offered, most preferred first.
+# br needs the Brotli package and zstd the zstandard package (both in requirements.txt), and are skipped when
+# they aren't installed.
+# COMPRESSION= turns it off; bodies under COMPRESSION_MIN_SIZE bytes are sent uncompressed.
+COMPRESSION = config("COMPRESSION", cast=CommaSeparatedStrings, default="zstd,br,gzip")
+COMPRESSION_MIN_SIZE = config("COMPRESSION_MIN_SIZE", cast=int, default=1024)
+COMPRESSION_GZIP_LEVEL = config("COMPRESSION_GZIP_LEVEL", cast=int, default=6)
+COMPRESSION_BROTLI_QUALITY = config("COMPRESSION_BROTLI_QUALITY", cast=int, default=5)
+COMPRESSION_ZSTD_LEVEL = config("COMPRESSION_ZSTD_LEVEL", cast=int, default=3)
+# Keep the compressed bodies of cached responses, so a cache hit isn't compressed again
+COMPRESSION_CACHED_BODIES = config("COMPRESSION_CACHED_BODIES", cast=bool, default=True)
+
+# Per-route latency, response size and Mongo round-trip metrics on /metrics (common/metrics.py)
+METRICS_ENABLED = config("METRICS_ENABLED", cast=bool, default=True)
+
+# Request profiling (common/profiling.py): off, admin (?profile= / X-Profile: for admins) or all
+PROFILING = config("PROFILING", default="admin")
+PROFILE_DIR = config("PROFILE_DIR", default="profiles")
+
+# Verified JWTs kept per worker by auth_middleware.py, until their exp or at most AUTH_CACHE_TTL_SECONDS.
+# AUTH_CACHE_MAX_ENTRIES=0 verifies every request.
+AUTH_CACHE_MAX_ENTRIES = config("AUTH_CACHE_MAX_ENTRIES", cast=int, default=10000)
+AUTH_CACHE_TTL_SECONDS = config("AUTH_CACHE_TTL_SECONDS", cast=int, default=300)
+
+# Pexels photo lookup for new locations (routes/third_party.py)
+PEXELS_API_KEY = config("PEXELS_API_KEY", default=None)
+PEXELS_API_URL = config("PEXELS_API_URL", default="https://api.pexels.com/v1")
+PEXELS_TIMEOUT_SECONDS = config("PEXELS_TIMEOUT_SECONDS", cast=float, default=3.0)
+PEXELS_MAX_CONNECTIONS = config("PEXELS_MAX_CONNECTIONS", cast=int, default=10)
+PHOTO_CACHE_TTL_SECONDS = config("PHOTO_CACHE_TTL_SECONDS", cast=int, default=30 * 24 * 3600)
+PHOTO_NEGATIVE_CACHE_TTL_SECONDS = config("PHOTO_NEGATIVE_CACHE_TTL_SECONDS", cast=int, default=24 * 3600)
+# inline: look the photo up before inserting the location
+# background: insert first and fill picture_url in from a job (common/jobs.py)
+PHOTO_LOOKUP = config("PHOTO_LOOKUP", default="inline")
+
+# Background jobs (common/jobs.py). JOBS_WORKERS=0 only enqueues, for processes that shouldn't run them
+JOBS_WORKERS = config("JOBS_WORKERS", cast=int, default=4)
+JOBS_MAX_ATTEMPTS = config("JOBS_MAX_ATTEMPTS", cast=int, default=5)
+JOBS_BACKOFF_SECONDS = config("JOBS_BACKOFF_SECONDS", cast=float, default=2.0)
+JOBS_POLL_SECONDS = config("JOBS_POLL_SECONDS", cast=float, default=5.0)
+JOBS_LEASE_SECONDS = config("JOBS_LEASE_SECONDS", cast=float, default=60.0)
+
+# embedded: conferences, presentations and attendees live inside their location document
+# normalized: they have their own collections, see normalized_datastore.py and migrate_normalized.py
+STORAGE_LAYOUT = config("STORAGE_LAYOUT", default="embedded")
+# Answer writes to /api/ with a 503 and Retry-After while reads go on (common/maintenance.py), e.g. while
+# migrate_normalized.py makes its final copy before STORAGE_LAYOUT is switched
+WRITES_PAUSED = config("WRITES_PAUSED", cast=bool, default=False)
+WRITES_PAUSED_RETRY_SECONDS = config("WRITES_PAUSED_RETRY_SECONDS", cast=int, default=60)
@@ -0,0 +1,94 @@
+# Tests run against mongomock by default. Set TEST_MONGO_DB_CONNECTION_STRING to run them against a
+# real server instead, which the concurrency tests need to mean anything: mongomock applies every
+# write in one go. Each test gets an empty database that is dropped afterwards.
+#
+#   pip install -r requirements-test.txt
+#   python -m pytest -q
+import os
+from datetime import datetime
+
+import httpx
+import pytest
+
+os.environ.setdefault("SESSION_SECRET_KEY", "test-secret")
+os.environ.setdefault("PEXELS_API_KEY", "test-key")
+os.environ["MONGO_DB_NAME"] = os.environ.get("TEST_MONGO_DB_NAME", "conference_go_test")
+os.environ["CACHE_BACKEND"] = "none"
+os.environ["JOBS_WORKERS"] = "0"
+os.environ["MONGO_ENSURE_INDEXES"] = "false"
+
+import conference_go  # noqa: E402
+import datastore  # noqa: E402
+import normalized_datastore  # noqa: E402
+import settings  # noqa: E402
+from common import database  # noqa: E402
+from indexes import ensure_indexes  # noqa: E402
+from motor.motor_asyncio import AsyncIOMotorClient  # noqa: E402
+from normalized_datastore import conference_document  # noqa: E402
+from routes.models import Conference, Location  # noqa: E402
+
+LAYOUTS = {"embedded": datastore, "normalized": normalized_datastore}
+MONGOMOCK = not os.environ.get("TEST_MONGO_DB_CONNECTION_STRING")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "array_filters: the embedded layout's writes use arrayFilters, which "
+                                       "mongomock doesn't support; skipped there unless running on a server")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def db():
+    if MONGOMOCK:
+        from mongomock_motor import AsyncMongoMockClient
+        database.client = AsyncMongoMockClient()
+    else:
+        database.client = AsyncIOMotorClient(os.environ["TEST_MONGO_DB_CONNECTION_STRING"])
+    await database.client.drop_database(settings.MONGO_DB_NAME)
+    await ensure_indexes()
+    yield database.get_db()
+    await database.client.drop_database(settings.MONGO_DB_NAME)
+    database.close()
+
+
+@pytest.fixture(params=list(LAYOUTS))
+def layout(request, monkeypatch):
+    # The datastore functions of one storage layout
+    if request.param == "embedded" and MONGOMOCK and request.node.get_closest_marker("array_filters"):
+        pytest.skip("mongomock doesn't support arrayFilters")
+    monkeypatch.setattr(settings, "STORAGE_LAYOUT", request.param)
+    return request.param, LAYOUTS[request.param]
+
+
+def make_location(**fields) -> Location:
+    return Location(**{"name": "Javits Center", "city": "New York", "room_count": 10, "picture_url": "",
+                       "state": {"name": "New York", "abbreviation": "NY"}, **fields})
+
+
+def make_conference(location: Location, **fields) -> Conference:
+    return Conference(**{"name": "PyCon", "starts": datetime(2026, 5, 1), "ends": datetime(2026, 5, 3), "description": "Python",
+                         "max_presentations": 10, "max_attendees": 100, "location_id": location.id, **fields})
+
+
+@pytest.fixture
+def store(db, layout):
+    # Writes a location and its conferences the way the layout stores them
+    async def store(location: Location):
+        if layout[0] == "embedded":
+            await db.locations.insert_one(location.dict(by_alias=True))
+            return
+        await db.locations.insert_one(location.dict(by_alias=True, exclude={"conferences"}))
+        for conference in location.conferences:
+            await db.conferences.insert_one(conference_document(conference))
+    return store
+
+
+@pytest.fixture
+async def client(db):
+    # Requests straight to the app; the lifespan isn't run, so the test's database stays in place
+    async with httpx.AsyncClient(app=conference_go.app, base_url="http://localhost") as client:
+        yield client
@@ -0,0 +1,128 @@
+import asyncio
+
+import pytest
+from common import cache
+from pymongo.errors import DocumentTooLarge, ServerSelectionTimeoutError
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+pytestmark = pytest.mark.anyio
+
+
+class Worker:
+    # The cache state of one worker process; workers share only the database
+    def __init__(self):
+        self.backend = cache.MemoryCache(max_entries=100, ttl=60)
+        self.generations = cache.Generations(sync_seconds=0)
+
+    def use(self, monkeypatch):
+        monkeypatch.setattr(cache, "backend", self.backend)
+        monkeypatch.setattr(cache, "generations", self.generations)
+
+
+def make_request(location_id="1") -> Request:
+    return Request({"type": "http", "method": "GET", "path": f"/api/locations/{location_id}/",
+                    "query_string": b"", "headers": [], "path_params": {"location_id": location_id}})
+
+
+def make_endpoint(data: dict, reading: asyncio.Event = None, written: asyncio.Event = None):
+    # An endpoint serving data, which can stop halfway through its read until a write is made
+    @cache.cached("locations", "location:{location_id}")
+    async def endpoint(request):
+        body = dict(data)
+        if reading is not None:
+            reading.set()
+            await written.wait()
+        return JSONResponse(body)
+    return endpoint
+
+
+@pytest.fixture
+def worker(db, monkeypatch):
+    worker = Worker()
+    worker.use(monkeypatch)
+    return worker
+
+
+async def test_hit_until_invalidated(worker):
+    data = {"name": "Javits Center"}
+    endpoint = make_endpoint(data)
+
+    assert (await endpoint(make_request())).headers["X-Cache"] == "MISS"
+    assert (await endpoint(make_request())).headers["X-Cache"] == "HIT"
+
+    data["name"] = "Moscone Center"
+    await cache.invalidate_location("1")
+    response = await endpoint(make_request())
+    assert response.headers["X-Cache"] == "MISS"
+    assert b"Moscone Center" in response.body
+
+
+async def test_write_during_read_is_not_cached(worker):
+    data = {"name": "Javits Center"}
+    reading, written = asyncio.Event(), asyncio.Event()
+    endpoint = make_endpoint(data, reading, written)
+
+    async def write():
+        await reading.wait()
+        data["name"] = "Moscone Center"
+        await cache.invalidate_location("1")
+        written.set()
+
+    response, _ = await asyncio.gather(endpoint(make_request()), write())
+    assert b"Javits Center" in response.body
+
+    response = await make_endpoint(data)(make_request())
+    assert response.headers["X-Cache"] == "MISS"
+    assert b"Moscone Center" in response.body
+
+
+async def test_write_on_another_worker_invalidates(db, monkeypatch):
+    data = {"name": "Javits Center"}
+    endpoint = make_endpoint(data)
+    reader, writer = Worker(), Worker()
+
+    reader.use(monkeypatch)
+    await endpoint(make_request())
+    assert (await endpoint(make_request())).headers["X-Cache"] == "HIT"
+
+    writer.use(monkeypatch)
+    data["name"] = "Moscone Center"
+    await cache.invalidate_location("1")
+
+    reader.use(monkeypatch)
+    response = await endpoint(make_request())
+    assert response.headers["X-Cache"] == "MISS"
+    assert b"Moscone Center" in response.body
+
+
+async def test_other_locations_stay_cached(worker):
+    endpoint = make_endpoint({"name": "Javits Center"})
+    await endpoint(make_request("1"))
+    await endpoint(make_request("2"))
+
+    await cache.invalidate("location:1")
+
+    assert (await endpoint(make_request("1"))).headers["X-Cache"] == "MISS"
+    assert (await endpoint(make_request("2"))).headers["X-Cache"] == "HIT"
+
+
+async def test_cache_failures_serve_uncached(worker, monkeypatch):
+    endpoint = make_endpoint({"name": "Javits Center"})
+
+    async def unreachable(tags):
+        raise ServerSelectionTimeoutError("no servers")
+    monkeypatch.setattr(worker.generations, "current", unreachable)
+    response = await endpoint(make_request())
+    assert response.status_code == 200
+    assert "X-Cache" not in response.headers
+
+    monkeypatch.undo()
+    worker.use(monkeypatch)
+
+    async def too_large(key, value, tags):
+        raise DocumentTooLarge("too large")
+    monkeypatch.setattr(worker.backend, "set", too_large)
+    response = await endpoint(make_request())
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "MISS"
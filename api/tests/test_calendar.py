@@ -0,0 +1,67 @@
+from datetime import datetime
+
+import datastore
+import pytest
+from bson import ObjectId
+from conftest import make_conference, make_location
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def conferences(layout, store):
+    # Five conferences starting on consecutive days over two locations, the first one finished
+    javits, moscone = make_location(), make_location(name="Moscone Center", city="San Francisco",
+                                                     state={"name": "California", "abbreviation": "CA"})
+    conferences = []
+    for day in range(1, 6):
+        location = javits if day % 2 else moscone
+        conference = make_conference(location, name=f"Day {day}", starts=datetime(2026, 5, day),
+                                     ends=datetime(2026, 5, day + 1), attendees=[ObjectId() for _ in range(day)])
+        location.conferences.append(conference)
+        conferences.append(conference)
+    await store(javits)
+    await store(moscone)
+    return conferences
+
+
+async def test_calendar_orders_the_range_by_start(layout, conferences):
+    _, ds = layout
+    calendar = await ds.conference_calendar(ends_after=datetime(2026, 5, 3), starts_before=datetime(2026, 5, 5))
+
+    assert [conference["name"] for conference in calendar] == ["Day 2", "Day 3", "Day 4"]
+    assert calendar[1]["location"]["city"] == "New York"
+    assert calendar[2]["location"]["city"] == "San Francisco"
+    assert all("attendees" not in conference for conference in calendar)
+
+
+async def test_calendar_pages_follow_after(layout, conferences):
+    _, ds = layout
+    names, after = [], None
+    while True:
+        page = await ds.conference_calendar(ends_after=datetime(2026, 5, 3), after=after, limit=2)
+        names.extend(conference["name"] for conference in page)
+        if len(page) < 2:
+            break
+        after = (page[-1]["starts"], page[-1]["id"])
+
+    assert names == ["Day 2", "Day 3", "Day 4", "Day 5"]
+
+
+async def test_calendar_filters_by_state(layout, conferences):
+    _, ds = layout
+    calendar = await ds.conference_calendar(ends_after=datetime(2026, 5, 1), state="CA")
+
+    assert [conference["name"] for conference in calendar] == ["Day 2", "Day 4"]
+
+
+async def test_embedded_calendar_counts_without_the_arrays(db):
+    # Conferences stored before the counters existed count their arrays
+    location = make_location()
+    location.conferences.append(make_conference(location, attendees=[ObjectId() for _ in range(3)]))
+    await db.locations.insert_one(location.dict(by_alias=True))
+
+    calendar = await datastore.conference_calendar(ends_after=datetime(2026, 5, 1))
+
+    assert [(conference["attendee_count"], conference["presentation_count"]) for conference in calendar] == [(3, 0)]
+    assert "attendees" not in calendar[0] and "presentations" not in calendar[0]
@@ -0,0 +1,121 @@
+import gzip
+import zlib
+
+import brotli
+import pytest
+import settings
+import zstandard
+from common import compression
+from test_export import lines, token
+
+pytestmark = pytest.mark.anyio
+
+
+def zstd_decompress(body: bytes) -> bytes:
+    # Compressed as a stream, the frame doesn't record its size
+    return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+
+@pytest.fixture
+def encodings(monkeypatch):
+    monkeypatch.setattr(compression, "ENCODINGS", ["zstd", "br", "gzip"])
+
+
+@pytest.fixture
+def min_size(monkeypatch):
+    # Small enough for the states list to be compressed
+    monkeypatch.setattr(settings, "COMPRESSION_MIN_SIZE", 256)
+
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    (None, None),
+    ("identity", None),
+    ("gzip", "gzip"),
+    ("gzip, br", "br"),
+    ("gzip, br, zstd", "zstd"),
+    ("gzip;q=1.0, br;q=0.5", "gzip"),
+    ("br;q=0, gzip", "gzip"),
+    ("*", "zstd"),
+    ("*;q=0.1, gzip;q=0.5", "gzip"),
+    ("GZIP;q=bogus, br", "br"),
+])
+def test_negotiate(encodings, accept_encoding, expected):
+    assert compression.negotiate(accept_encoding) == expected
+
+
+@pytest.mark.parametrize("encoding, decompress", [
+    ("gzip", gzip.decompress), ("br", brotli.decompress), ("zstd", zstd_decompress),
+])
+async def test_responses_are_compressed_with_the_negotiated_encoding(db, client, encodings, min_size, encoding,
+                                                                     decompress):
+    plain = await client.get("/api/states/", headers={"Accept-Encoding": "identity"})
+    assert len(plain.content) >= settings.COMPRESSION_MIN_SIZE
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["vary"] == "Accept-Encoding"
+
+    async with client.stream("GET", "/api/states/", headers={"Accept-Encoding": encoding}) as response:
+        body = b"".join([chunk async for chunk in response.aiter_raw()])
+
+    assert response.headers["content-encoding"] == encoding
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.headers["etag"] == f"W/{plain.headers['etag']}"
+    assert int(response.headers["content-length"]) == len(body) < len(plain.content)
+    assert decompress(body) == plain.content
+
+
+async def test_not_modified_matches_the_compressed_response(db, client, min_size):
+    response = await client.get("/api/states/", headers={"Accept-Encoding": "gzip"})
+    etag = response.headers["etag"]
+    assert etag.startswith("W/")
+
+    not_modified = await client.get("/api/states/", headers={"Accept-Encoding": "gzip", "If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == etag
+    assert not_modified.headers["vary"] == "Accept-Encoding"
+
+    # Uncompressed, the same representation revalidates with its strong ETag
+    not_modified = await client.get("/api/states/", headers={"Accept-Encoding": "identity", "If-None-Match": etag})
+    assert not_modified.status_code == 304
+    assert not_modified.headers["etag"] == etag.removeprefix("W/")
+    assert not_modified.headers["vary"] == "Accept-Encoding"
+
+
+async def test_streamed_bodies_are_compressed_chunk_by_chunk(db, client):
+    await db.locations.insert_many([{"name": f"Venue {i}", "city": "New York", "room_count": 1, "picture_url": "",
+                                     "state": {"name": "New York", "abbreviation": "NY"}} for i in range(3)])
+    headers = {**token("admin"), "Accept-Encoding": "gzip"}
+    async with client.stream("GET", "/api/export/locations", headers=headers) as response:
+        body = b"".join([chunk async for chunk in response.aiter_raw()])
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    # Small as it is, the streamed body is compressed: its size isn't known when it starts
+    assert len(lines(gzip.decompress(body))) == 3
+
+
+def test_every_chunk_decodes_on_arrival():
+    encoder, decoder = compression.Encoder("gzip"), zlib.decompressobj(31)
+    for chunk in (b'{"id": 1}\n', b'{"id": 2}\n'):
+        assert decoder.decompress(encoder.compress(chunk, final=False)) == chunk
+    assert decoder.decompress(encoder.compress(b"", final=True)) == b""
+    assert decoder.eof
+
+
+async def test_gzip_exports_pass_through(db, client):
+    await db.locations.insert_one({"name": "Javits Center", "city": "New York", "room_count": 1, "picture_url": "",
+                                   "state": {"name": "New York", "abbreviation": "NY"}})
+    headers = {**token("admin"), "Accept-Encoding": "gzip"}
+    async with client.stream("GET", "/api/export/locations", params={"gzip": "true"}, headers=headers) as response:
+        body = b"".join([chunk async for chunk in response.aiter_raw()])
+
+    assert response.headers["content-type"] == "application/gzip"
+    assert "content-encoding" not in response.headers
+    assert len(lines(gzip.decompress(body))) == 1
+
+
+async def test_small_bodies_pass_through(db, client):
+    response = await client.get("/api/locations/", headers={"Accept-Encoding": "gzip"})
+
+    assert len(response.content) < settings.COMPRESSION_MIN_SIZE
+    assert "content-encoding" not in response.headers
+    assert response.headers["vary"] == "Accept-Encoding"
@@ -0,0 +1,12 @@
+import pytest
+from conftest import make_conference, make_location
+from starlette.exceptions import HTTPException
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_create_with_a_malformed_location_id_is_a_bad_request(db, layout):
+    _, ds = layout
+    with pytest.raises(HTTPException) as e:
+        await ds.conference_create("bogus", make_conference(make_location()))
+    assert e.value.status_code == 400
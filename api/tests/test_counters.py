@@ -0,0 +1,66 @@
+import datastore as ds
+import pytest
+from bson import ObjectId
+from conftest import make_conference, make_location
+from routes.models import Presentation
+
+pytestmark = pytest.mark.anyio
+
+
+async def store_legacy(db, attendees: int, presentations: int):
+    # A location whose conference was written before the counters existed
+    location = make_location()
+    conference = make_conference(location, max_attendees=100, max_presentations=10)
+    conference.attendees = [ObjectId() for _ in range(attendees)]
+    conference.presentations = [Presentation(presenter=ObjectId(), title=f"Talk {i}", synopsis="s")
+                                for i in range(presentations)]
+    location.conferences.append(conference)
+    await db.locations.insert_one(location.dict(by_alias=True))
+    return location, conference
+
+
+async def stored_conference(db, location):
+    return (await db.locations.find_one({"_id": location.id}))["conferences"][0]
+
+
+async def test_new_conferences_start_with_counters(db):
+    location = make_location()
+    await db.locations.insert_one(location.dict(by_alias=True))
+    await ds.conference_create(str(location.id), make_conference(location))
+
+    conference = await stored_conference(db, location)
+    assert (conference["attendee_count"], conference["presentation_count"]) == (0, 0)
+
+
+async def test_init_counters_counts_the_arrays(db):
+    location, conference = await store_legacy(db, attendees=50, presentations=3)
+
+    assert await ds.init_counters(str(location.id), str(conference.id)) is True
+    stored = await stored_conference(db, location)
+    assert (stored["attendee_count"], stored["presentation_count"]) == (50, 3)
+    # Already set, nothing to retry
+    assert await ds.init_counters(str(location.id), str(conference.id)) is False
+
+
+@pytest.mark.array_filters
+@pytest.mark.parametrize("layout", ["embedded"], indirect=True)
+async def test_writes_to_a_legacy_conference_start_from_its_arrays(db, layout):
+    location, conference = await store_legacy(db, attendees=50, presentations=3)
+    location_id, conference_id = str(location.id), str(conference.id)
+
+    attendee_id = ObjectId()
+    await ds.attendee_create(location_id, conference_id, attendee_id)
+    assert (await stored_conference(db, location))["attendee_count"] == 51
+    assert await ds.attendee_delete(location_id, conference_id, str(attendee_id)) == 1
+    assert await ds.attendee_delete(location_id, conference_id, str(conference.attendees[0])) == 1
+
+    presentation, _ = await ds.presentation_create(
+        location_id, conference_id, Presentation(presenter=ObjectId(), title="New talk", synopsis="s"),
+    )
+    assert await ds.presentation_delete(location_id, conference_id, str(conference.presentations[0].id)) == 1
+
+    stored = await stored_conference(db, location)
+    assert (stored["attendee_count"], stored["presentation_count"]) == (49, 3)
+    assert (len(stored["attendees"]), len(stored["presentations"])) == (49, 3)
+    stats = await ds.conference_stats(conference_id)
+    assert (stats.attendee_count, stats.presentation_count) == (49, 3)
@@ -0,0 +1,94 @@
+import asyncio
+import gzip
+import json
+
+import conference_go
+import datastore
+import pytest
+from auth_utility import generate_token
+from bson import ObjectId
+from conftest import make_conference, make_location
+from pymongo.errors import AutoReconnect
+
+pytestmark = pytest.mark.anyio
+
+
+def token(*roles: str) -> dict:
+    payload = {"_id": str(ObjectId()), "username": "admin", "roles": list(roles)}
+    return {"Authorization": f"Bearer {generate_token(payload)}"}
+
+
+def lines(body: bytes) -> list:
+    return [json.loads(line) for line in body.splitlines()]
+
+
+@pytest.fixture
+async def locations(db):
+    locations = [make_location(name=f"Venue {i}") for i in range(3)]
+    locations[0].conferences.append(make_conference(locations[0]))
+    await db.locations.insert_many([location.dict(by_alias=True) for location in locations])
+    return locations
+
+
+async def test_export_streams_ndjson(client, locations):
+    response = await client.get("/api/export/locations", headers=token("admin"))
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    rows = lines(response.content)
+    assert [row["id"] for row in rows] == [str(location.id) for location in locations]
+    assert all("conferences" not in row for row in rows)
+
+
+async def test_export_gzip(client, locations):
+    response = await client.get("/api/export/locations", params={"gzip": "true"}, headers=token("admin"))
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/gzip"
+    assert response.headers["content-disposition"] == 'attachment; filename="locations.ndjson.gz"'
+    assert len(lines(gzip.decompress(response.content))) == len(locations)
+
+
+async def test_export_needs_an_admin(client, locations):
+    assert (await client.get("/api/export/locations")).status_code == 403
+    assert (await client.get("/api/export/locations", headers=token())).status_code == 403
+
+
+async def test_unknown_export(client, locations):
+    assert (await client.get("/api/export/speakers", headers=token("admin"))).status_code == 404
+
+
+@pytest.mark.parametrize("compress", [False, True])
+async def test_error_mid_stream_ends_with_an_error_line(db, monkeypatch, compress):
+    async def failing(state=None, city=None):
+        yield {"id": "1"}
+        raise AutoReconnect("connection reset")
+    monkeypatch.setattr(datastore, "export_locations", failing)
+
+    # What a server would send before logging the error and dropping the connection
+    scope = {"type": "http", "method": "GET", "path": "/api/export/locations", "raw_path": b"/api/export/locations",
+             "query_string": f"gzip={compress}".encode(), "http_version": "1.1", "scheme": "http",
+             "server": ("localhost", 80), "client": ("127.0.0.1", 1234), "root_path": "",
+             "headers": [(b"host", b"localhost"), *((k.lower().encode(), v.encode()) for k, v in token("admin").items())]}
+    messages, requested = [], asyncio.Event()
+
+    async def receive():
+        # The request, then a client that stays connected
+        if requested.is_set():
+            await asyncio.Event().wait()
+        requested.set()
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    with pytest.raises(Exception):
+        await conference_go.app(scope, receive, send)
+
+    assert messages[0]["status"] == 200
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    assert messages[-1]["more_body"]  # the body was never ended
+    rows = lines(gzip.decompress(body) if compress else body)
+    assert rows[0] == {"id": "1"}
+    assert rows[-1]["rows"] == 1
+    assert "connection reset" in rows[-1]["error"]
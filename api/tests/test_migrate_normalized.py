@@ -0,0 +1,63 @@
+import migrate_normalized
+import pytest
+import settings
+from conftest import make_conference, make_location
+from normalized_datastore import conference_document
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_sync_refuses_to_run_once_normalized(db, monkeypatch):
+    monkeypatch.setattr(settings, "STORAGE_LAYOUT", "normalized")
+    location = make_location()
+    conference = make_conference(location)
+    await db.locations.insert_one(location.dict(by_alias=True))  # conferences: [], as written when normalized
+    await db.conferences.insert_one(conference_document(conference))
+
+    assert await migrate_normalized.sync(100, restart=True) is None
+    assert await db.conferences.count_documents({"_id": conference.id}) == 1
+    assert await db.migrations.count_documents({}) == 0
+
+
+async def test_sync_copies_embedded_conferences_and_removes_deleted_ones(db):
+    location = make_location()
+    kept, deleted = make_conference(location, name="Kept"), make_conference(location, name="Deleted")
+    location.conferences.append(kept)
+    await db.locations.insert_one(location.dict(by_alias=True))
+    await db.conferences.insert_one(conference_document(deleted))
+
+    assert await migrate_normalized.sync(100, restart=True) == 1
+    assert [c["_id"] async for c in db.conferences.find({"location_id": location.id})] == [kept.id]
+
+
+async def test_sync_leaves_pruned_locations_alone(db):
+    location = make_location()
+    conference = make_conference(location)
+    await db.locations.insert_one(location.dict(by_alias=True, exclude={"conferences"}))
+    await db.conferences.insert_one(conference_document(conference))
+    await db.registrations.insert_one({"conference_id": conference.id, "location_id": location.id,
+                                       "attendee_id": conference.id})
+
+    assert await migrate_normalized.sync(100, restart=True) == 1
+    assert await db.conferences.count_documents({"_id": conference.id}) == 1
+    assert await db.registrations.count_documents({"location_id": location.id}) == 1
+
+
+async def test_cutover_pauses_writes_and_keeps_them(db, client, monkeypatch):
+    location = make_location()
+    location.conferences.append(make_conference(location, name="Before"))
+    await db.locations.insert_one(location.dict(by_alias=True))
+    assert await migrate_normalized.sync(100, restart=True) == 1
+
+    # A write after the bulk copy, then writes paused for the final copy
+    await db.locations.update_one({"_id": location.id},
+                                  {"$push": {"conferences": make_conference(location, name="After").dict(by_alias=True)}})
+    monkeypatch.setattr(settings, "WRITES_PAUSED", True)
+    response = await client.delete(f"/api/locations/{location.id}/")
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+    assert (await client.get(f"/api/locations/{location.id}/")).status_code == 200
+
+    assert await migrate_normalized.sync(100, restart=True) == 1
+    names = {c["name"] async for c in db.conferences.find({"location_id": location.id})}
+    assert names == {"Before", "After"}
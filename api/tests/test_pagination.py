@@ -0,0 +1,40 @@
+import pytest
+from conftest import make_location
+
+pytestmark = pytest.mark.anyio
+
+LOCATIONS = 105
+
+
+@pytest.fixture
+async def locations(db):
+    locations = [make_location(name=f"Venue {i}") for i in range(LOCATIONS)]
+    await db.locations.insert_many([location.dict(by_alias=True) for location in locations])
+    return sorted(str(location.id) for location in locations)
+
+
+async def test_lists_are_whole_unless_paged(client, locations):
+    response = await client.get("/api/locations/")
+
+    assert response.status_code == 200
+    assert [location["id"] for location in response.json()["locations"]] == locations
+    assert response.json()["next"] is None
+
+
+async def test_pages_follow_next(client, locations):
+    ids, params = [], {"limit": 40}
+    while True:
+        page = (await client.get("/api/locations/", params=params)).json()
+        ids.extend(location["id"] for location in page["locations"])
+        if page["next"] is None:
+            break
+        params = {"limit": 40, "after": page["next"]}
+
+    assert ids == locations
+
+
+async def test_after_alone_pages_with_the_default_limit(client, locations):
+    page = (await client.get("/api/locations/", params={"after": locations[0]})).json()
+
+    assert [location["id"] for location in page["locations"]] == locations[1:101]
+    assert page["next"] == locations[100]
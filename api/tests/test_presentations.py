@@ -0,0 +1,15 @@
+import pytest
+from bson import ObjectId
+from routes.models import Presentation
+from starlette.exceptions import HTTPException
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("location_id, conference_id", [("bogus", str(ObjectId())), (str(ObjectId()), "bogus")])
+async def test_create_with_a_malformed_id_is_a_bad_request(db, layout, location_id, conference_id):
+    _, ds = layout
+    presentation = Presentation(presenter=ObjectId(), title="Talk", synopsis="About things")
+    with pytest.raises(HTTPException) as e:
+        await ds.presentation_create(location_id, conference_id, presentation)
+    assert e.value.status_code == 400
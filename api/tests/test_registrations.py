@@ -0,0 +1,62 @@
+import asyncio
+from collections import Counter
+
+import pytest
+from bson import ObjectId
+from conftest import make_conference, make_location
+from starlette.exceptions import HTTPException
+
+pytestmark = [pytest.mark.anyio, pytest.mark.array_filters]
+
+SEATS = 20
+USERS = 60
+
+
+async def register(ds, location_id, conference_id, user_id):
+    try:
+        await ds.attendee_create(str(location_id), str(conference_id), user_id)
+        return 201
+    except HTTPException as e:
+        return e.status_code
+
+
+async def stored_attendees(db, layout, conference_id):
+    # (attendee ids, attendee_count) as stored
+    if layout == "embedded":
+        location = await db.locations.find_one({"conferences._id": conference_id})
+        conference = next(c for c in location["conferences"] if c["_id"] == conference_id)
+        return conference["attendees"], conference["attendee_count"]
+    registrations = await db.registrations.find({"conference_id": conference_id}).to_list(None)
+    conference = await db.conferences.find_one({"_id": conference_id})
+    return [registration["attendee_id"] for registration in registrations], conference["attendee_count"]
+
+
+async def test_concurrent_registrations_fill_exactly_the_seats(db, layout, store):
+    name, ds = layout
+    location = make_location()
+    conference = make_conference(location, max_attendees=SEATS)
+    location.conferences.append(conference)
+    await store(location)
+
+    user_ids = [ObjectId() for _ in range(USERS)]
+    statuses = await asyncio.gather(*(register(ds, location.id, conference.id, user_id) for user_id in user_ids))
+
+    assert Counter(statuses) == {201: SEATS, 409: USERS - SEATS}
+    attendees, attendee_count = await stored_attendees(db, name, conference.id)
+    assert len(attendees) == attendee_count == SEATS
+    assert len(set(attendees)) == SEATS
+    assert set(attendees) == {user_id for user_id, status in zip(user_ids, statuses) if status == 201}
+
+
+async def test_concurrent_duplicate_registrations_take_one_seat(db, layout, store):
+    name, ds = layout
+    location = make_location()
+    conference = make_conference(location, max_attendees=SEATS)
+    location.conferences.append(conference)
+    await store(location)
+
+    user_id = ObjectId()
+    statuses = await asyncio.gather(*(register(ds, location.id, conference.id, user_id) for _ in range(10)))
+
+    assert Counter(statuses) == {201: 1, 400: 9}
+    assert await stored_attendees(db, name, conference.id) == ([user_id], 1)
@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+
+import datastore as ds
+import pytest
+from conftest import make_conference, make_location
+
+pytestmark = pytest.mark.anyio
+
+
+async def indexed(db, location):
+    return {document["title"] async for document in db[ds.SEARCH].find({"location_id": location.id})}
+
+
+async def test_reindex_replaces_the_locations_documents(db):
+    location = make_location()
+    location.conferences = [make_conference(location, name="PyCon"), make_conference(location, name="JSConf")]
+    await db.locations.insert_one(location.dict(by_alias=True))
+
+    assert await ds.search_reindex(location.id) == 2
+    await db.locations.update_one({"_id": location.id}, {"$pull": {"conferences": {"name": "JSConf"}}})
+    assert await ds.search_reindex(location.id) == 1
+
+    assert await indexed(db, location) == {"PyCon"}
+    assert await db[ds.SEARCH_LOCKS].count_documents({}) == 0
+
+
+async def test_a_reindex_during_another_makes_it_read_again(db, monkeypatch):
+    # The first reindex reads, a conference is added and its own reindex runs before the first
+    # one writes its (now stale) copies
+    location = make_location()
+    location.conferences = [make_conference(location, name="PyCon")]
+    await db.locations.insert_one(location.dict(by_alias=True))
+    search_entries = ds.search_entries
+    reads = []
+
+    async def interleaved(location_id):
+        documents = await search_entries(location_id)
+        reads.append(len(documents))
+        if len(reads) == 1:
+            added = make_conference(location, name="JSConf")
+            await db.locations.update_one({"_id": location.id}, {"$push": {"conferences": added.dict(by_alias=True)}})
+            assert await ds.search_reindex(location.id) == 0
+        return documents
+
+    monkeypatch.setattr(ds, "search_entries", interleaved)
+    assert await ds.search_reindex(location.id) == 2
+
+    assert reads == [1, 2]
+    assert await indexed(db, location) == {"PyCon", "JSConf"}
+    assert await db[ds.SEARCH_LOCKS].count_documents({}) == 0
+
+
+async def test_an_expired_lock_is_taken_over(db):
+    location = make_location()
+    location.conferences = [make_conference(location)]
+    await db.locations.insert_one(location.dict(by_alias=True))
+    await db[ds.SEARCH_LOCKS].insert_one({"_id": location.id, "token": None, "dirty": False,
+                                          "expires": datetime.utcnow() - timedelta(seconds=1)})
+
+    assert await ds.search_reindex(location.id) == 1
+    assert await indexed(db, location) == {"PyCon"}
@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+import settings
+from common.jobs import JobRunner
+from routes import third_party
+
+pytestmark = pytest.mark.anyio
+
+PHOTO = "https://images.pexels.com/photos/1/pexels-photo-1.jpeg"
+
+
+class Pexels:
+    # Stands in for the Pexels API through the worker's pooled client: answers with `photos`,
+    # or raises `error` instead, and records every request it gets
+    def __init__(self):
+        self.photos = [{"src": {"original": PHOTO}}]
+        self.error = None
+        self.status_code = 200
+        self.requests = []
+
+    def handle(self, request: httpx.Request):
+        self.requests.append(request)
+        if self.error is not None:
+            raise self.error
+        return httpx.Response(self.status_code, json={"photos": self.photos})
+
+
+@pytest.fixture
+async def pexels(db, monkeypatch):
+    monkeypatch.setattr(settings, "PEXELS_API_KEY", "test-key")
+    pexels = Pexels()
+    # A client with the worker's base URL, key and timeouts, sending to the stub
+    await third_party.use_client(third_party.create_client(httpx.MockTransport(pexels.handle)))
+    yield pexels
+    await third_party.close_client()
+
+
+async def test_lookups_are_cached_per_city(pexels):
+    assert await third_party.get_photo("New York", "NY") == {"picture_url": PHOTO}
+    assert await third_party.get_photo(" new york", "ny ") == {"picture_url": PHOTO}
+
+    assert len(pexels.requests) == 1
+    assert pexels.requests[0].url.params["query"] == "downtown New York NY"
+    assert pexels.requests[0].headers["Authorization"] == "test-key"
+
+
+async def test_expired_entries_are_looked_up_again(pexels, db):
+    await third_party.get_photo("New York", "NY")
+    await db[third_party.PHOTO_CACHE].update_many({}, {"$set": {"expires": datetime.utcnow() - timedelta(seconds=1)}})
+    await third_party.get_photo("New York", "NY")
+
+    assert len(pexels.requests) == 2
+
+
+async def test_no_photo_is_cached_for_the_negative_ttl(pexels, db):
+    pexels.photos = []
+    assert await third_party.get_photo("Nowhere", "KS") == {"picture_url": None}
+    assert await third_party.get_photo("Nowhere", "KS") == {"picture_url": None}
+
+    assert len(pexels.requests) == 1
+    entry = await db[third_party.PHOTO_CACHE].find_one({"_id": "nowhere|ks"})
+    assert entry["picture_url"] is None
+    ttl = entry["expires"] - datetime.utcnow()
+    assert timedelta(0) < ttl <= timedelta(seconds=settings.PHOTO_NEGATIVE_CACHE_TTL_SECONDS)
+
+
+@pytest.mark.parametrize("error, status_code", [
+    (httpx.ReadTimeout("timed out"), 200),
+    (httpx.ConnectError("connection refused"), 200),
+    (None, 500),
+])
+async def test_upstream_failures_are_not_cached(pexels, db, error, status_code):
+    pexels.error, pexels.status_code = error, status_code
+    assert await third_party.get_photo("New York", "NY") == {"picture_url": None}
+    assert await db[third_party.PHOTO_CACHE].count_documents({}) == 0
+
+    pexels.error, pexels.status_code = None, 200
+    assert await third_party.get_photo("New York", "NY") == {"picture_url": PHOTO}
+    assert len(pexels.requests) == 2
+
+
+async def test_inline_lookup_fills_the_new_location(pexels, client):
+    response = await client.post("/api/locations/", json={
+        "name": "Javits Center", "city": "New York", "room_count": 10, "state": "New York",
+    })
+
+    assert response.status_code == 201
+    assert response.json()["picture_url"] == PHOTO
+
+
+async def test_background_lookup_fills_the_picture_in_later(pexels, client, db, monkeypatch):
+    monkeypatch.setattr(settings, "PHOTO_LOOKUP", "background")
+    response = await client.post("/api/locations/", json={
+        "name": "Javits Center", "city": "New York", "room_count": 10, "state": "New York",
+    })
+
+    assert response.status_code == 201
+    assert response.json()["picture_url"] is None
+    assert pexels.requests == []
+
+    runner = JobRunner(workers=0, max_attempts=1, backoff=0, poll_interval=1, lease=60)
+    document = await runner.claim()
+    assert document["name"] == "fill_location_photo"
+    await runner.run(document)
+
+    location = await db.locations.find_one({"_id": document["payload"]["location_id"]})
+    assert location["picture_url"] == PHOTO
+    assert len(pexels.requests) == 1
+    assert await db.jobs.count_documents({}) == 0
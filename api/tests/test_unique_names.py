@@ -0,0 +1,49 @@
+import json
+
+import datastore as ds
+import pytest
+from conftest import make_location
+from importer import run_import
+from starlette.exceptions import HTTPException
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(params=["index", "no index"])
+async def unique_index(request, db):
+    # "no index": the unique indexes were skipped over existing duplicates, see indexes.ensure_indexes
+    if request.param == "no index":
+        await db.locations.drop_index("name_unique")
+        await db.users.drop_index("username_unique")
+    return request.param
+
+
+async def test_location_names_stay_unique(db, unique_index):
+    await ds.location_create(make_location(name="Javits Center"))
+    with pytest.raises(HTTPException) as e:
+        await ds.location_create(make_location(name="Javits Center"))
+
+    assert e.value.status_code == 400
+    assert await db.locations.count_documents({"name": "Javits Center"}) == 1
+
+
+async def test_imported_location_names_stay_unique(db, unique_index):
+    await ds.location_create(make_location(name="Javits Center"))
+    rows = [{"name": name, "city": "New York", "state": "NY", "room_count": 5}
+            for name in ("Javits Center", "Pier 36", "Pier 36", "Terminal 5")]
+    report = await run_import("locations", "\n".join(map(json.dumps, rows)).encode(), "ndjson")
+
+    assert report["created"] == 2
+    assert [error["row"] for error in report["errors"]] == [1, 3]
+    assert sorted(await db.locations.distinct("name")) == ["Javits Center", "Pier 36", "Terminal 5"]
+
+
+async def test_usernames_stay_unique(db, unique_index):
+    user = {"username": "ada", "name": "Ada", "email": "ada@example.com", "company_name": "Analytical Engines",
+            "password_hash": "x"}
+    assert await ds.create_user(dict(user))
+    with pytest.raises(HTTPException) as e:
+        await ds.create_user(dict(user))
+
+    assert e.value.status_code == 400
+    assert await db.users.count_documents({"username": "ada"}) == 1
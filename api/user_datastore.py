@@ -1,22 +1,14 @@
-import os
 from typing import List
 
 from bson import ObjectId
 from bson.errors import InvalidId
+from common.database import db
 from pydantic import ValidationError
-from pymongo import MongoClient, ReturnDocument
+from pymongo import ReturnDocument
 from pymongo.errors import PyMongoError
 from routes.models import Conference, User, Presentation
 from starlette.exceptions import HTTPException
 
-MONGO_DB_CONNECTION_STRING = os.environ["MONGO_DB_CONNECTION_STRING"]
-MONGO_DB_NAME = os.environ["MONGO_DB_NAME"]
-
-url = MONGO_DB_CONNECTION_STRING
-db_name = MONGO_DB_NAME
-
-client = MongoClient(url)
-db = client[db_name]
 
 def handle_exceptions(e, id=None, model_name=""):
     if isinstance(e, InvalidId):
@@ -30,27 +22,26 @@ def handle_exceptions(e, id=None, model_name=""):
 
 
 async def user_create(user: User):
-    if (count := db.users.count_documents({"name": user.name})) > 0:
+    if (count := await db.users.count_documents({"name": user.name})) > 0:
         raise HTTPException(status_code=400, detail="User already exists")
     try:
-        response = db.users.insert_one(user.dict(by_alias=True))
-        user = db["users"].find_one({"_id": response.inserted_id})
-        return User(**user)
+        response = await db.users.insert_one(user.dict(by_alias=True))
+        user = await db["users"].find_one({"_id": response.inserted_id})
+        return User.from_mongo(user)
     except (ValidationError, PyMongoError) as e:
         handle_exceptions(user.name, e)
 
 async def user_all():
     try:
-        db_users = db.users.find()
-        return [User(**user) for user in db_users]
+        return [User.from_mongo(user) async for user in db.users.find()]
     except (ValidationError, PyMongoError) as e:
         handle_exceptions(e)
 
 async def user_details(user_id: str):
     try:
-        if (user := db.users.find_one({"_id": ObjectId(user_id)})) is None:
+        if (user := await db.users.find_one({"_id": ObjectId(user_id)})) is None:
             raise HTTPException(status_code=400, detail="User does not exist")
-        return User(**user)
+        return User.from_mongo(user)
     except (ValidationError, PyMongoError, InvalidId) as e:
         handle_exceptions(e, user_id)
 
@@ -58,7 +49,7 @@ async def user_update(update_fields: dict, id: str):
     try:
         # The $set operator within the update document specifies the properties you want to update for
         # the matched user.
-        result = db.users.update_one(
+        result = await db.users.update_one(
             {"_id": ObjectId(id)},
             {"$set": update_fields}
         )
@@ -73,6 +64,6 @@ async def user_update(update_fields: dict, id: str):
 
 async def user_delete(user_id: str):
     try:
-        return db.users.delete_one({"_id": ObjectId(user_id)}).deleted_count
+        return (await db.users.delete_one({"_id": ObjectId(user_id)})).deleted_count
     except (PyMongoError, InvalidId) as e:
         handle_exceptions(e, user_id)
@@ -13,7 +13,7 @@ function ConferenceForm() {
   })
 
   const getData = async () => {
-    const url = 'http://localhost:8000/api/locations/';
+    const url = 'http://localhost:8000/api/locations/?fields=id,name';
     const response = await fetch(url);
 
     if (response.ok) {
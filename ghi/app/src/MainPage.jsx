@@ -27,23 +27,19 @@ const MainPage = () => {
   const [conferences, setConferences] = useState([])
 
   const fetchData = async () => {
-    const url = 'http://localhost:8000/api/locations/';
+    const url = 'http://localhost:8000/api/conferences/calendar?days=90&limit=30';
     const response = await fetch(url);
     if (response.ok) {
-      // Get the list of conferences
+      // Get the upcoming conferences, soonest first
       const data = await response.json();
 
-      const conferences = data.locations.reduce((accumulator, currentLocation) => {
-        const locationConferences = currentLocation.conferences.map(conference =>
-          ({...conference,
-            location: {
-              pictureUrl: currentLocation.picture_url,
-              name: currentLocation.name
-            }
-          }))
-
-        return [...accumulator, ...locationConferences]
-      },[])
+      const conferences = data.conferences.map(conference =>
+        ({...conference,
+          location: {
+            pictureUrl: conference.location.picture_url,
+            name: conference.location.name
+          }
+        }))
       setConferences(conferences)
     }
   }
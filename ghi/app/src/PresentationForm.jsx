@@ -12,7 +12,7 @@ function PresentationForm () {
   })
 
   const getData = async () => {
-    const url = 'http://localhost:8000/api/conferences/';
+    const url = 'http://localhost:8000/api/conferences/?fields=id,name';
     const response = await fetch(url);
 
     if (response.ok) {